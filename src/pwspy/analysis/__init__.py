@@ -29,10 +29,20 @@ Submodules
     pws
     warnings
     dynamics
+    batch
+
+Classes
+---------
+
+.. autosummary::
+    :toctree: generated/
+
+    ReferenceCache
 
 """
 import os
 from ._abstract import AbstractAnalysisSettings, AbstractAnalysis, AbstractAnalysisResults, AbstractHDFAnalysisResults
+from ._referenceCache import ReferenceCache
 
 # TODO settings are missing reference IDtag but they exist in the results. Results and settings both contain extra reflectance idTag, reduntant
 
@@ -40,6 +50,6 @@ resources = os.path.join(os.path.split(__file__)[0], '_resources')
 defaultSettingsPath = os.path.join(resources, 'defaultAnalysisSettings')
 
 __all__ = ['AbstractAnalysisSettings', 'AbstractAnalysis', 'AbstractAnalysisResults',
-           'AbstractHDFAnalysisResults', 'resources', 'defaultSettingsPath']
+           'AbstractHDFAnalysisResults', 'ReferenceCache', 'resources', 'defaultSettingsPath']
 
 
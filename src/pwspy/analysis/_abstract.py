@@ -23,6 +23,7 @@ import h5py
 import numpy as np
 import typing
 from pwspy import __version__ as pwspyversion
+from pwspy.utility import hdfCodecs
 from pwspy.utility.misc import cached_property
 if typing.TYPE_CHECKING:
     from pwspy.dataTypes import ICBase
@@ -125,9 +126,32 @@ class AbstractAnalysis(ABC):
     @abstractmethod
     def copySharedDataToSharedMemory(self):
         """When running the `run` method in parallel memory for the object used must be copied to each new process. We can avoid that and save a lot of Ram by moving data
-        that is shared between processes to shared memory. If you don't want to implement this then just override it and raise NotImplementedError"""
+        that is shared between processes to shared memory. Implementations should use `_copyToSharedMemory` so that pickling
+        this object only sends the names of the shared memory blocks, this works with any multiprocessing start method. Calling this more
+        than once should have no further effect. If you don't want to implement this then just override it and raise NotImplementedError"""
         pass
 
+    @staticmethod
+    def _copyToSharedMemory(arr: np.ndarray) -> np.ndarray:
+        """Copy an array to shared memory. On Python 3.8 and newer this is a `pwspy.utility.sharedMemory.SharedArray`.
+        Older versions don't have `multiprocessing.shared_memory` so a `multiprocessing.RawArray` is used instead, this
+        is only shared with processes that are forked after it is created."""
+        try:
+            from pwspy.utility.sharedMemory import SharedArray  # Requires Python 3.8
+        except ImportError:
+            import multiprocessing as mp
+            shared = np.frombuffer(mp.RawArray('b', arr.nbytes), dtype=arr.dtype).reshape(arr.shape)  # Wrap the shared memory array in a numpy array
+            np.copyto(shared, arr)
+            return shared
+        return SharedArray.fromArray(arr)
+
+    def getFingerprint(self) -> str:
+        """Returns a string that identifies everything other than the data cube that affects the results of `run`, e.g.
+        the prepared reference, the extra reflection and the settings. Two analyses with the same fingerprint produce the
+        same results for the same cube. This is saved with results by `BatchAnalysisRunner` so that up to date results can
+        be skipped when an experiment is analyzed again. Raises NotImplementedError if not implemented."""
+        raise NotImplementedError(f"{type(self).__name__} does not support fingerprinting.")
+
 
 class AbstractAnalysisResults(ABC):
     """This abstract class lays out the most basic skeleton of what an AnalysisResults object should implement."""
@@ -212,6 +236,22 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
         self.dict = variablesDict
         self.analysisName = analysisName
 
+    def __getstate__(self):
+        """An open file can't be pickled so we pickle the file name and reopen the file when unpickling. Fields that
+        have already been loaded are pickled along with the rest of the object, with protocol 5 their arrays are
+        pickled out-of-band, see `pwspy.utility.sharedMemory.SharedMemoryPickle`. Fields that were loaded as h5py
+        objects (e.g. datasets) can't be pickled, they are left out and loaded again from the reopened file when they
+        are next accessed."""
+        state = {k: v for k, v in self.__dict__.items() if k == 'file' or not isinstance(v, h5py.HLObject)}
+        if self.file is not None:
+            state['file'] = self.file.filename
+        return state
+
+    def __setstate__(self, state):
+        if state['file'] is not None:
+            state['file'] = h5py.File(state['file'], 'r')
+        self.__dict__ = state
+
     @cached_property
     def moduleVersion(self) -> str:
         """The version of PWSpy code that this file was saved with."""
@@ -252,7 +292,9 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
         """
         pass
 
-    def toHDF(self, directory: str, name: str, overwrite: bool = False, compression: str = None):
+    def toHDF(self, directory: str, name: str, overwrite: bool = False, compression: str = None,
+              codec: typing.Optional[typing.Union[str, hdfCodecs.HDFCodec, typing.Dict[str, typing.Union[str, hdfCodecs.HDFCodec]]]] = None,
+              lowRankTolerance: typing.Optional[float] = None, fingerprint: typing.Optional[str] = None):
         """
         Save the AnalysisResults object to an HDF file in `directory`. The name of the file will be determined by `name`. If you want to know what the full file name
         will be you can use this class's `name2FileName` method.
@@ -262,6 +304,13 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
             name: The name of the analysis. This determines the file name.
             overwrite: If `True` then any existing file of the same name will be replaced.
             compression: The value of this argument will be passed to h5py.create_dataset for numpy arrays. See h5py documentation for available options.
+            codec: A codec from `pwspy.utility.hdfCodecs` (or the name of one) used to compress the array fields in
+                parallel. A dictionary can be used to select a codec for each field by name, fields that aren't in the
+                dictionary are saved normally. Readers decode the fields automatically.
+            lowRankTolerance: If provided then data cube fields are saved in the lossy low rank format with this
+                relative error tolerance. See `ICBase.toHdfDataset`.
+            fingerprint: A string identifying the inputs that the results were calculated from. It can be read back
+                with `loadFingerprint` without loading the results. See `AbstractAnalysis.getFingerprint`.
         """
         from pwspy.dataTypes import ICBase  # Need this for instance checking
         fileName = osp.join(directory, self.name2FileName(name))
@@ -271,10 +320,13 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
             with h5py.File(pythonFile, 'w', driver='fileobj') as hf:  # Using the default driver causes write errors when writing from windows to a Samba shared server. Using a reference to a python `File Object` solves this issue.
                 # Save version
                 hf.create_dataset('pwspy_version', data=np.string_(self._currentmoduleversion))
+                if fingerprint is not None:
+                    hf.attrs['inputFingerprint'] = np.string_(fingerprint)
                 # Save fields defined by implementing subclass
                 for field in self.fields():
                     k = field
                     v = getattr(self, field)
+                    fieldCodec = codec.get(k) if isinstance(codec, dict) else codec
                     if isinstance(v, AbstractAnalysisSettings):
                         v = v.toJsonString() # Convert to string, then string case will then handle saving the string.
                     elif isinstance(v, dict):  # Save as json. The str case will handle the actual saving.
@@ -282,9 +334,9 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
                     if isinstance(v, str):
                         hf.create_dataset(k, data=np.string_(v))  # h5py recommends encoding strings this way for compatability.
                     elif isinstance(v, ICBase):
-                        hf = v.toHdfDataset(hf, k, fixedPointCompression=True)
+                        hf = v.toHdfDataset(hf, k, fixedPointCompression=True, codec=fieldCodec, lowRankTolerance=lowRankTolerance)
                     elif isinstance(v, np.ndarray):
-                        hf.create_dataset(k, data=v, compression=compression)
+                        hdfCodecs.writeDataset(hf, k, v, codec=fieldCodec, compression=compression)
                     elif v is None:
                         pass
                     else:
@@ -306,6 +358,22 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
         file = h5py.File(filePath, 'r')
         return cls(file, None, name)
 
+    @classmethod
+    def loadFingerprint(cls, directory: str, name: str) -> typing.Optional[str]:
+        """Read the fingerprint of the inputs that were used to calculate saved results, without loading the results.
+
+        Args:
+            directory: The path to the folder containing the file.
+            name: The name of the analysis.
+        Returns:
+            The fingerprint passed to `toHDF`. `None` if the results were saved without one.
+        """
+        filePath = osp.join(directory, cls.name2FileName(name))
+        if not osp.exists(filePath):
+            raise OSError(f"The {cls.__name__} analysis file does not exist. {filePath}")
+        with h5py.File(filePath, 'r') as hf:
+            return hf.attrs['inputFingerprint'].decode() if 'inputFingerprint' in hf.attrs else None
+
     def __del__(self):
         if self.file is not None:  # Make sure to release the file if it's still open.
             try:
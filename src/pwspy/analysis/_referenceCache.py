@@ -0,0 +1,105 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+import glob
+import hashlib
+import json
+import logging
+import os
+import typing
+from typing import Callable, Optional
+import h5py
+import pwspy
+
+T = typing.TypeVar('T')
+
+
+class ReferenceCache:
+    """An on-disk cache of the reference data that is prepared when an analysis is constructed. Preparing a reference
+    involves camera correction, dust filtering, the calculation of the theoretical reflectance of the reference, and the
+    subtraction of extra reflection. This can take many seconds and must otherwise be repeated every time an analysis
+    is constructed, e.g. once in every worker process of a batch.
+
+    Each entry is keyed by the idTag of the reference, the idTag of the extra reflectance calibration, the settings that
+    affect the preparation, and the version of PWSpy, so an entry is only reused if the reference would have been
+    prepared identically. Entries are stored as HDF5 files which are written to a temporary file and then renamed into
+    place, so many processes can safely share a cache directory.
+
+    Args:
+        directory: The folder to store cached references in. It is created if it doesn't exist.
+    """
+    _SUFFIX = '_preparedReference.h5'
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def getKey(analysisName: str, refTag: str, erTag: Optional[str], settings: dict) -> str:
+        """Get the key that identifies a prepared reference.
+
+        Args:
+            analysisName: The name of the analysis class that prepares the reference.
+            refTag: The idTag of the reference acquisition.
+            erTag: The idTag of the extra reflectance calibration. `None` if no extra reflectance is used.
+            settings: A JSON serializable dictionary of everything else that affects the preparation of the reference.
+
+        Returns:
+            A hexadecimal hash of the inputs.
+        """
+        parts = {'analysis': analysisName, 'reference': refTag, 'extraReflectance': erTag, 'settings': settings,
+                 'version': pwspy.__version__}  # Changes to the code may change how references are prepared.
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str, create: Callable[[], T], save: Callable[[h5py.File, T], None], load: Callable[[h5py.File], T]) -> T:
+        """Load an entry from the cache, creating and saving it first if it isn't present.
+
+        Args:
+            key: The key of the entry, from `getKey`.
+            create: A function that prepares the reference. Only called if the entry isn't in the cache.
+            save: A function that saves the output of `create` to an open HDF5 file.
+            load: A function that loads the entry from an open HDF5 file.
+
+        Returns:
+            The output of `create` or `load`.
+        """
+        logger = logging.getLogger(__name__)
+        path = os.path.join(self.directory, f"{key}{self._SUFFIX}")
+        if os.path.exists(path):
+            try:
+                with h5py.File(path, 'r') as hf:
+                    return load(hf)
+            except (OSError, KeyError) as e:  # The file is unreadable, maybe it was written by an incompatible version of h5py. Just replace it.
+                logger.warning(f"Failed to load cached reference from {path}: {e!r}")
+        value = create()
+        tempPath = f"{path}.{os.getpid()}.tmp"  # Other processes will never see a partially written file.
+        try:
+            with h5py.File(tempPath, 'w') as hf:
+                save(hf, value)
+            os.replace(tempPath, path)
+        except OSError as e:  # Failing to cache is not a reason to fail the analysis.
+            logger.warning(f"Failed to save reference to cache at {path}: {e!r}")
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+        return value
+
+    def clear(self):
+        """Delete every entry in the cache."""
+        for path in glob.glob(os.path.join(self.directory, f"*{self._SUFFIX}")):
+            os.remove(path)
@@ -0,0 +1,424 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Run an analysis on many acquisitions in parallel. Data files are loaded by a pool of reader threads while previously
+loaded cubes are analyzed by a pool of processes and the results of finished analyses are saved by a writer thread.
+Results are saved with a fingerprint of their inputs so that when an experiment is analyzed again only the acquisitions
+that are new or have changed need to be processed.
+
+Classes
+---------
+
+.. autosummary::
+    :toctree: generated/
+
+    BatchAnalysisRunner
+    BatchTask
+    BatchResult
+    TaskStatus
+
+"""
+
+from __future__ import annotations
+import collections
+import concurrent.futures
+import dataclasses
+import enum
+import fnmatch
+import hashlib
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import queue
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Sequence, Tuple
+import psutil
+import pwspy
+import pwspy.dataTypes as pwsdt
+from ._abstract import AbstractAnalysis
+from . import warnings
+if typing.TYPE_CHECKING:
+    from pwspy.utility.sharedMemory import SharedMemoryPickle
+
+
+@dataclasses.dataclass
+class BatchTask:
+    """A single acquisition to be analyzed by `BatchAnalysisRunner`.
+
+    Attributes:
+        metadata: The metadata of the acquisition to analyze. The results are saved with its `saveAnalysis` method.
+        analysisName: The name to save the analysis results as.
+        overwrite: If `True` then an existing analysis of the same name will be replaced.
+    """
+    metadata: typing.Union[pwsdt.ICMetaData, pwsdt.DynMetaData]
+    analysisName: str
+    overwrite: bool = False
+
+
+class TaskStatus(enum.Enum):
+    """The state of the saved results of a `BatchTask` before it is run."""
+    New = enum.auto()  # No results have been saved under the name of the task.
+    Stale = enum.auto()  # Results exist but were calculated from different inputs, or were saved without a fingerprint.
+    UpToDate = enum.auto()  # Results exist and were calculated from the current acquisition files, reference, extra reflectance, settings, and version of PWSpy.
+
+
+@dataclasses.dataclass
+class BatchResult:
+    """The outcome of a `BatchTask`.
+
+    Attributes:
+        task: The task that was run.
+        succeeded: `True` if the analysis was run and saved.
+        warnings: The warnings generated by the analysis.
+        error: A description of the error that caused the last attempt to fail. `None` if the task succeeded.
+        attempts: The number of times the task was attempted.
+        duration: The time in seconds between the first attempt starting and the task finishing.
+        status: The state of the saved results before the task was run.
+        skipped: `True` if the task wasn't run because its saved results were already up to date.
+    """
+    task: BatchTask
+    succeeded: bool
+    warnings: List[warnings.AnalysisWarning]
+    error: Optional[str]
+    attempts: int
+    duration: float
+    status: TaskStatus
+    skipped: bool
+
+
+_ignoredFiles = ('bw*_*.mat', 'roi_*.h5', 'notes.txt')  # Lower case patterns of files that may be saved alongside old acquisitions but don't affect the analysis.
+
+
+def _getAcquisitionSignature(path: str) -> str:
+    """Returns a hash of the name, size and modification time of the files of an acquisition. `path` may be the folder
+    containing the acquisition files, subfolders such as `analyses` are not included, or a single file."""
+    if os.path.isfile(path):
+        st = os.stat(path)
+        files = [(os.path.basename(path), st.st_size, st.st_mtime_ns)]
+    else:
+        files = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file() and not any(fnmatch.fnmatch(entry.name.lower(), p) for p in _ignoredFiles):
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime_ns))
+    return hashlib.sha1(repr(sorted(files)).encode()).hexdigest()
+
+
+_workerAnalysis: Optional[AbstractAnalysis] = None  # Each worker process receives the analysis once when it starts.
+_workerStarts: Optional[mp.Queue] = None  # The worker reports when it starts each task here.
+
+
+def _initWorker(analysis: AbstractAnalysis, pids: mp.Queue, starts: mp.Queue):
+    """Runs when each worker process starts. The process ID is reported so that the worker can be terminated if it
+    exceeds the timeout."""
+    global _workerAnalysis, _workerStarts
+    _workerAnalysis = analysis
+    _workerStarts = starts
+    pids.put(os.getpid())
+
+
+def _analyzeCube(cube: SharedMemoryPickle, submissionId: int) -> SharedMemoryPickle:
+    """The cube and the returned tuple of (results, warnings) are passed through shared memory to avoid copying them.
+    The time that the task starts is reported so that the time spent starting the worker process doesn't count
+    towards the timeout."""
+    from pwspy.utility.sharedMemory import SharedMemoryPickle  # Requires Python 3.8
+    _workerStarts.put((submissionId, time.time()))
+    ret = _workerAnalysis.run(cube.loads())
+    if not isinstance(ret, tuple):
+        ret = ret, []
+    return SharedMemoryPickle.dumps(ret)
+
+
+class BatchAnalysisRunner:
+    """Runs an `AbstractAnalysis` on many acquisitions. The work is pipelined so that the loading of data files, the
+    analysis and the saving of results all overlap:
+
+    1. A pool of reader threads loads data cubes ahead of time. The number of cubes that are loaded but not yet
+       analyzed is limited so that memory usage stays bounded.
+    2. A pool of processes runs the analysis. The analysis object is sent to each worker only once, when the worker
+       starts, after its reference data has been moved to shared memory with `copySharedDataToSharedMemory`. Cubes and
+       results are passed to and from the workers through shared memory with `SharedMemoryPickle`.
+    3. A writer thread saves the results with `AnalysisManager.saveAnalysis`.
+
+    Tasks that raise an error, exceed the timeout, or are running when a worker process crashes are retried. If a
+    worker crashes or times out then the process pool is replaced and the other tasks that were running are restarted.
+    The timeout is measured from when a worker starts the task so the time taken to start the worker is not included.
+
+    Requires Python 3.8 or newer.
+
+    Results are saved with a fingerprint of the acquisition files, the reference, the extra reflectance, the settings,
+    and the version of PWSpy, see `AbstractAnalysis.getFingerprint`. In incremental mode tasks with saved results that
+    match the current fingerprint are skipped and stale results are recalculated. Use `dryRun` to see which tasks
+    would be run.
+
+    Args:
+        analysis: The analysis to run on each acquisition.
+        numProcesses: The number of worker processes. If `None` then this is chosen based on the size of the first
+            cube that is loaded, the available RAM, and the number of physical cores.
+        numReaders: The number of threads used to load data from file.
+        maxRetries: The number of times a failed task is retried before giving up on it.
+        timeout: The maximum number of seconds that an analysis can run for before it is treated as a failure.
+        memoryFraction: The fraction of the currently available RAM that the worker processes are allowed to use when
+            `numProcesses` is chosen automatically.
+        mpContext: The name of the multiprocessing start method to use. E.g. "spawn", "fork" or "forkserver". If
+            `None` then the platform default is used.
+        incremental: If `True` then tasks with up to date results are skipped. Stale results are replaced even if the
+            `overwrite` attribute of the task is `False`.
+
+    Examples:
+        Analyze every PWS acquisition in an experiment::
+
+            acqs = AcquisitionCatalog(experimentDirectory).getAcquisitions()
+            tasks = [BatchTask(acq.pws, 'script') for acq in acqs if acq.pws is not None]
+            results = BatchAnalysisRunner(PWSAnalysis(settings, extraReflectance, reference)).run(tasks)
+            failed = [r for r in results if not r.succeeded]
+
+        After adding new cells to the experiment only analyze the new cells and any that have changed::
+
+            runner = BatchAnalysisRunner(PWSAnalysis(settings, extraReflectance, reference), incremental=True)
+            statuses = runner.dryRun(tasks)  # Check what will be done first.
+            results = runner.run(tasks)
+
+    """
+    _cubeCopiesPerWorker = 3  # The approximate number of cube sized arrays that each worker holds. The input, the reflectance, and temporaries.
+    _pollInterval = 1  # Seconds between checks for timed out tasks.
+
+    def __init__(self, analysis: AbstractAnalysis, numProcesses: Optional[int] = None, numReaders: int = 2,
+                 maxRetries: int = 1, timeout: Optional[float] = None, memoryFraction: float = 0.7, mpContext: Optional[str] = None,
+                 incremental: bool = False):
+        self.analysis = analysis
+        self.numProcesses = numProcesses
+        self.numReaders = numReaders
+        self.maxRetries = maxRetries
+        self.timeout = timeout
+        self.memoryFraction = memoryFraction
+        self.mpContext = mpContext
+        self.incremental = incremental
+
+    def run(self, tasks: Sequence[BatchTask]) -> List[BatchResult]:
+        """Run the analysis for each task and save the results.
+
+        Args:
+            tasks: The acquisitions to analyze.
+
+        Returns:
+            A `BatchResult` for each task, in the same order as `tasks`.
+        """
+        from pwspy.utility.sharedMemory import SharedMemoryPickle  # Requires Python 3.8
+        logger = logging.getLogger(__name__)
+        tasks = list(tasks)
+        fingerprints, statuses = self._checkTasks(tasks)
+        try:
+            self.analysis.copySharedDataToSharedMemory()
+        except NotImplementedError:
+            pass
+        results: List[Optional[BatchResult]] = [None] * len(tasks)
+        attempts = [0] * len(tasks)
+        firstStart = [None] * len(tasks)
+        overwrite = [task.overwrite for task in tasks]
+        toLoad = collections.deque()  # Indices of the tasks waiting to be loaded.
+        for i, status in enumerate(statuses):
+            if self.incremental and status == TaskStatus.UpToDate:
+                results[i] = BatchResult(tasks[i], True, [], None, 0, 0., status, True)
+                continue
+            if self.incremental and status == TaskStatus.Stale:
+                logger.info(f"Results of {tasks[i].analysisName} for {tasks[i].metadata.filePath} are stale and will be replaced.")
+                overwrite[i] = True
+            toLoad.append(i)
+        if self.incremental:
+            logger.info(f"Incremental batch analysis skipping {len(tasks) - len(toLoad)} of {len(tasks)} tasks that are up to date.")
+        loaded = collections.deque()  # (index, cube) for cubes waiting to be analyzed.
+        loading, writing = {}, {}  # Futures keyed to the index of their task.
+        analyzing = {}  # Futures keyed to the index of their task, the pool that they were submitted to, and the ID of the submission.
+        analysisStart = {}  # The time that each running analysis was started by a worker, keyed by submission ID.
+        analysisInput = {}  # The cube sent to each running analysis. Discarded once the analysis finishes in case the worker never loaded it.
+        submissionIds = itertools.count()
+        numProcesses = self.numProcesses
+        pool: Optional[ProcessPoolExecutor] = None
+        ctx = mp.get_context(self.mpContext)
+        workerPids, workerStarts = ctx.Queue(), ctx.Queue()  # Shared by every pool that is created.
+        remaining = len(toLoad)
+
+        def finish(i: int, error: Optional[BaseException] = None, warns: List[warnings.AnalysisWarning] = None):
+            nonlocal remaining
+            results[i] = BatchResult(tasks[i], error is None, warns if warns is not None else [],
+                                     None if error is None else repr(error), attempts[i], time.time() - firstStart[i], statuses[i], False)
+            remaining -= 1
+            logger.info(f"Batch analysis of {tasks[i].metadata.filePath} {'succeeded' if error is None else 'failed'}. {remaining} tasks remaining.")
+
+        def retryOrFail(i: int, error: BaseException):
+            if attempts[i] <= self.maxRetries:
+                logger.warning(f"Attempt {attempts[i]} of batch analysis of {tasks[i].metadata.filePath} failed with {error!r}. Retrying.")
+                toLoad.append(i)
+            else:
+                finish(i, error)
+
+        with ThreadPoolExecutor(self.numReaders) as readers, ThreadPoolExecutor(1) as writer:
+            try:
+                while remaining > 0:
+                    # Keep enough cubes loaded that a worker never has to wait for a file to be read.
+                    while len(toLoad) > 0 and len(loading) + len(loaded) < (numProcesses or 1) + self.numReaders:
+                        i = toLoad.popleft()
+                        attempts[i] += 1
+                        if firstStart[i] is None:
+                            firstStart[i] = time.time()
+                        loading[readers.submit(tasks[i].metadata.toDataClass, None)] = i
+                    while len(loaded) > 0 and (numProcesses is None or len(analyzing) < numProcesses):
+                        i, cube = loaded.popleft()
+                        if pool is None:
+                            if numProcesses is None:
+                                numProcesses = self._getNumProcesses(cube.data.nbytes)
+                                logger.info(f"Running batch analysis with {numProcesses} processes.")
+                            pool = ProcessPoolExecutor(numProcesses, mp_context=ctx, initializer=_initWorker,
+                                                       initargs=(self.analysis, workerPids, workerStarts))
+                        analysisInput[i] = SharedMemoryPickle.dumps(cube)
+                        submissionId = next(submissionIds)
+                        analyzing[pool.submit(_analyzeCube, analysisInput[i], submissionId)] = (i, pool, submissionId)
+                        del cube  # Don't hold on to the data while it is being analyzed.
+
+                    done, _ = concurrent.futures.wait(list(loading) + list(analyzing) + list(writing),
+                                                      timeout=self._pollInterval, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for fut in done:
+                        if fut in loading:
+                            i = loading.pop(fut)
+                            if fut.exception() is not None:
+                                retryOrFail(i, fut.exception())
+                            else:
+                                loaded.append((i, fut.result()))
+                        elif fut in analyzing:
+                            i, taskPool, submissionId = analyzing.pop(fut)
+                            analysisStart.pop(submissionId, None)
+                            analysisInput.pop(i).discard()
+                            if isinstance(fut.exception(), BrokenProcessPool):
+                                # A worker crashed. We can't tell which task caused it so all running tasks count it as a failed attempt.
+                                if taskPool is pool:  # The other tasks of a pool that was already replaced may report that it broke later.
+                                    self._terminatePool(pool, workerPids)
+                                    pool = None
+                                retryOrFail(i, fut.exception())
+                            elif fut.exception() is not None:
+                                retryOrFail(i, fut.exception())
+                            else:
+                                anResults, warns = fut.result().loads()
+                                writing[writer.submit(tasks[i].metadata.saveAnalysis, anResults, tasks[i].analysisName, overwrite[i], fingerprints[i])] = (i, warns)
+                        elif fut in writing:
+                            i, warns = writing.pop(fut)
+                            finish(i, fut.exception(), warns)
+
+                    while True:
+                        try:
+                            submissionId, startTime = workerStarts.get_nowait()
+                        except queue.Empty:
+                            break
+                        if any(submissionId == sid for _, _, sid in analyzing.values()):  # Ignore tasks that have already finished.
+                            analysisStart[submissionId] = startTime
+                    if self.timeout is not None and len(analyzing) > 0:
+                        now = time.time()
+                        expired = [i for i, _, sid in analyzing.values() if sid in analysisStart and now - analysisStart[sid] > self.timeout]
+                        if len(expired) > 0:  # A running task can't be cancelled so we have to terminate the whole pool.
+                            if pool is not None:
+                                self._terminatePool(pool, workerPids)
+                                pool = None
+                            analysisStart.clear()
+                            for i, _, _ in analyzing.values():
+                                analysisInput.pop(i).discard()
+                                if i in expired:
+                                    retryOrFail(i, TimeoutError(f"Analysis exceeded the timeout of {self.timeout} seconds."))
+                                else:  # This task was interrupted through no fault of its own.
+                                    attempts[i] -= 1
+                                    toLoad.appendleft(i)
+                            analyzing.clear()
+            finally:
+                if pool is not None:
+                    pool.shutdown(wait=True)
+        return results
+
+    def dryRun(self, tasks: Sequence[BatchTask]) -> List[TaskStatus]:
+        """Check the saved results of each task without running anything. Every task that isn't up to date is logged.
+
+        Args:
+            tasks: The acquisitions to check.
+
+        Returns:
+            The status of the saved results of each task, in the same order as `tasks`. In incremental mode only the
+            tasks that aren't `TaskStatus.UpToDate` would be run.
+        """
+        logger = logging.getLogger(__name__)
+        tasks = list(tasks)
+        _, statuses = self._checkTasks(tasks)
+        for task, status in zip(tasks, statuses):
+            if status != TaskStatus.UpToDate:
+                logger.info(f"{status.name}: {task.analysisName} for {task.metadata.filePath}")
+        logger.info(f"Batch analysis dry run: {statuses.count(TaskStatus.New)} new, {statuses.count(TaskStatus.Stale)} stale, {statuses.count(TaskStatus.UpToDate)} up to date.")
+        return statuses
+
+    def _checkTasks(self, tasks: List[BatchTask]) -> Tuple[List[Optional[str]], List[TaskStatus]]:
+        """Returns the fingerprint that the results of each task will be saved with and the status of the currently
+        saved results. The fingerprints are `None` if the analysis doesn't support fingerprinting."""
+        try:
+            analysisFingerprint = self.analysis.getFingerprint()
+        except NotImplementedError:
+            analysisFingerprint = None
+            if self.incremental:
+                logging.getLogger(__name__).warning(f"{type(self.analysis).__name__} does not support fingerprinting. Incremental analysis will not skip any tasks.")
+
+        def check(task: BatchTask) -> Tuple[Optional[str], TaskStatus]:
+            if analysisFingerprint is None:
+                fingerprint = None
+            else:
+                fingerprint = hashlib.sha1(f"{analysisFingerprint} {_getAcquisitionSignature(task.metadata.filePath)} {pwspy.__version__}".encode()).hexdigest()
+            if task.analysisName not in task.metadata.getAnalyses():
+                return fingerprint, TaskStatus.New
+            try:
+                saved = task.metadata.getAnalysisFingerprint(task.analysisName)
+            except OSError:  # The file is unreadable, it will need to be replaced.
+                saved = None
+            return fingerprint, TaskStatus.UpToDate if fingerprint is not None and saved == fingerprint else TaskStatus.Stale
+
+        with ThreadPoolExecutor(self.numReaders) as pool:  # Checking thousands of acquisitions is limited by file system latency.
+            checked = list(pool.map(check, tasks))
+        return [c[0] for c in checked], [c[1] for c in checked]
+
+    def _getNumProcesses(self, cubeBytes: int) -> int:
+        """Choose the number of worker processes so that the workers fit in the available RAM, using at most one less
+        than the number of physical cores."""
+        byMemory = int(psutil.virtual_memory().available * self.memoryFraction // (self._cubeCopiesPerWorker * cubeBytes))
+        numCores = psutil.cpu_count(logical=False) or os.cpu_count() or 1  # psutil returns `None` if it can't tell.
+        byCpu = numCores - 1  # If we use all cores then things can get locked up.
+        return max(1, min(byMemory, byCpu))
+
+    @staticmethod
+    def _terminatePool(pool: ProcessPoolExecutor, workerPids: mp.Queue):
+        """`ProcessPoolExecutor` has no public way to stop a running task so we terminate the workers directly. Each
+        worker reports its process ID to `workerPids` when it starts."""
+        pool.shutdown(wait=False)
+        while True:
+            try:
+                pid = workerPids.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                p = psutil.Process(pid)
+                if p.ppid() == os.getpid():  # Make sure the ID wasn't reused by an unrelated process after the worker exited.
+                    p.terminate()
+            except psutil.NoSuchProcess:
+                pass
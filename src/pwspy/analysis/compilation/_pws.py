@@ -104,8 +104,11 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.opd:
             try:
-                opd, opdIndex = results.opd
-                opd = opd[roi.mask].mean(axis=0)
+                if 'opd' in results.__dict__:  # The OPD of the full image has already been calculated.
+                    opd, opdIndex = results.opd
+                    opd = opd[roi.mask].mean(axis=0)
+                else:  # Only read the part of the reflectance that we need.
+                    opd, opdIndex = results.getReflectance(roi).getOpd(isHannWindow=False, indexOpdStop=100, mask=roi.mask)
             except KeyError:
                 opd = opdIndex = None
         else:
@@ -113,7 +116,7 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.meanSigmaRatio:
             try:
-                spectra = results.reflectance.getMeanSpectra(roi)[0]
+                spectra = results.getReflectance(roi).getMeanSpectra(roi)[0]
                 meanRms = spectra.std()
                 varRatio = meanRms**2 / (results.rms[roi.mask] ** 2).mean()
                 warns.append(warnings.checkMeanSpectraRatio(varRatio))
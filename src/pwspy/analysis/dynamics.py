@@ -37,17 +37,20 @@ Inheritance
 
 from __future__ import annotations
 import dataclasses
+import hashlib
 import logging
 from datetime import datetime
 
+import h5py
 import numpy as np
 import pandas as pd
 from numpy import ma
-import multiprocessing as mp
 import typing
 from . import AbstractAnalysis, warnings, AbstractAnalysisSettings, AbstractHDFAnalysisResults
+from ._referenceCache import ReferenceCache
 from pwspy import dateTimeFormat
 import pwspy.dataTypes as pwsdt
+from pwspy.utility import hdfCodecs
 from pwspy.utility.reflection import reflectanceHelper, Material
 
 
@@ -61,16 +64,51 @@ class DynamicsAnalysis(AbstractAnalysis):
     Args:
         settings: The settings use for the analysis
         extraReflectance: the metadata object referring to a calibration file for extra reflectance. You can optionally proide the ExtraReflectanceCube rather than just the metadata object referring to it.
-        ref: A reference acquisition to use for normalization.
+        ref: A reference acquisition to use for normalization. If `cache` is provided then this can be the metadata of
+            the reference, in which case the data is only loaded if the prepared reference isn't found in the cache.
+        cache: If provided then the mean and autocorrelation of the reference and the extra reflection are saved to
+            this cache. Later analyses using the same reference, extra reflectance and settings will load them rather
+            than repeating the calculation.
     """
-    def __init__(self, settings: DynamicsAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube]], ref: pwsdt.DynCube):
+    _cacheSettings = ('cameraCorrection', 'referenceMaterial', 'numericalAperture', 'relativeUnits', 'diffusionRegressionLength')  # The settings that affect the preparation of the reference.
+
+    def __init__(self, settings: DynamicsAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube]],
+                 ref: typing.Union[pwsdt.DynCube, pwsdt.DynMetaData], cache: typing.Optional[ReferenceCache] = None):
         super().__init__()
+        if cache is None:
+            prepared = self._prepareReference(settings, extraReflectance, ref)
+        else:
+            erTag = None if extraReflectance is None else (extraReflectance.idTag if isinstance(extraReflectance, pwsdt.ERMetaData) else extraReflectance.metadata.idTag)
+            refTag = ref.idTag if isinstance(ref, pwsdt.DynMetaData) else ref.metadata.idTag
+            settingsDict = {k: v for k, v in settings.asDict().items() if k in self._cacheSettings}
+            if isinstance(ref, pwsdt.DynCube):  # A cube that has already been loaded may have been processed or cropped.
+                settingsDict.update(processingStatus=ref.processingStatus.toDict(), offset=ref.offset)
+            prepared = cache.get(cache.getKey(type(self).__name__, refTag, erTag, settingsDict),
+                                 create=lambda: self._prepareReference(settings, extraReflectance, ref),
+                                 save=self._savePreparedReference,
+                                 load=self._loadPreparedReference)
+        self.refMean, self.refAc, self.extraReflection, self.refTag, self.erTag = prepared
+        self.n_medium = 1.37  # The average index of refraction for chromatin?
+        self.settings = settings
+
+    @staticmethod
+    def _prepareReference(settings: DynamicsAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube]],
+                          ref: typing.Union[pwsdt.DynCube, pwsdt.DynMetaData]) -> typing.Tuple[np.ndarray, np.ndarray, typing.Optional[np.ndarray], str, typing.Optional[str]]:
+        """Correct and normalize the reference and calculate its mean and autocorrelation.
+
+        Returns:
+            A tuple containing: `refMean`: The mean of the reference over time, `refAc`: The average autocorrelation of
+                the reference, `Iextra`: The extra reflection in units of counts/ms, `refTag`: The idTag of the
+                reference, `erTag`: The idTag of the extra reflectance.
+        """
+        if isinstance(ref, pwsdt.DynMetaData):
+            ref = ref.toDataClass()
         if isinstance(extraReflectance, pwsdt.ERMetaData): # In the case the extraReflectance is an ExtraReflectanceCube or `None` no action needs to take place.
             extraReflectance = pwsdt.ExtraReflectanceCube.fromMetadata(extraReflectance)
         logger = logging.getLogger(__name__)
         if not ref.processingStatus.cameraCorrected:
-            ref.correctCameraEffects(settings.cameraCorrection)
-        if not ref.processingStatus.normalizedByExposure:
+            ref.correctCameraEffectsAndNormalizeExposure(settings.cameraCorrection)
+        elif not ref.processingStatus.normalizedByExposure:
             ref.normalizeByExposure()
         if ref.metadata.pixelSizeUm is not None:  # Only works if pixel size was saved in the metadata.
             ref.filterDust(.75)  # Apply a blur to filter out dust particles. This is in microns. I'm not sure if this is the optimal value.
@@ -92,20 +130,44 @@ class DynamicsAnalysis(AbstractAnalysis):
         if not settings.relativeUnits:
             ref = ref / theoryR[None, None, :]  # now when we normalize by our reference we will get a result in units of physical reflectance rather than arbitrary units.
 
-        self.refMean = ref.data.mean(axis=2)
-        ref.normalizeByReference(self.refMean)  # We normalize so that the average is 1. This is for scaling purposes with the AC. Seems like the AC should be scale independent though, not sure.
-        self.refAc = ref.getAutocorrelation()[:, :, :settings.diffusionRegressionLength+1].mean(axis=(0, 1))  # We find the average autocorrlation of the background to cut down on noise, presumably this is uniform accross the field of view any way, right?
-        self.refTag = ref.metadata.idTag
-        self.erTag = extraReflectance.metadata.idTag if extraReflectance is not None else None
-        self.n_medium = 1.37  # The average index of refraction for chromatin?
-        self.settings = settings
-        self.extraReflection = Iextra
+        refMean = ref.data.mean(axis=2)
+        ref.normalizeByReference(refMean)  # We normalize so that the average is 1. This is for scaling purposes with the AC. Seems like the AC should be scale independent though, not sure.
+        refAc = ref.getAutocorrelation()[:, :, :settings.diffusionRegressionLength+1].mean(axis=(0, 1))  # We find the average autocorrlation of the background to cut down on noise, presumably this is uniform accross the field of view any way, right?
+        erTag = extraReflectance.metadata.idTag if extraReflectance is not None else None
+        return refMean, refAc, Iextra, ref.metadata.idTag, erTag
+
+    @staticmethod
+    def _savePreparedReference(hf: h5py.File, prepared: typing.Tuple[np.ndarray, np.ndarray, typing.Optional[np.ndarray], str, typing.Optional[str]]):
+        """Save the output of `_prepareReference` to a `ReferenceCache` file."""
+        refMean, refAc, Iextra, refTag, erTag = prepared
+        hf.create_dataset('refMean', data=refMean)
+        hf.create_dataset('refAc', data=refAc)
+        if Iextra is not None:
+            hf.create_dataset('extraReflection', data=Iextra)
+        hf.attrs['refTag'] = np.string_(refTag)
+        if erTag is not None:
+            hf.attrs['erTag'] = np.string_(erTag)
+
+    @staticmethod
+    def _loadPreparedReference(hf: h5py.File) -> typing.Tuple[np.ndarray, np.ndarray, typing.Optional[np.ndarray], str, typing.Optional[str]]:
+        """Load a prepared reference that was saved with `_savePreparedReference`."""
+        Iextra = hf['extraReflection'][()] if 'extraReflection' in hf else None
+        erTag = hf.attrs['erTag'].decode() if 'erTag' in hf.attrs else None
+        return hf['refMean'][()], hf['refAc'][()], Iextra, hf.attrs['refTag'].decode(), erTag
+
+    def getFingerprint(self) -> str:  # Inherit docstring
+        fingerprint = hashlib.sha1(self.settings.toJsonString().encode())
+        fingerprint.update(f"{self.refTag} {self.erTag}".encode())
+        for arr in (self.refMean, self.refAc, self.extraReflection):  # Hashing the prepared reference covers all of the settings and files that went into preparing it.
+            if arr is not None:
+                fingerprint.update(np.ascontiguousarray(arr))
+        return fingerprint.hexdigest()
 
     def run(self, cube: pwsdt.DynCube) -> typing.Tuple[DynamicsAnalysisResults, typing.List[warnings.AnalysisWarning]]:  # Inherit docstring
         warns = []
         if not cube.processingStatus.cameraCorrected:
-            cube.correctCameraEffects(self.settings.cameraCorrection)
-        if not cube.processingStatus.normalizedByExposure:
+            cube.correctCameraEffectsAndNormalizeExposure(self.settings.cameraCorrection)
+        elif not cube.processingStatus.normalizedByExposure:
             cube.normalizeByExposure()
         if self.extraReflection is not None:
             cube.subtractExtraReflection(self.extraReflection)
@@ -170,21 +232,10 @@ class DynamicsAnalysis(AbstractAnalysis):
         return Slope
 
     def copySharedDataToSharedMemory(self): # Inherit docstring
-        refdata = mp.RawArray('f', self.refAc.size)
-        refdata = np.frombuffer(refdata, dtype=np.float32).reshape(self.refAc.shape)
-        np.copyto(refdata, self.refAc)
-        self.refAc = refdata
-
-        refmdata = mp.RawArray('f', self.refMean.size)
-        refmdata = np.frombuffer(refmdata, dtype=np.float32).reshape(self.refMean.shape)
-        np.copyto(refmdata, self.refMean)
-        self.refMean = refmdata
-
+        self.refAc = self._copyToSharedMemory(self.refAc)  # When this object is pickled only the names of the shared memory blocks are sent.
+        self.refMean = self._copyToSharedMemory(self.refMean)
         if self.extraReflection is not None:
-            iedata = mp.RawArray('f', self.extraReflection.size)
-            iedata = np.frombuffer(iedata, dtype=np.float32).reshape(self.extraReflection.shape)
-            np.copyto(iedata, self.extraReflection)
-            self.extraReflection = iedata
+            self.extraReflection = self._copyToSharedMemory(self.extraReflection)
 
 
 class DynamicsAnalysisResults(AbstractHDFAnalysisResults): # Inherit docstring.
@@ -219,13 +270,13 @@ class DynamicsAnalysisResults(AbstractHDFAnalysisResults): # Inherit docstring.
     def meanReflectance(self) -> np.ndarray:
         """A 2D array giving the reflectance of the image averaged over the full spectra."""
         dset = self.file['meanReflectance']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def rms_t_squared(self) -> np.ndarray:
         """A 2D array giving the spectral variance at each position in the image."""
         dset = self.file['rms_t_squared']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def settings(self) -> DynamicsAnalysisSettings:
@@ -238,11 +289,26 @@ class DynamicsAnalysisResults(AbstractHDFAnalysisResults): # Inherit docstring.
         dset = self.file['reflectance']
         return pwsdt.DynCube.fromHdfDataset(dset)
 
+    def getReflectance(self, region: typing.Optional[typing.Union[pwsdt.Roi, typing.Tuple[float, float, float, float]]] = None) -> pwsdt.DynCube:
+        """Load the `reflectance` for just a region of the image. Unlike the `reflectance` property the result is not
+        kept in memory and only the chunks of the file overlapping `region` are read. If the full `reflectance` has
+        already been loaded (or the results aren't associated with a file) then that is returned instead.
+
+        Args:
+            region: An `Roi` or a (top, left, bottom, right) bounding box, as returned by `Roi.getBoundingBox`.
+
+        Returns:
+            A DynCube of the region. Its `offset` attribute gives the position of the region in the full image.
+        """
+        if self.file is None or 'reflectance' in self.__dict__:
+            return self.reflectance
+        return pwsdt.DynCube.fromHdfDataset(self.file['reflectance'], region=region)
+
     @AbstractHDFAnalysisResults.FieldDecorator
     def diffusion(self) -> np.ndarray:
         """A 2D array indicating the diffusion at each position in the image."""
         dset = self.file['diffusion']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def imCubeIdTag(self) -> str:
@@ -27,6 +27,7 @@ Classes
     PWSAnalysisSettings
     PWSAnalysisResults
     PWSAnalysis
+    PWSAnalysisPlan
 
 
 Inheritance
@@ -37,19 +38,30 @@ Inheritance
 """
 
 from __future__ import annotations
+import copy
 import dataclasses
+import hashlib
+import json
+import logging
 import os
+import tracemalloc
 import typing
 from datetime import datetime
+import h5py
 import numpy as np
 import pandas as pd
 from scipy import signal as sps
-import multiprocessing as mp
+from scipy import interpolate as spi
+from scipy import fft as spf
+from concurrent.futures import ThreadPoolExecutor
+import psutil
 from typing import Type, Tuple, List, Optional
 from ._abstract import AbstractHDFAnalysisResults, AbstractAnalysis, AbstractAnalysisResults, AbstractAnalysisSettings
+from ._referenceCache import ReferenceCache
 from . import warnings
 import pwspy.dataTypes as pwsdt
 from pwspy import dateTimeFormat
+from pwspy.utility import hdfCodecs
 from pwspy.utility.misc import cached_property
 from pwspy.utility.reflection import reflectanceHelper, Material
 
@@ -91,22 +103,56 @@ class PWSAnalysis(AbstractAnalysis):
             ERMetaData (Recommended): The metadata object referring to a calibration file for extra reflectance. It will be processed in conjunction with the reference immage to produce an ExtraReflectionCube representing the stray reflectance in units of camera counts/ms.
             ExtraReflectanceCube: Effectively identical to supplying an ERMataData object.
             ExtraReflectionCube: An object representing the stray reflection in units of counts/ms. It is up to the user to make sure that the data is scaled appropriately to match the data being analyzed.
-        ref: The reference acquisition used for analysis.
+        ref: The reference acquisition used for analysis. If `cache` is provided then this can be the metadata of the
+            reference, in which case the data is only loaded if the prepared reference isn't found in the cache.
+        cache: If provided then the reference, after it has been corrected and normalized, is saved to this cache. Later
+            analyses using the same reference, extra reflectance and settings will load it rather than repeating the
+            preparation. Not used if `extraReflectance` is an `ExtraReflectionCube`, since its contents can't be identified.
     """
-    def __init__(self, settings: PWSAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube, pwsdt.ExtraReflectionCube]], ref: pwsdt.ImCube):
-        from pwspy.dataTypes import ExtraReflectanceCube
+    _cacheSettings = ('cameraCorrection', 'referenceMaterial', 'numericalAperture', 'relativeUnits')  # The settings that affect the preparation of the reference.
+
+    def __init__(self, settings: PWSAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube, pwsdt.ExtraReflectionCube]],
+                 ref: typing.Union[pwsdt.ImCube, pwsdt.ICMetaData], cache: typing.Optional[ReferenceCache] = None):
         super().__init__()
-        self._initWarnings = []
         self.settings = settings
+        if cache is None or isinstance(extraReflectance, pwsdt.ExtraReflectionCube):
+            self.ref, self.extraReflection, self._initWarnings = self._prepareReference(settings, extraReflectance, ref)
+        else:
+            erTag = None if extraReflectance is None else (extraReflectance.idTag if isinstance(extraReflectance, pwsdt.ERMetaData) else extraReflectance.metadata.idTag)
+            refTag = ref.idTag if isinstance(ref, pwsdt.ICMetaData) else ref.metadata.idTag
+            settingsDict = {k: v for k, v in settings.asDict().items() if k in self._cacheSettings}
+            if isinstance(ref, pwsdt.ImCube):  # A cube that has already been loaded may have been processed or cropped.
+                settingsDict.update(processingStatus=ref.processingStatus.toDict(), offset=ref.offset)
+            self.ref, self.extraReflection, self._initWarnings = cache.get(
+                cache.getKey(type(self).__name__, refTag, erTag, settingsDict),
+                create=lambda: self._prepareReference(settings, extraReflectance, ref),
+                save=self._savePreparedReference,
+                load=self._loadPreparedReference)
+        self._plans: typing.Dict[typing.Tuple[float, ...], PWSAnalysisPlan] = {}
+        self.peakMemory: typing.Optional[int] = None  # The peak memory in bytes measured during the last `run` with a `memoryBudget`.
+        self.getPlan(self.ref.wavelengths)  # Build the plan up front, every cube analyzed should share the wavelengths of the reference.
+
+    @staticmethod
+    def _prepareReference(settings: PWSAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube, pwsdt.ExtraReflectionCube]],
+                          ref: typing.Union[pwsdt.ImCube, pwsdt.ICMetaData]) -> Tuple[pwsdt.ImCube, typing.Optional[pwsdt.ExtraReflectionCube], List[warnings.AnalysisWarning]]:
+        """Correct and normalize the reference and generate the extra reflection that is subtracted from each cube.
+
+        Returns:
+            A tuple containing: `ref`: The prepared reference, `Iextra`: The extra reflection in units of counts/ms, `initWarnings`: Warnings to be included with the results of every analysis.
+        """
+        from pwspy.dataTypes import ExtraReflectanceCube
+        initWarnings = []
+        if isinstance(ref, pwsdt.ICMetaData):
+            ref = ref.toDataClass()
         if not ref.processingStatus.cameraCorrected:
-            ref.correctCameraEffects(settings.cameraCorrection)
-        if not ref.processingStatus.normalizedByExposure:
+            ref.correctCameraEffectsAndNormalizeExposure(settings.cameraCorrection)
+        elif not ref.processingStatus.normalizedByExposure:
             ref.normalizeByExposure()
         if ref.metadata.pixelSizeUm is not None: #Only works if pixel size was saved in the metadata.
             ref.filterDust(.75)  # Apply a blur to filter out dust particles. This is in microns. I'm not sure if this is the optimal value.
         if settings.referenceMaterial is None:
             theoryR = pd.Series(np.ones((len(ref.wavelengths),)), index=ref.wavelengths) # Having this as all ones effectively ignores it.
-            self._initWarnings.append(warnings.AnalysisWarning("Ignoring reference material", "Analysis ignoring reference material correction. Extra Reflection subtraction can not be performed."))
+            initWarnings.append(warnings.AnalysisWarning("Ignoring reference material", "Analysis ignoring reference material correction. Extra Reflection subtraction can not be performed."))
             assert extraReflectance is None, "Extra reflectance calibration relies on being provided with the theoretical reflectance of our reference."
         else:
             theoryR = reflectanceHelper.getReflectance(settings.referenceMaterial, Material.Glass, wavelengths=ref.wavelengths, NA=settings.numericalAperture)
@@ -114,102 +160,231 @@ class PWSAnalysis(AbstractAnalysis):
         #Handle the extra reflection cube.
         if extraReflectance is None:
             Iextra = None
-            self._initWarnings.append(warnings.AnalysisWarning("Ignoring extra reflection correction.", "That's all"))
+            initWarnings.append(warnings.AnalysisWarning("Ignoring extra reflection correction.", "That's all"))
         elif isinstance(extraReflectance, pwsdt.ERMetaData):  # Load an extraReflectanceCube and use it in conjunction with the reference to generate an extraReflectionCube
             extraReflectance = ExtraReflectanceCube.fromMetadata(extraReflectance)
         if isinstance(extraReflectance, pwsdt.ExtraReflectanceCube):  # This case will be handled if the argument was supplied as an ExtraReflectance cube or if it was supplied as ERMetaData
             if extraReflectance.metadata.numericalAperture != settings.numericalAperture:
-                self._initWarnings.append(warnings.AnalysisWarning("NA mismatch!", f"The numerical aperture of your analysis does not match the NA of the Extra Reflectance Calibration. Calibration File NA: {extraReflectance.metadata.numericalAperture}. PWSAnalysis NA: {settings.numericalAperture}."))
+                initWarnings.append(warnings.AnalysisWarning("NA mismatch!", f"The numerical aperture of your analysis does not match the NA of the Extra Reflectance Calibration. Calibration File NA: {extraReflectance.metadata.numericalAperture}. PWSAnalysis NA: {settings.numericalAperture}."))
             Iextra = pwsdt.ExtraReflectionCube.create(extraReflectance, theoryR, ref) #Convert from reflectance to predicted counts/ms for the internal reflections of the system.
         elif isinstance(extraReflectance, pwsdt.ExtraReflectionCube): # An extraReflectionCube (counts/ms rather than a reflectance percentage) has been directly provided by the user. No need to generate one from the reference.
             Iextra = extraReflectance
-        else:
+        elif extraReflectance is not None:
             raise TypeError(f"`extraReflectance` of type: {type(extraReflectance)} is not supported.")
         if Iextra is not None:
             ref.subtractExtraReflection(Iextra)  # remove the extra reflection from our reference data
 
         if not settings.relativeUnits:
             ref = ref / theoryR[None, None, :]  # now when we normalize by our reference we will get a result in units of physical reflectance rather than arbitrary units.
-        self.ref = ref
-        self.extraReflection = Iextra
+        return ref, Iextra, initWarnings
+
+    @staticmethod
+    def _savePreparedReference(hf: h5py.File, prepared: Tuple[pwsdt.ImCube, typing.Optional[pwsdt.ExtraReflectionCube], List[warnings.AnalysisWarning]]):
+        """Save the output of `_prepareReference` to a `ReferenceCache` file. Fixed point compression is not used so that the loaded reference is identical."""
+        ref, Iextra, initWarnings = prepared
+        ref.toHdfDataset(hf, 'reference', fixedPointCompression=False)
+        hf['reference'].attrs['offset'] = ref.offset
+        if Iextra is not None:
+            Iextra.toHdfDataset(hf, pwsdt.ERMetaData.DATASETTAG, fixedPointCompression=False)
+            Iextra.metadata.toHdfDataset(hf)
+            hf[pwsdt.ERMetaData.DATASETTAG].attrs['offset'] = Iextra.offset
+        hf.attrs['initWarnings'] = np.string_(json.dumps([(w.shortMsg, w.longMsg) for w in initWarnings]))
 
-    def run(self, cube: pwsdt.ImCube) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:  # Inherit docstring
+    @staticmethod
+    def _loadPreparedReference(hf: h5py.File) -> Tuple[pwsdt.ImCube, typing.Optional[pwsdt.ExtraReflectionCube], List[warnings.AnalysisWarning]]:
+        """Load a prepared reference that was saved with `_savePreparedReference`."""
+        ref = pwsdt.ImCube.fromHdfDataset(hf['reference'])
+        ref.offset = tuple(hf['reference'].attrs['offset'])
+        if pwsdt.ERMetaData.DATASETTAG in hf:
+            dset = hf[pwsdt.ERMetaData.DATASETTAG]
+            data, wavelengths = pwsdt.ExtraReflectionCube.decodeHdf(dset)
+            Iextra = pwsdt.ExtraReflectionCube(data, wavelengths, pwsdt.ERMetaData.fromHdfDataset(dset))
+            Iextra.offset = tuple(dset.attrs['offset'])
+        else:
+            Iextra = None
+        initWarnings = [warnings.AnalysisWarning(shortMsg, longMsg) for shortMsg, longMsg in json.loads(hf.attrs['initWarnings'])]
+        return ref, Iextra, initWarnings
+
+    def getFingerprint(self) -> str:  # Inherit docstring
+        fingerprint = hashlib.sha1(self.settings.toJsonString().encode())
+        fingerprint.update(self.ref.metadata.idTag.encode())
+        fingerprint.update(np.ascontiguousarray(self.ref.data))  # Hashing the prepared reference covers all of the settings and files that went into preparing it.
+        if self.extraReflection is not None:
+            fingerprint.update(self.extraReflection.metadata.idTag.encode())
+            fingerprint.update(np.ascontiguousarray(self.extraReflection.data))
+        return fingerprint.hexdigest()
+
+    def getPlan(self, wavelengths: typing.Sequence[float]) -> PWSAnalysisPlan:
+        """Get the `PWSAnalysisPlan` for data with the given wavelengths. Plans are built on first use and then cached for
+        the lifetime of this object.
+
+        Args:
+            wavelengths: The wavelengths of the data to be analyzed.
+        Returns:
+            The plan containing the precomputed operators for this analysis.
+        """
+        wavelengths = tuple(wavelengths)
+        if wavelengths not in self._plans:
+            self._plans[wavelengths] = PWSAnalysisPlan(wavelengths, self.settings)
+        return self._plans[wavelengths]
+
+    def run(self, cube: pwsdt.ImCube, tileSize: typing.Optional[int] = None, numThreads: typing.Optional[int] = None,
+            memoryBudget: typing.Optional[int] = None) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:
+        """Given an data cube to analyze this function returns an instance of PWSAnalysisResults.
+
+        Args:
+            cube: The data cube to be analyzed.
+            tileSize: If provided then the image is split into square spatial blocks with sides of this many pixels.
+                The full per-pixel analysis is then performed on each block in a thread pool, writing into preallocated
+                outputs. This avoids creating many full size temporary arrays. The results do not depend on the block
+                size since the plan always processes pixels in row blocks of a fixed size, see `PWSAnalysisPlan`. In this mode `cube` is not modified by the extra reflection subtraction and reference normalization.
+            numThreads: The number of threads used to process blocks when `tileSize` is provided. Defaults to the number
+                of physical cores.
+            memoryBudget: If provided then the analysis is run in tiled mode with a block size chosen so that the
+                memory allocated by the analysis fits within this many bytes, see `PWSAnalysisPlan.getTileSize`. The
+                data is kept as float32 throughout. The full frame outputs, including the k-space reflectance cube and
+                the autocorrelation, are preallocated and count towards the budget, the input data does not. The
+                measured peak memory allocated during the analysis is logged and saved to the `peakMemory` attribute
+                of this object.
+        Returns:
+            A tuple containing: `results`: The analysis results, `warnings`: A list of warnings generated by the analysis.
+        """
+        if memoryBudget is None:
+            return self._run(cube, tileSize, numThreads)
+        if numThreads is None:
+            numThreads = psutil.cpu_count(logical=False)
+        if tileSize is None:
+            tileSize = self.getPlan(cube.wavelengths).getTileSize(memoryBudget, numThreads, cube.data.shape[:2])
+        with _PeakMemoryMonitor() as monitor:
+            ret = self._run(cube, tileSize, numThreads)
+        self.peakMemory = monitor.peak
+        logging.getLogger(__name__).info(f"PWSAnalysis of {cube.metadata.idTag} peaked at {monitor.peak / 1e6:.1f} MB of allocated memory. Tile size: {tileSize}, Threads: {numThreads}, Budget: {memoryBudget / 1e6:.1f} MB")
+        return ret
+
+    def _run(self, cube: pwsdt.ImCube, tileSize: typing.Optional[int], numThreads: typing.Optional[int]) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:
         if not cube.processingStatus.cameraCorrected:
-            cube.correctCameraEffects(self.settings.cameraCorrection)
-        if not cube.processingStatus.normalizedByExposure:
+            cube.correctCameraEffectsAndNormalizeExposure(self.settings.cameraCorrection)
+        elif not cube.processingStatus.normalizedByExposure:
             cube.normalizeByExposure()
         warns = self._initWarnings
-        cube = self._normalizeImCube(cube)
-        interval = (max(cube.wavelengths) - min(cube.wavelengths)) / (len(cube.wavelengths) - 1)  # Wavelength interval. We are assuming equally spaced wavelengths here
-        cube.data = self._filterSignal(cube.data, 1/interval)
-        # The rest of the analysis will be performed only on the selected wavelength range.
-        cube = cube.selIndex(self.settings.wavelengthStart, self.settings.wavelengthStop)
-        # Determine the mean-reflectance for each pixel in the cell.
-        reflectance = cube.data.mean(axis=2)
-        cube = pwsdt.KCube.fromImCube(cube)  # -- Convert to K-Space
-        cubePoly = self._fitPolynomial(cube)
-        # Remove the polynomial fit from filtered cubeCell.
-        cube.data = cube.data - cubePoly
-
-        # -- RMS
-        # Obtain the RMS of each signal in the cube.
-        rms = cube.data.std(axis=2)
-        if not self.settings.skipAdvanced:
-            # RMS - POLYFIT
-            # The RMS should be calculated on the mean-subtracted polyfit. This may
-            # also be accomplished by calculating the standard-deviation. This is a pointless metric IMO.
-            rmsPoly = cubePoly.std(axis=2)
-
-            slope, rSquared = cube.getAutoCorrelation(self.settings.autoCorrMinSub, self.settings.autoCorrStopIndex)
-            ld = self._calculateLd(rms, slope)
+        plan = self.getPlan(cube.wavelengths)
+        imShape = cube.data.shape[:2]
+        if tileSize is None:
+            cube = self._normalizeImCube(cube)
+            data = cube.data.reshape((imShape[0] * imShape[1], cube.data.shape[2]))  # Flatten the array to 2d (pixels x wavelength)
+            # Determine the mean-reflectance for each pixel in the cell.
+            reflectance = plan.getMeanReflectance(data).reshape(imShape)
+            # Filter, select the wavelength range, convert to K-Space and remove the polynomial fit, all in a single step.
+            kData = plan.getResidual(data)
+
+            # -- RMS
+            # Obtain the RMS of each signal in the cube.
+            rms = kData.std(axis=1).reshape(imShape)
+            if not self.settings.skipAdvanced:
+                # RMS - POLYFIT
+                # The RMS should be calculated on the mean-subtracted polyfit. This may
+                # also be accomplished by calculating the standard-deviation. This is a pointless metric IMO.
+                rmsPoly = plan.getPolynomial(data).std(axis=1).reshape(imShape)
+                slope, rSquared = plan.getAutoCorrelation(kData)
+                slope, rSquared = slope.reshape(imShape), rSquared.reshape(imShape)
+            else:
+                rmsPoly = slope = rSquared = None
+            kData = kData.reshape(imShape + (len(plan.wavenumbers),))
         else:
-            rmsPoly = slope = rSquared = ld = None
+            reflectance, kData, rms, rmsPoly, slope, rSquared = self._runTiled(cube, plan, tileSize, numThreads)
+        ld = self._calculateLd(rms, slope) if not self.settings.skipAdvanced else None
+
+        md = copy.deepcopy(cube.metadata)  # The KCube metadata should reflect the selected wavelength range, the same as `ImCube.selIndex` does.
+        md.dict['wavelengths'] = plan.selectedWavelengths
+        kCube = pwsdt.KCube(kData, plan.wavenumbers, metadata=md)
 
         results = PWSAnalysisResults.create(
             meanReflectance=reflectance,
-            reflectance=cube,
+            reflectance=kCube,
             rms=rms,
             polynomialRms=rmsPoly,
             autoCorrelationSlope=slope,
             rSquared=rSquared,
             ld=ld,
             settings=self.settings,
-            imCubeIdTag=cube.metadata.idTag,
+            imCubeIdTag=kCube.metadata.idTag,
             referenceIdTag=self.ref.metadata.idTag,
             extraReflectionTag=self.extraReflection.metadata.idTag if self.extraReflection is not None else None)
         warns = [warn for warn in warns if warn is not None]  # Filter out null values.
         return results, warns
 
+    def _runTiled(self, cube: pwsdt.ImCube, plan: PWSAnalysisPlan, tileSize: int, numThreads: typing.Optional[int]) -> Tuple[np.ndarray, ...]:
+        """Perform the analysis one spatial block at a time in a pool of threads. Every step is independent for each
+        pixel except the minimum subtraction of the autocorrelation which uses the minimum of the whole image. For this
+        reason the autocorrelation fit is done in a second pass after the global minimum is known.
+
+        Returns:
+            A tuple of the meanReflectance, the 3D reflectance data in k-space, rms, polynomialRms, autoCorrelationSlope,
+            and rSquared arrays. The last three are `None` if `skipAdvanced` is set.
+        """
+        if numThreads is None:
+            numThreads = psutil.cpu_count(logical=False)
+        refData = cube._cropToRegion(self.ref.data, self.ref.offset)  # The cube may have been loaded from just a region of the frame.
+        erData = cube._cropToRegion(self.extraReflection.data, self.extraReflection.offset) if self.extraReflection is not None else None
+        if cube.data.shape != refData.shape:
+            raise ValueError(f"The shape of the data {cube.data.shape} does not match the reference {refData.shape}.")
+        if cube.processingStatus.extraReflectionSubtracted or cube.processingStatus.normalizedByReference:
+            raise Exception("The ImCube has already been normalized. Tiled analysis expects data that has only been corrected for camera effects and exposure.")
+        imShape = cube.data.shape[:2]
+        numK = len(plan.wavenumbers)
+        skipAdvanced = self.settings.skipAdvanced
+        # Preallocate the outputs. Each block writes to its own region of these arrays.
+        reflectance = np.empty(imShape, dtype=np.float32)
+        kData = np.empty(imShape + (numK,), dtype=np.float32)
+        rms = np.empty(imShape, dtype=np.float32)
+        if skipAdvanced:
+            rmsPoly = slope = rSquared = autocorr = None
+        else:
+            rmsPoly = np.empty(imShape, dtype=np.float32)
+            slope = np.empty(imShape, dtype=np.float32)
+            rSquared = np.empty(imShape, dtype=np.float32)
+            autocorr = np.empty(imShape + (len(plan._lagsSquared),), dtype=np.float32)
+        tiles = [(slice(y, y + tileSize), slice(x, x + tileSize)) for y in range(0, imShape[0], tileSize) for x in range(0, imShape[1], tileSize)]
+
+        def processTile(tile: Tuple[slice, slice]) -> typing.Optional[float]:
+            if erData is not None:
+                block = cube.data[tile] - erData[tile]
+                block /= refData[tile]
+            else:
+                block = cube.data[tile] / refData[tile]
+            shape = block.shape[:2]
+            block = block.reshape((shape[0] * shape[1], block.shape[2]))
+            reflectance[tile] = plan.getMeanReflectance(block).reshape(shape)
+            k = plan.getResidual(block)
+            kData[tile] = k.reshape(shape + (numK,))
+            rms[tile] = k.std(axis=1).reshape(shape)
+            if skipAdvanced:
+                return None
+            rmsPoly[tile] = plan.getPolynomial(block).std(axis=1).reshape(shape)
+            ac, acMin = plan.getTruncatedAutoCorrelation(k, dtype=np.float32)
+            autocorr[tile] = ac.reshape(shape + (ac.shape[1],))
+            return acMin
+
+        def fitTile(tile: Tuple[slice, slice], minimum: float):
+            ac = autocorr[tile]
+            shape = ac.shape[:2]
+            s, r = plan.fitAutoCorrelation(ac.reshape((shape[0] * shape[1], ac.shape[2])), minimum)
+            slope[tile] = s.reshape(shape)
+            rSquared[tile] = r.reshape(shape)
+
+        with ThreadPoolExecutor(max_workers=numThreads) as pool:
+            minimums = list(pool.map(processTile, tiles))  # `list` makes sure that any exceptions are raised here.
+            if not skipAdvanced:
+                minimum = min(minimums)
+                list(pool.map(lambda tile: fitTile(tile, minimum), tiles))
+        return reflectance, kData, rms, rmsPoly, slope, rSquared
+
     def _normalizeImCube(self, cube: pwsdt.ImCube) -> pwsdt.ImCube:
         if self.extraReflection is not None:
             cube.subtractExtraReflection(self.extraReflection)
         cube.normalizeByReference(self.ref)
         return cube
 
-    def _filterSignal(self, data: np.ndarray, sampleFreq: float):
-        if self.settings.filterCutoff is None:  # Skip filtering.
-            return data
-        else:
-            b, a = sps.butter(self.settings.filterOrder, self.settings.filterCutoff, fs=sampleFreq)  # Generate the filter coefficients
-            return sps.filtfilt(b, a, data, axis=2).astype(data.dtype)  # Actually do the filtering on the data.
-
-    # -- Polynomial Fit
-    def _fitPolynomial(self, cube: pwsdt.KCube):
-        order = self.settings.polynomialOrder
-        flattenedData = cube.data.reshape((cube.data.shape[0] * cube.data.shape[1], cube.data.shape[2]))
-        # Flatten the array to 2d and put the wavenumber axis first.
-        flattenedData = np.rollaxis(flattenedData, 1)
-        # make an empty array to hold the fit values.
-        cubePoly = np.zeros(flattenedData.shape, dtype=cube.data.dtype)
-        # At this point polydata goes from holding the cube data to holding the polynomial values for each pixel. still 2d.
-        polydata = np.polyfit(cube.wavenumbers, flattenedData, order)
-        for i in range(order + 1):
-            # Populate cubePoly with the fit values.
-            cubePoly += (np.array(cube.wavenumbers)[:, np.newaxis] ** i) * polydata[order - i, :]
-        cubePoly = np.moveaxis(cubePoly, 0, 1)
-        cubePoly = cubePoly.reshape(cube.data.shape)  # reshape back to a cube.
-        return cubePoly
-
     # Ld Calculation
     @staticmethod
     def _calculateLd(rms: np.ndarray, slope: np.ndarray):
@@ -222,16 +397,232 @@ class PWSAnalysis(AbstractAnalysis):
         return ld
 
     def copySharedDataToSharedMemory(self):  # Inherit docstring
-        refdata = mp.RawArray('f', self.ref.data.size)  # Create an empty ctypes array of shared memory
-        refdata = np.frombuffer(refdata, dtype=np.float32).reshape(self.ref.data.shape)  # Wrap the shared memory array in a numpy array and reshape back to origianl shape
-        np.copyto(refdata, self.ref.data)  # Copy our ImCubes data to the shared memory array.
-        self.ref.data = refdata # Reassign the shared memory array to our ImCube object data attribute.
-
+        self.ref.data = self._copyToSharedMemory(self.ref.data)  # Copy our ImCube's data to a named block of shared memory. When this object is pickled only the name of the block is sent.
         if self.extraReflection is not None:
-            iedata = mp.RawArray('f', self.extraReflection.data.size)
-            iedata = np.frombuffer(iedata, dtype=np.float32).reshape(self.extraReflection.data.shape)
-            np.copyto(iedata, self.extraReflection.data)
-            self.extraReflection.data = iedata
+            self.extraReflection.data = self._copyToSharedMemory(self.extraReflection.data)
+
+
+class _PeakMemoryMonitor:
+    """A context manager that uses `tracemalloc` to measure the peak amount of memory allocated (numpy arrays included)
+    while it is active. The result in bytes is saved to the `peak` attribute."""
+    def __init__(self):
+        self.peak: typing.Optional[int] = None
+        self._wasTracing = False
+        self._start = 0
+
+    def __enter__(self) -> _PeakMemoryMonitor:
+        self._wasTracing = tracemalloc.is_tracing()
+        if not self._wasTracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):  # Python >= 3.9. On older versions the peak may predate this monitor.
+            tracemalloc.reset_peak()
+        self._start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.peak = tracemalloc.get_traced_memory()[1] - self._start
+        if not self._wasTracing:
+            tracemalloc.stop()
+
+
+class PWSAnalysisPlan:
+    """The spectral processing of `PWSAnalysis` only depends on the wavelengths of the data and the analysis settings. This
+    class precomputes everything that can be determined from those two things so that it can be reused for every cube
+    with the same wavelengths. The lowpass filter, the wavelength selection, the interpolation to evenly spaced wavenumbers
+    and the polynomial subtraction are all linear so they are combined into a single matrix which can be applied to the
+    flattened (pixels x wavelengths) data with one matrix multiplication. The linear regression operator used to fit the
+    autocorrelation function is also precomputed.
+
+    BLAS libraries may change the order of operations of a matrix product depending on the number of rows, so the
+    operators and FFTs are always applied to blocks of exactly `blockRows` pixels, padding the last block. The result for
+    each pixel is the same no matter how the data is split up, e.g. by the `tileSize` of `PWSAnalysis.run`.
+
+    Args:
+        wavelengths: The wavelengths of the data that will be processed with this plan.
+        settings: The settings for the analysis.
+    """
+    blockRows: int = 256  # The number of pixels that operators are applied to at a time.
+
+    def __init__(self, wavelengths: typing.Sequence[float], settings: PWSAnalysisSettings):
+        self.wavelengths = tuple(wavelengths)
+        self.settings = settings
+        wv = np.array(self.wavelengths, dtype=np.float64)
+        identity = np.eye(len(wv))
+
+        # Lowpass filter. `filtfilt` is linear so applying it to the identity matrix gives us its matrix representation.
+        if settings.filterCutoff is None:
+            filt = identity
+        else:
+            interval = (wv.max() - wv.min()) / (len(wv) - 1)  # Wavelength interval. We are assuming equally spaced wavelengths here
+            b, a = sps.butter(settings.filterOrder, settings.filterCutoff, fs=1/interval)  # Generate the filter coefficients
+            filt = sps.filtfilt(b, a, identity, axis=0)
+
+        # The rest of the analysis will be performed only on the selected wavelength range.
+        slc = pwsdt.ICBase._getIndexSlice(self.wavelengths, settings.wavelengthStart, settings.wavelengthStop)
+        self.selectedWavelengths: typing.Tuple[float, ...] = self.wavelengths[slc]
+        selected = filt[slc, :]
+
+        # Convert to wavenumber and reverse the order so we are ascending in order. Units of radian/micron. Then linearly
+        # interpolate to evenly spaced wavenumbers. This matches `KCube.fromImCube`.
+        wavenumbers = (2 * np.pi) / (np.array(self.selectedWavelengths, dtype=np.float64) * 1e-3)[::-1]
+        evenWavenumbers = np.linspace(wavenumbers[0], wavenumbers[-1], num=len(wavenumbers), dtype=np.float64)
+        interp = spi.interp1d(wavenumbers, np.eye(len(wavenumbers))[::-1], kind='linear', axis=0)(evenWavenumbers)
+        self.wavenumbers: typing.Tuple[float, ...] = tuple(evenWavenumbers.astype(np.float32))
+        toK = interp @ selected
+
+        # Least squares polynomial fit. `V @ pinv(V)` projects each spectrum onto the space of polynomials of this order.
+        V = np.vander(np.array(self.wavenumbers, dtype=np.float64), settings.polynomialOrder + 1)
+        polyProjection = V @ np.linalg.pinv(V)
+
+        # Transposed so that they can be right-multiplied against the flattened (pixels x wavelengths) data.
+        self._meanOperator = selected.mean(axis=0).astype(np.float32)
+        self._residualOperator = ((np.eye(len(self.wavenumbers)) - polyProjection) @ toK).T.astype(np.float32)
+        self._polynomialOperator = (polyProjection @ toK).T.astype(np.float32)
+
+        # Autocorrelation. See `KCube.getAutoCorrelation` for an explanation of these steps.
+        self._fftSize = int(2 ** (np.ceil(np.log2((2 * len(self.wavenumbers)) - 1))))
+        lagsSquared = (np.array(self.wavenumbers) - min(self.wavenumbers)) ** 2
+        self._lagsSquared = lagsSquared[:settings.autoCorrStopIndex]
+        V = np.stack([np.ones(self._lagsSquared.shape), self._lagsSquared]).T
+        self._acfRegressionOperator = (V @ np.linalg.pinv(V)).T
+
+    def getTileSize(self, memoryBudget: int, numThreads: int, imShape: Tuple[int, int]) -> int:
+        """
+        Args:
+            memoryBudget: The number of bytes available for the outputs and temporary arrays of the analysis.
+            numThreads: The number of blocks that will be processed simultaneously.
+            imShape: The (rows, columns) shape of the image. The full frame outputs of this size are allocated before
+                any blocks are processed.
+        Returns:
+            The side length in pixels of the largest square block that can be processed by `numThreads` threads at once
+            without exceeding `memoryBudget`.
+        Raises:
+            ValueError: If the full frame outputs alone don't fit in `memoryBudget`.
+        """
+        numWv = len(self.wavelengths)
+        numK = len(self.wavenumbers)
+        # The float32 outputs of `PWSAnalysis._runTiled`: reflectance, rms and the k-space data. Unless advanced
+        # analysis is skipped there is also the polynomial rms, slope, r squared and the autocorrelation.
+        outputBytesPerPixel = 4 * (2 + numK)
+        if not self.settings.skipAdvanced:
+            outputBytesPerPixel += 4 * (3 + len(self._lagsSquared))
+        outputBytes = outputBytesPerPixel * imShape[0] * imShape[1]
+        if outputBytes >= memoryBudget:
+            raise ValueError(f"The outputs of the analysis require {outputBytes / 1e6:.1f} MB which doesn't fit in the memory budget of {memoryBudget / 1e6:.1f} MB.")
+        memoryBudget -= outputBytes
+        # Normalized block, k-space data, polynomial and the temporaries of `std` in float32.
+        bytesPerPixel = 4 * (numWv + 4 * numK)
+        # The autocorrelation is calculated `blockRows` pixels at a time so its FFTs (complex64/float32) don't grow with the block.
+        bytesPerThread = self.blockRows * (4 * numK + 12 * (self._fftSize // 2 + 1) + 4 * self._fftSize)
+        available = max(memoryBudget / numThreads - bytesPerThread, bytesPerPixel)
+        return max(1, int(np.sqrt(available / bytesPerPixel)))
+
+    def getMeanReflectance(self, data: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            data: A 2D array of the normalized data, (pixels x wavelengths).
+        Returns:
+            A 1D array of the mean of each filtered spectrum over the selected wavelength range.
+        """
+        return self._applyOperator(data, self._meanOperator)
+
+    def getResidual(self, data: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            data: A 2D array of the normalized data, (pixels x wavelengths).
+        Returns:
+            A 2D array (pixels x wavenumbers) of the filtered data in evenly spaced wavenumbers with the polynomial fit
+            subtracted.
+        """
+        return self._applyOperator(data, self._residualOperator)
+
+    def getPolynomial(self, data: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            data: A 2D array of the normalized data, (pixels x wavelengths).
+        Returns:
+            A 2D array (pixels x wavenumbers) of the polynomial fit to each spectrum in k-space.
+        """
+        return self._applyOperator(data, self._polynomialOperator)
+
+    def _iterRowBlocks(self, data: np.ndarray) -> typing.Iterator[Tuple[int, int, np.ndarray]]:
+        """Yields the index of the first row, the number of rows, and a copy of each block of `blockRows` rows of `data`.
+        The copy of the last block is padded with zeros. The same buffer is reused for every block."""
+        buffer = np.zeros((self.blockRows,) + data.shape[1:], dtype=data.dtype)
+        for start in range(0, data.shape[0], self.blockRows):
+            block = data[start:start + self.blockRows]
+            count = block.shape[0]
+            buffer[:count] = block
+            buffer[count:] = 0
+            yield start, count, buffer
+
+    def _applyOperator(self, data: np.ndarray, operator: np.ndarray) -> np.ndarray:
+        """Returns `data @ operator`, calculated one block of `blockRows` rows at a time."""
+        out = np.empty((data.shape[0],) + operator.shape[1:], dtype=np.result_type(data, operator))
+        for start, count, block in self._iterRowBlocks(data):
+            out[start:start + count] = (block @ operator)[:count]
+        return out
+
+    def getAutoCorrelation(self, kData: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Equivalent to `KCube.getAutoCorrelation` but using the precomputed regression operator.
+
+        Args:
+            kData: A 2D array (pixels x wavenumbers) as returned by `getResidual`.
+        Returns:
+            A tuple containing: `slope`: A 1D array of the slope of the log of the ACF vs. squared lag for each pixel,
+            `rSquared`: A 1D array of the coefficient of determination of each linear fit.
+        """
+        cubeAutocorr, minimum = self.getTruncatedAutoCorrelation(kData)
+        slope, rSquared = self.fitAutoCorrelation(cubeAutocorr, minimum)
+        return slope.astype(kData.dtype), rSquared.astype(kData.dtype)
+
+    def getTruncatedAutoCorrelation(self, kData: np.ndarray, dtype: np.dtype = np.float64) -> Tuple[np.ndarray, float]:
+        """The first half of `getAutoCorrelation`. The minimum subtraction (if enabled) uses the minimum of the whole data
+        set so it is split out here, this allows the data to be processed in blocks.
+
+        Args:
+            kData: A 2D array (pixels x wavenumbers) as returned by `getResidual`.
+            dtype: The floating point type that the ACF is calculated in. With float32 the FFTs are done in complex64.
+        Returns:
+            A tuple containing: `autocorr`: A 2D array of the normalized ACF of each spectrum truncated to the lags used for
+            the regression, `minimum`: The minimum value of the full normalized ACF.
+        """
+        numLags = len(self._lagsSquared)
+        out = np.empty((kData.shape[0], numLags), dtype=dtype)
+        minimum = np.inf
+        for start, count, block in self._iterRowBlocks(kData):
+            block = block.astype(dtype, copy=False)  # `scipy.fft`, unlike `numpy.fft`, keeps single precision data in single precision.
+            cubeAutocorr = spf.irfft(np.abs(spf.rfft(block, n=self._fftSize, axis=1)) ** 2, axis=1)  # This is the autocovariance.
+            cubeAutocorr = cubeAutocorr[:count, :kData.shape[1]]  # Drop the padding.
+            cubeAutocorr /= cubeAutocorr[:, 0, np.newaxis]  # Normalize so that the zero-lag value is 1.
+            out[start:start + count] = cubeAutocorr[:, :numLags]
+            minimum = min(minimum, cubeAutocorr.min())
+        return out, minimum
+
+    def fitAutoCorrelation(self, cubeAutocorr: np.ndarray, minimum: float) -> Tuple[np.ndarray, np.ndarray]:
+        """The second half of `getAutoCorrelation`. Fits a line to the log of the ACF vs. the squared lags.
+
+        Args:
+            cubeAutocorr: The truncated ACF returned by `getTruncatedAutoCorrelation`. Modified in place.
+            minimum: The minimum of the full ACF of the whole data set. Only used if `autoCorrMinSub` is enabled.
+        Returns:
+            A tuple containing: `slope`: A 1D array of the slope of the log of the ACF vs. squared lag for each pixel,
+            `rSquared`: A 1D array of the coefficient of determination of each linear fit.
+        """
+        if self.settings.autoCorrMinSub:
+            cubeAutocorr -= minimum
+        tiny = 1e-323 if cubeAutocorr.dtype == np.float64 else np.nextafter(cubeAutocorr.dtype.type(0), cubeAutocorr.dtype.type(1))  # A tiny positive value that can be represented by the dtype.
+        cubeAutocorr[cubeAutocorr == 0] = tiny  # Prevent "inf" or "-inf" when taking the log.
+        cubeAutocorrLog = np.log(cubeAutocorr)
+
+        cubeLinear = self._applyOperator(cubeAutocorrLog, self._acfRegressionOperator)
+        cubeSlope = (cubeLinear[:, 1] - cubeLinear[:, 0]) / (self._lagsSquared[1] - self._lagsSquared[0])
+        # -- Coefficient of Determination
+        meanObserved = cubeAutocorrLog.mean(axis=1)
+        ssReg = ((cubeLinear - meanObserved[:, None]) ** 2).sum(axis=1)  # Regression sum of squares.
+        ssErr = ((cubeAutocorrLog - cubeLinear) ** 2).sum(axis=1)  # Residual sum of squares.
+        rSquared = ssReg / (ssReg + ssErr)
+        return cubeSlope, rSquared
 
 
 class PWSAnalysisResults(AbstractHDFAnalysisResults):
@@ -299,39 +690,39 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
     def meanReflectance(self) -> np.ndarray:
         """A 2D array giving the reflectance of the image averaged over the full spectra."""
         dset = self.file['meanReflectance']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def rms(self) -> np.ndarray:
         """A 2D array giving the spectral variance at each posiiton in the image."""
         dset = self.file['rms']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def polynomialRms(self) -> np.ndarray:
         """A 2D array giving the variance of the polynomial fit that was subtracted from the reflectance before
         calculating RMS."""
         dset = self.file['polynomialRms']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def autoCorrelationSlope(self) -> np.ndarray:
         """A 2D array giving the slope of the ACF of the spectra at each position in the image."""
         dset = self.file['autoCorrelationSlope']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def rSquared(self) -> np.ndarray:
         """A 2D array giving the r^2 coefficient of determination for the linear fit to the logarithm of the ACF. This
         basically tells us how confident to be in the `autoCorrelationSlope`."""
         dset = self.file['rSquared']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def ld(self) -> np.ndarray:
         """A 2D array giving Ld. A parameter derived from RMS and the ACF slope."""
         dset = self.file['ld']
-        return np.array(dset)
+        return hdfCodecs.readDataset(dset)
 
     @AbstractHDFAnalysisResults.FieldDecorator
     def opd(self) -> Tuple[np.ndarray, np.ndarray]:
@@ -349,6 +740,25 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
         """The `idtag` of the extra reflectance correction used."""
         return bytes(np.array(self.file['extraReflectionTag'])).decode()
 
+    def getReflectance(self, region: typing.Optional[typing.Union[pwsdt.Roi, Tuple[float, float, float, float]]] = None) -> typing.Union[pwsdt.KCube, pwsdt.LowRankCube]:
+        """Load the `reflectance` for just a region of the image. Unlike the `reflectance` property the result is not
+        kept in memory and only the chunks of the file overlapping `region` are read. If the full `reflectance` has
+        already been loaded (or the results aren't associated with a file) then that is returned instead.
+
+        Args:
+            region: An `Roi` or a (top, left, bottom, right) bounding box, as returned by `Roi.getBoundingBox`.
+
+        Returns:
+            A KCube of the region. Its `offset` attribute gives the position of the region in the full image. If the
+            reflectance was saved in the low rank format then a `LowRankCube` is returned instead, it supports
+            `getMeanSpectra` and `getOpd` without reconstructing the full data.
+        """
+        if self.file is None or 'reflectance' in self.__dict__:
+            return self.reflectance
+        if pwsdt.LowRankCube.isLowRank(self.file['reflectance']):
+            return pwsdt.LowRankCube.fromHdfDataset(self.file['reflectance'], region=region)
+        return pwsdt.KCube.fromHdfDataset(self.file['reflectance'], region=region)
+
     def releaseMemory(self):
         """
         The cached properties continue to stay in RAM until they are deleted, this method deletes all cached data to release the memory.
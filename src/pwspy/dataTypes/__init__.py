@@ -48,6 +48,7 @@ These classes are used to actuallly load and manipulate acquisition data. The al
     ExtraReflectionCube
     ICBase
     ICRawBase
+    LowRankCube
 
 Other Classes
 ---------------
@@ -58,6 +59,7 @@ Other Classes
     Roi
     CameraCorrection
     AcqDir
+    AcquisitionCatalog
     FluorescenceImage
 
 Inheritance
@@ -73,12 +75,14 @@ _jsonSchemasPath = os.path.join(os.path.split(__file__)[0], 'jsonSchemas')
 from ._metadata import (ICMetaData, AcqDir, DynMetaData, ERMetaData, FluorMetaData, AnalysisManager, MetaDataBase,
                         MetaDataBase)
 from ._other import Roi, CameraCorrection
+from ._catalog import AcquisitionCatalog
 from ._data import (FluorescenceImage, ExtraReflectanceCube, ExtraReflectionCube, ImCube, KCube, DynCube, ICBase,
-                    ICRawBase)
+                    ICRawBase, LowRankCube)
 
 __all__ = ['ICMetaData', 'AcqDir', 'DynMetaData', 'ERMetaData', 'FluorMetaData', 'AnalysisManager', 'MetaDataBase',
            'MetaDataBase', 'Roi', 'CameraCorrection', 'FluorescenceImage', 'ExtraReflectionCube',
-           'ExtraReflectanceCube', 'ImCube', 'KCube', 'DynCube', 'ICBase', 'ICRawBase']
+           'ExtraReflectanceCube', 'ImCube', 'KCube', 'DynCube', 'ICBase', 'ICRawBase',
+           'LowRankCube', 'AcquisitionCatalog']
 
 
 
@@ -0,0 +1,406 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+import fnmatch
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import typing
+from datetime import datetime
+from glob import glob
+from typing import Optional, Tuple, List
+import numpy as np
+from pwspy import dateTimeFormat
+from pwspy.dataTypes._metadata import AcqDir, ICMetaData, DynMetaData, FluorMetaData, MetaDataBase
+from pwspy.dataTypes._other import Roi
+if typing.TYPE_CHECKING:
+    from pwspy.analysis import AbstractHDFAnalysisResults
+
+
+def _jsonDefault(o):
+    """Allows numpy scalars and arrays that sometimes end up in metadata dictionaries to be saved as json."""
+    if isinstance(o, (np.generic, np.ndarray)):
+        return o.tolist()
+    raise TypeError(f"Object of type {type(o)} is not JSON serializable")
+
+
+class AcquisitionCatalog:
+    """A persistent record of the acquisitions in an experiment folder, saved as an SQLite database in the root of the
+    experiment. Loading the metadata of an acquisition requires opening the data files and validating the metadata
+    which is slow for experiments with thousands of acquisitions. The catalog stores the metadata, file formats, ROI
+    listings, analysis names and thumbnails so that they can be loaded without opening the data files. Each
+    record is tied to the names, sizes and modification times of the files it was loaded from. When those change the
+    record is reloaded from the files the next time it is accessed.
+
+    Args:
+        rootDirectory: The root folder of the experiment. All acquisitions in the catalog should be within this folder.
+        catalogPath: The file path to save the database to. By default this is `FILENAME` in `rootDirectory`.
+        trusted: If `True` then metadata loaded from the catalog is not validated again. All metadata is validated
+            before it is saved to the catalog so this is only unsafe if the database file has been edited.
+
+    Examples:
+        Load all acquisitions of an experiment, only acquisitions that have changed since the last time are loaded from their files::
+
+            catalog = AcquisitionCatalog(experimentDirectory)
+            acqs = catalog.getAcquisitions()
+
+        Find the acquisitions from a single system that have a "nucleus" ROI without opening any data files::
+
+            paths = catalog.query(system='LCPWS1', roiName='nucleus')
+            acqs = [catalog.getAcquisition(p) for p in paths]
+
+    """
+    FILENAME = 'pwspyCatalog.sqlite'
+    _roiPatterns = ('bw*_*.mat', 'roi_*.h5')  # Lower case patterns matching the files that `Roi.getValidRoisInPath` searches for.
+    _acquisitionSubfolders = ('pws', 'dynamics', 'fluorescence*')  # Lower case patterns matching the subfolders that contain acquisition data.
+    _schema = """
+        CREATE TABLE IF NOT EXISTS signatures (path TEXT, section TEXT, signature TEXT, PRIMARY KEY (path, section));
+        CREATE TABLE IF NOT EXISTS metadata (path TEXT, kind TEXT, number INTEGER, filePath TEXT, fileFormat TEXT,
+            system TEXT, time TEXT, timestamp TEXT, exposure REAL, dict TEXT, PRIMARY KEY (path, kind, number));
+        CREATE TABLE IF NOT EXISTS rois (path TEXT, name TEXT, number INTEGER, fileFormat TEXT);
+        CREATE TABLE IF NOT EXISTS analyses (path TEXT, fileName TEXT);
+        CREATE TABLE IF NOT EXISTS thumbnails (path TEXT PRIMARY KEY, image BLOB);
+        CREATE INDEX IF NOT EXISTS metadataSystem ON metadata (system);
+        CREATE INDEX IF NOT EXISTS metadataTimestamp ON metadata (timestamp);
+        CREATE INDEX IF NOT EXISTS roisPath ON rois (path);
+        CREATE INDEX IF NOT EXISTS roisName ON rois (name);
+        CREATE INDEX IF NOT EXISTS analysesPath ON analyses (path);
+    """
+
+    def __init__(self, rootDirectory: str, catalogPath: Optional[str] = None, trusted: bool = False):
+        self.rootDirectory = os.path.abspath(rootDirectory)
+        self.catalogPath = os.path.abspath(catalogPath) if catalogPath is not None else os.path.join(self.rootDirectory, self.FILENAME)
+        self.trusted = trusted
+        self._lock = threading.RLock()
+        self._connection = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """The connection is opened on first use so that a catalog can be cheaply passed to other processes."""
+        with self._lock:  # Otherwise two threads could both open a connection.
+            if self._connection is None:
+                conn = sqlite3.connect(self.catalogPath, check_same_thread=False)  # Access is synchronized by `_lock`
+                conn.execute("PRAGMA journal_mode=WAL")  # Allows other processes to read while we write.
+                conn.execute("PRAGMA synchronous=NORMAL")  # We can always rebuild the catalog from the files so we don't need to wait for every write to reach the disk.
+                conn.executescript(self._schema)
+                self._connection = conn
+            return self._connection
+
+    def close(self):
+        """Close the connection to the database file. It will be reopened if the catalog is used again."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def __getstate__(self):
+        """The database connection and lock can't be pickled, they are recreated when the catalog is unpickled."""
+        return {'rootDirectory': self.rootDirectory, 'catalogPath': self.catalogPath, 'trusted': self.trusted}
+
+    def __setstate__(self, state):
+        self.__init__(state['rootDirectory'], state['catalogPath'], state['trusted'])
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.rootDirectory})"
+
+    def getAcquisition(self, directory: str) -> AcqDir:
+        """Load an acquisition using the catalog. Equivalent to `AcqDir(directory, catalog=self)`.
+
+        Args:
+            directory: The path to the acquisition folder. Relative paths are interpreted as relative to `rootDirectory`.
+
+        Returns:
+            A new `AcqDir` that will load its information from this catalog.
+        """
+        return AcqDir(os.path.join(self.rootDirectory, directory), catalog=self)
+
+    def getAcquisitions(self, pattern: str = os.path.join('**', 'Cell[0-9]*')) -> List[AcqDir]:
+        """Find all of the acquisitions in `rootDirectory`, bringing the catalog up to date for each of them. The ROIs
+        and analyses of each acquisition are also catalogued so that they can be searched for with `query`.
+
+        Args:
+            pattern: A glob pattern, relative to `rootDirectory`, used to find acquisition folders.
+
+        Returns:
+            A list of the valid acquisitions that were found.
+        """
+        acqs = []
+        for path in sorted(glob(os.path.join(self.rootDirectory, pattern), recursive=True)):
+            if not os.path.isdir(path):
+                continue
+            try:
+                acq = self.getAcquisition(path)
+            except OSError:
+                continue  # Not a valid acquisition.
+            acq.getRois()
+            for md in (acq.pws, acq.dynamics):
+                if md is not None:
+                    md.getAnalyses()
+            acqs.append(acq)
+        return acqs
+
+    def query(self, kind: Optional[str] = None, system: Optional[str] = None, startTime: Optional[datetime] = None,
+              endTime: Optional[datetime] = None, exposure: Optional[Tuple[float, float]] = None,
+              roiName: Optional[str] = None, analysisName: Optional[str] = None) -> List[str]:
+        """Search the catalog for acquisitions. This only reads the database, records that are out of date will not be
+        updated. Use `getAcquisitions` to bring the catalog up to date first.
+
+        Args:
+            kind: One of 'pws', 'dynamics', or 'fluorescence'. Only match acquisitions of this type.
+            system: Only match acquisitions taken on the system of this name.
+            startTime: Only match acquisitions taken at or after this time.
+            endTime: Only match acquisitions taken at or before this time.
+            exposure: A tuple of the (minimum, maximum) exposure time in milliseconds.
+            roiName: Only match acquisitions that have an ROI of this name.
+            analysisName: Only match acquisitions that have an analysis of this name.
+
+        Returns:
+            A list of absolute paths to matching acquisition folders.
+        """
+        conditions, params = [], []
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind)
+        if system is not None:
+            conditions.append("system = ?")
+            params.append(system)
+        if startTime is not None:
+            conditions.append("timestamp >= ?")
+            params.append(startTime.isoformat())
+        if endTime is not None:
+            conditions.append("timestamp <= ?")
+            params.append(endTime.isoformat())
+        if exposure is not None:
+            conditions.append("exposure BETWEEN ? AND ?")
+            params.extend(exposure)
+        if roiName is not None:
+            conditions.append("path IN (SELECT path FROM rois WHERE name = ?)")
+            params.append(roiName)
+        if analysisName is not None:  # Analysis names can only be found from file names by the analysis results class so we search for the name anywhere in the file name and filter afterwards.
+            conditions.append("filePath IN (SELECT path FROM analyses WHERE instr(fileName, ?) > 0)")
+            params.append(analysisName)
+        sql = "SELECT DISTINCT path, kind, filePath FROM metadata"
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        paths = []
+        for path, kind_, filePath in rows:
+            if analysisName is not None:
+                mdClass = {'pws': ICMetaData, 'dynamics': DynMetaData}.get(kind_)
+                if mdClass is None or analysisName not in self.getAnalyses(self._absPath(filePath), mdClass.getAnalysisResultsClass(), update=False):
+                    continue
+            path = self._absPath(path)
+            if path not in paths:
+                paths.append(path)
+        return paths
+
+    def prune(self):
+        """Remove the records of folders that no longer exist."""
+        with self._lock, self._conn as conn:
+            paths = {row[0] for row in conn.execute("SELECT DISTINCT path FROM signatures")}
+            for path in paths:
+                if not os.path.exists(self._absPath(path)):
+                    for table in ('signatures', 'metadata', 'rois', 'analyses', 'thumbnails'):
+                        conn.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+
+    def loadMetadata(self, acq: AcqDir) -> Tuple[Optional[ICMetaData], Optional[DynMetaData], List[FluorMetaData]]:
+        """Used by `AcqDir` to load the metadata of its acquisitions. If the catalog record is out of date then it is
+        reloaded from file.
+
+        Args:
+            acq: The acquisition to load the metadata for.
+
+        Returns:
+            A tuple containing: The PWS metadata, the dynamics metadata, a list of the fluorescence metadata.
+        """
+        key = self._relPath(acq.filePath)
+        signature = self._getAcquisitionSignature(acq.filePath)
+        with self._lock:
+            if self._getStoredSignature(key, 'acquisition') == signature:
+                rows = self._conn.execute("SELECT kind, filePath, fileFormat, dict FROM metadata WHERE path = ? ORDER BY kind, number", (key,)).fetchall()
+                return self._decodeMetadata(rows, acq)
+        pws, dyn, fluor = acq._loadPws(), acq._loadDynamics(), acq._loadFluorescence()
+        if self._getAcquisitionSignature(acq.filePath) != signature:  # The files changed while they were being loaded, don't record what may be a mix of old and new.
+            return pws, dyn, fluor
+        rows = []
+        for kind, mds in (('pws', [pws]), ('dynamics', [dyn]), ('fluorescence', fluor)):
+            for i, md in enumerate(mds):
+                if md is not None:
+                    rows.append((key, kind, i) + self._encodeMetadata(md))
+        with self._lock, self._conn as conn:
+            conn.execute("DELETE FROM metadata WHERE path = ?", (key,))
+            conn.execute("DELETE FROM thumbnails WHERE path = ?", (key,))
+            conn.executemany("INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._setStoredSignature(conn, key, 'acquisition', signature)
+        return pws, dyn, fluor
+
+    def getRois(self, path: str) -> List[Tuple[str, int, Roi.FileFormats]]:
+        """The equivalent of `Roi.getValidRoisInPath` answered from the catalog.
+
+        Args:
+            path: The path to the folder containing the Roi files.
+
+        Returns:
+            A list of tuples containing the `name`, `number`, and file format of each Roi.
+        """
+        key = self._relPath(path)
+        signature = self._getRoiSignature(path)
+        with self._lock:
+            if self._getStoredSignature(key, 'rois') == signature:
+                rows = self._conn.execute("SELECT name, number, fileFormat FROM rois WHERE path = ?", (key,)).fetchall()
+                return [(name, num, Roi.FileFormats[fformat]) for name, num, fformat in rows]
+        rois = Roi.getValidRoisInPath(path)
+        if self._getRoiSignature(path) != signature:  # The files changed while they were being listed.
+            return rois
+        with self._lock, self._conn as conn:
+            conn.execute("DELETE FROM rois WHERE path = ?", (key,))
+            conn.executemany("INSERT INTO rois VALUES (?, ?, ?, ?)", [(key, name, num, fformat.name) for name, num, fformat in rois])
+            self._setStoredSignature(conn, key, 'rois', signature)
+        return rois
+
+    def getAnalyses(self, path: str, resultsClass: typing.Type[AbstractHDFAnalysisResults], update: bool = True) -> List[str]:
+        """The equivalent of `AnalysisManager.getAnalysesAtPath` answered from the catalog.
+
+        Args:
+            path: The path to search for analysis files.
+            resultsClass: The analysis results class used to convert file names to analysis names.
+            update: If `False` then the record is returned even if it is out of date.
+
+        Returns:
+            A list of the names of analyses that were found.
+        """
+        key = self._relPath(path)
+        if update:
+            files = self._listDirectory(os.path.join(path, 'analyses'))[0]
+            signature = self._hashFiles(files)
+            with self._lock, self._conn as conn:
+                if self._getStoredSignature(key, 'analyses') != signature:
+                    conn.execute("DELETE FROM analyses WHERE path = ?", (key,))
+                    conn.executemany("INSERT INTO analyses VALUES (?, ?)", [(key, f[0]) for f in files])
+                    self._setStoredSignature(conn, key, 'analyses', signature)
+        with self._lock:
+            rows = self._conn.execute("SELECT fileName FROM analyses WHERE path = ?", (key,)).fetchall()
+        return [resultsClass.fileName2Name(row[0]) for row in rows]
+
+    def getThumbnail(self, acq: AcqDir) -> np.ndarray:
+        """Used by `AcqDir` to load its thumbnail image. The image is loaded from file the first time and then saved in the catalog.
+
+        Args:
+            acq: The acquisition to get the thumbnail of.
+
+        Returns:
+            The thumbnail image.
+        """
+        self.loadMetadata(acq)  # Make sure that the thumbnail is cleared if the acquisition has changed.
+        key = self._relPath(acq.filePath)
+        with self._lock:
+            row = self._conn.execute("SELECT image FROM thumbnails WHERE path = ?", (key,)).fetchone()
+        if row is not None:
+            return np.load(io.BytesIO(row[0]))
+        thumbnail = acq._loadThumbnail()
+        if thumbnail is not None:
+            buffer = io.BytesIO()
+            np.save(buffer, thumbnail)
+            with self._lock, self._conn as conn:
+                conn.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?)", (key, buffer.getvalue()))
+        return thumbnail
+
+    def _getRoiSignature(self, path: str) -> str:
+        """A hash of the ROI files in the folder at `path`."""
+        return self._hashFiles([f for f in self._listDirectory(path)[0] if self._isRoiFile(f[0])])
+
+    def _relPath(self, path: str) -> str:
+        """Records are keyed by paths relative to the root so that the catalog remains valid if the experiment folder is moved."""
+        return os.path.normcase(os.path.relpath(os.path.abspath(path), self.rootDirectory))
+
+    def _absPath(self, path: str) -> str:
+        return os.path.normpath(os.path.join(self.rootDirectory, path))
+
+    def _getStoredSignature(self, key: str, section: str) -> Optional[str]:
+        row = self._conn.execute("SELECT signature FROM signatures WHERE path = ? AND section = ?", (key, section)).fetchone()
+        return None if row is None else row[0]
+
+    @staticmethod
+    def _setStoredSignature(conn: sqlite3.Connection, key: str, section: str, signature: str):
+        conn.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?)", (key, section, signature))
+
+    @staticmethod
+    def _listDirectory(directory: str) -> Tuple[List[Tuple[str, int, int]], List[str]]:
+        """Returns a sorted list of the (name, size, modification time) of each file in `directory` and a list of the
+        names of the subfolders. Empty lists are returned if the directory doesn't exist."""
+        files, folders = [], []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        folders.append(entry.name)
+                    else:
+                        st = entry.stat()
+                        files.append((entry.name, st.st_size, st.st_mtime_ns))
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return sorted(files), sorted(folders)
+
+    @staticmethod
+    def _hashFiles(files: List[Tuple[str, int, int]]) -> str:
+        return hashlib.sha1(repr(files).encode()).hexdigest()
+
+    @classmethod
+    def _isRoiFile(cls, name: str) -> bool:
+        return any(fnmatch.fnmatch(name.lower(), p) for p in cls._roiPatterns)
+
+    def _getAcquisitionSignature(self, directory: str) -> str:
+        """Old acquisitions were saved directly in the acquisition folder so we include the files there (aside from
+        ROIs and notes which don't affect the metadata) as well as the files in the subfolders of each acquisition type."""
+        files, folders = self._listDirectory(directory)
+        catalogFiles = [os.path.basename(self.catalogPath) + suffix for suffix in ('', '-wal', '-shm')]
+        files = [f for f in files if not (self._isRoiFile(f[0]) or f[0] == 'notes.txt' or f[0] in catalogFiles)]
+        for folder in folders:
+            if any(fnmatch.fnmatch(folder.lower(), p) for p in self._acquisitionSubfolders):
+                files += [(os.path.join(folder, name), size, mtime) for name, size, mtime in self._listDirectory(os.path.join(directory, folder))[0]]
+        return self._hashFiles(files)
+
+    def _encodeMetadata(self, md: MetaDataBase) -> tuple:
+        """Returns the values of the `metadata` table columns from filePath to dict."""
+        fileFormat = getattr(md, 'fileFormat', None)
+        try:
+            timestamp = datetime.strptime(md.time, dateTimeFormat).isoformat()
+        except ValueError:
+            timestamp = None
+        return (self._relPath(md.filePath), None if fileFormat is None else fileFormat.name, md.systemName, md.time,
+                timestamp, md.exposure, json.dumps(md.dict, default=_jsonDefault))
+
+    def _decodeMetadata(self, rows: List[tuple], acq: AcqDir) -> Tuple[Optional[ICMetaData], Optional[DynMetaData], List[FluorMetaData]]:
+        pws, dyn, fluor = None, None, []
+        for kind, filePath, fileFormat, dic in rows:
+            filePath = self._absPath(filePath)
+            dic = json.loads(dic)
+            if kind == 'pws':
+                pws = ICMetaData(dic, filePath, ICMetaData.FileFormats[fileFormat] if fileFormat else None, acquisitionDirectory=acq, trusted=self.trusted)
+            elif kind == 'dynamics':
+                dyn = DynMetaData(dic, filePath, DynMetaData.FileFormats[fileFormat] if fileFormat else None, acquisitionDirectory=acq, trusted=self.trusted)
+            elif kind == 'fluorescence':
+                fluor.append(FluorMetaData(dic, filePath, acquisitionDirectory=acq, trusted=self.trusted))
+            else:
+                logging.getLogger(__name__).warning(f"Unrecognized acquisition type {kind} found in {self.catalogPath}")
+        return pws, dyn, fluor
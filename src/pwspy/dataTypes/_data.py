@@ -16,6 +16,7 @@
 # along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
+import collections
 import copy
 import json
 import logging
@@ -24,13 +25,15 @@ import numbers
 import os
 import typing
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
-from typing import Tuple, Optional, Union, Type
+from typing import Tuple, Optional, Union, Type, List
 
 import h5py
 import numpy as np
 import pandas as pd
+import psutil
 import scipy as sp
 import tifffile as tf
 from matplotlib import pyplot as plt, widgets
@@ -38,6 +41,8 @@ from scipy import interpolate as spi
 from scipy.io import savemat
 from . import _metadata as pwsdtmd
 from . import _other
+from pwspy.utility import hdfCodecs
+from pwspy.utility.misc import cached_property
 if typing.TYPE_CHECKING:
     from ..utility.reflection import Material
 
@@ -51,14 +56,17 @@ class ICBase(ABC): #TODO add a `completeNormalization` method
         data (np.ndarray): A 3-dimensional array containing the data the dimensions should be [Y, X, Z] where X and Y are the spatial coordinates of the image
             and Z corresponds to the `index` dimension, e.g. wavelength, wavenumber, time, etc.
         index (tuple(Number)): A tuple containing the values of the index for the data. This could be a tuple of wavelength values, times (in the case of Dyanmics), etc.
-        dtype (type): the data type that the data should be stored as. The default is numpy.float32.
+        dtype (type): the data type that the data should be stored as. The default is numpy.float32. If `None` then the
+            data is stored as is, without copying.
     """
     _index: tuple
     data: np.ndarray
+    _floatDtype = np.float32  # The data type used when integer data must be converted to floating point. See `_ensureFloatingPoint`.
+    offset: Tuple[int, int] = (0, 0)  # The (y, x) position of `data[0, 0]` in the full camera frame. This is only non-zero if just a region of the acquisition was loaded, e.g. `ImCube.fromMetadata(md, region=roi)`
 
     def __init__(self, data: np.ndarray, index: tuple, dtype=np.float32):
         assert isinstance(data, np.ndarray)
-        self.data = data.astype(dtype)
+        self.data = data if dtype is None else data.astype(dtype)
         self._index = index
         if self.data.shape[2] != len(self.index):
             raise ValueError(f"The length of the index list doesn't match the index axis of the data array. Got {len(self.index)}, expected {self.data.shape[2]}.")
@@ -69,6 +77,18 @@ class ICBase(ABC): #TODO add a `completeNormalization` method
         """Each class of this type should have a unique constant name which will be used to identify it when saved as HDF."""
         pass
 
+    def __getstate__(self):
+        """With pickle protocol 5 contiguous arrays are pickled as out-of-band buffers that can be transferred without
+        copying, see `pwspy.utility.sharedMemory.SharedMemoryPickle`. Here we make sure that `data` can be pickled
+        that way. Memory mapped data is pickled as a plain array of the same memory and non-contiguous data is copied."""
+        state = self.__dict__.copy()
+        data = state['data']
+        if not (data.flags.c_contiguous or data.flags.f_contiguous):
+            state['data'] = np.ascontiguousarray(data)
+        elif isinstance(data, np.memmap):
+            state['data'] = np.asarray(data)
+        return state
+
     @property
     def index(self) -> Tuple[float, ...]:
         """
@@ -102,7 +122,9 @@ class ICBase(ABC): #TODO add a `completeNormalization` method
             The average spectra within the region, the standard deviation of the spectra within the region
         """
         if isinstance(mask, _other.Roi):
-            mask = mask.mask
+            mask = self._cropToRegion(mask.mask)  # Roi masks always cover the full frame.
+        elif mask is not None and mask.shape != self.data.shape[:2]:  # Assume the mask covers the full frame.
+            mask = self._cropToRegion(mask)
         if mask is None: #Make a mask that includes everything
             mask = np.ones(self.data.shape[:-1], dtype=np.bool)
         mean = self.data[mask].mean(axis=0)
@@ -172,6 +194,12 @@ class ICBase(ABC): #TODO add a `completeNormalization` method
     def __getitem__(self, slic):
         return self.data[slic]
 
+    def _ensureFloatingPoint(self):
+        """Raw data may be stored in its native integer format to save memory. This converts the data to floating point.
+        It should be called before any operation that modifies the data in place or otherwise requires floating point."""
+        if not np.issubdtype(self.data.dtype, np.floating):
+            self.data = self.data.astype(self._floatDtype, order='C')  # If the data is memory mapped from a Fortran ordered file this is where it gets loaded into a C ordered working copy.
+
     def filterDust(self, sigma: float, pixelSize: float):
         """Blurs the data cube in the X and Y dimensions. Often used to remove the effects of dust on a normalization.
 
@@ -179,10 +207,21 @@ class ICBase(ABC): #TODO add a `completeNormalization` method
             sigma: This specifies the radius of the gaussian filter used for blurring. The units of the value are determined by `pixelSize`
             pixelSize: The pixel size in microns. Settings this to 1 will effectively causes sigma to be in units of pixels rather than microns."""
         from scipy import ndimage
+        self._ensureFloatingPoint()
         sigma = sigma / pixelSize  # convert from microns to pixels
         for i in range(self.data.shape[2]):
             self.data[:, :, i] = ndimage.filters.gaussian_filter(self.data[:, :, i], sigma, mode='reflect')
 
+    def _cropToRegion(self, arr: np.ndarray, offset: Tuple[int, int] = (0, 0)) -> np.ndarray:
+        """Return the portion of `arr` which lines up with the data of this object. The first 2 dimensions of `arr`
+        should be spatial (Y, X) starting at position `offset` in the full camera frame, e.g. a full frame ROI mask or
+        the data of a reference. This is needed for data that was loaded with only a region of the frame."""
+        y, x = self.offset[0] - offset[0], self.offset[1] - offset[1]
+        h, w = self.data.shape[:2]
+        if y < 0 or x < 0 or arr.shape[0] < y + h or arr.shape[1] < x + w:
+            raise ValueError(f"An array of shape {arr.shape[:2]} at offset {offset} does not cover the data of shape {(h, w)} at offset {self.offset}.")
+        return arr[y:y + h, x:x + w]
+
     def _indicesMatch(self, other: 'ICBase') -> bool:
         """This check is performed before allowing many arithmetic operations between two data cubes. Makes sure that the Z-axis of the two cubes match."""
         return self._index == other._index
@@ -194,60 +233,53 @@ class ICBase(ABC): #TODO add a `completeNormalization` method
             stop: The ending value of the index in the new object.
         Returns:
             A new instance of ICBase with only data from `start` to `stop` in the `index`."""
-        wv = np.array(self.index)
+        slc = self._getIndexSlice(self.index, start, stop)
+        data = self.data[:, :, slc]
+        index = self.index[slc]
+        return data, index
+
+    @staticmethod
+    def _getIndexSlice(index: typing.Sequence[float], start: float, stop: float) -> slice:
+        """Returns the `slice` along the index axis which includes the values closest to `start` and `stop`. This is the
+        selection used by `selIndex`."""
+        wv = np.array(index)
         iStart = np.argmin(np.abs(wv - start))
         iStop = np.argmin(np.abs(wv - stop))
         iStop += 1  # include the end point
         if iStop >= len(wv):  # Include everything
             iStop = None
-        data = self.data[:, :, iStart:iStop]
-        index = self.index[iStart:iStop]
-        return data, index
+        return slice(iStart, iStop)
 
-    def _add(self, other: typing.Union['self.__class__', numbers.Real, np.ndarray]) -> 'self.__class__':  #TODO these don't return the right datatype. They should probably just be gotten rid of
+    def _getOperands(self, other: typing.Union['self.__class__', numbers.Real, np.ndarray], operation: str) -> typing.Tuple[np.ndarray, typing.Union[numbers.Real, np.ndarray]]:
+        """Returns the arrays that an arithmetic `operation` should be applied to. Raw data that is still stored as integers
+        is converted to floating point first, otherwise subtraction would wrap around and division would return float64."""
         if isinstance(other, self.__class__):
             if not self._indicesMatch(other):
                 raise ValueError(f"{self.__class__} indices are not compatible")
-            ret = self.data + other.data
+            self._ensureFloatingPoint()
+            other._ensureFloatingPoint()
+            return self.data, other.data
         elif isinstance(other, (numbers.Real, np.ndarray)):
-            ret = self.data + other
+            self._ensureFloatingPoint()
+            return self.data, other
         else:
-            raise NotImplementedError(f"Addition is not supported between {self.__class__} and {type(other)}")
-        return ret
+            raise NotImplementedError(f"{operation} is not supported between {self.__class__} and {type(other)}")
+
+    def _add(self, other: typing.Union['self.__class__', numbers.Real, np.ndarray]) -> 'self.__class__':  #TODO these don't return the right datatype. They should probably just be gotten rid of
+        a, b = self._getOperands(other, "Addition")
+        return a + b
 
     def _sub(self, other: typing.Union['self.__class__', numbers.Real, np.ndarray]) -> 'self.__class__':
-        if isinstance(other, self.__class__):
-            if not self._indicesMatch(other):
-                raise ValueError(f"{self.__class__} indices are not compatible")
-            ret = self.data - other.data
-        elif isinstance(other, (numbers.Real, np.ndarray)):
-            ret = self.data - other
-        else:
-            raise NotImplementedError(f"Subtraction is not supported between {self.__class__} and {type(other)}")
-        return ret
+        a, b = self._getOperands(other, "Subtraction")
+        return a - b
 
     def _mul(self, other: typing.Union['self.__class__', numbers.Real, np.ndarray]) -> 'self.__class__':
-        if isinstance(other, self.__class__):
-            if not self._indicesMatch(other):
-                raise ValueError(f"{self.__class__} indices are not compatible")
-            ret = self.data * other.data
-        elif isinstance(other, (numbers.Real, np.ndarray)):
-            ret = self.data * other
-        else:
-            raise NotImplementedError(f"Multiplication is not supported between {self.__class__} and {type(other)}")
-        return ret
-
+        a, b = self._getOperands(other, "Multiplication")
+        return a * b
 
     def _truediv(self, other: typing.Union['self.__class__', numbers.Real, np.ndarray]) -> 'self.__class__':
-        if isinstance(other, self.__class__):
-            if not self._indicesMatch(other):
-                raise ValueError(f"{self.__class__} indices are not compatible")
-            ret = self.data / other.data
-        elif isinstance(other, (numbers.Real, np.ndarray)):
-            ret = self.data / other
-        else:
-            raise NotImplementedError(f"Division is not supported between {self.__class__} and {type(other)}")
-        return ret
+        a, b = self._getOperands(other, "Division")
+        return a / b
 
     def __add__(self, other):
         ret = self._add(other)
@@ -275,7 +307,8 @@ class ICBase(ABC): #TODO add a `completeNormalization` method
         new.data = ret
         return new
 
-    def toHdfDataset(self, g: h5py.Group, name: str, fixedPointCompression: bool = True, compression: str = None) -> h5py.Group:
+    def toHdfDataset(self, g: h5py.Group, name: str, fixedPointCompression: bool = True, compression: str = None, chunkSize: Optional[int] = 64,
+                     codec: Optional[Union[str, hdfCodecs.HDFCodec]] = None, lowRankTolerance: Optional[float] = None) -> h5py.Group:
         """
         Save the data of this class to a new HDF dataset.
 
@@ -285,56 +318,82 @@ class ICBase(ABC): #TODO add a `completeNormalization` method
             fixedPointCompression (bool): if True then save the data in a special 16bit fixed-point format. Testing has shown that this has a
                 maximum conversion error of 1.4e-3 percent. Saving is ~10% faster but requires only 50% the hard drive space.
             compression: The value of this argument will be passed to h5py.create_dataset for numpy arrays. See h5py documentation for available options.
+            chunkSize: The dataset is stored in chunks of `chunkSize` x `chunkSize` pixels spanning the full index
+                axis. This allows a region of the data to be loaded without reading the whole dataset, see `decodeHdf`.
+                If `None` then the dataset is stored contiguously.
+            codec: A codec from `pwspy.utility.hdfCodecs` (or its name) used to compress the chunks of the dataset in
+                parallel. If provided then `compression` is ignored.
+            lowRankTolerance: If provided then the data is saved in a lossy low rank format rather than as individual
+                samples. Each spectrum is stored as a set of coefficients for a spectral basis that is calculated for
+                this data. The number of basis vectors is chosen so that the root-mean-square error of the saved data
+                is no more than `lowRankTolerance` times the root-mean-square of the data. `fixedPointCompression`
+                is ignored. See `LowRankCube`.
 
         Returns:
             h5py.Group: This is the the same h5py.Group that was passed in a `g`. It should now have a new dataset by the name of 'name'
         """
+        if lowRankTolerance is not None:
+            _LowRankEncoder.encode(self.data, g, name, lowRankTolerance, self._getHdfChunks(chunkSize or 64)[:2], codec)
+            g[name].attrs['index'] = np.array(self.index)
+            g[name].attrs['type'] = np.string_(f"{self._hdfTypeName}_lr")
+            return g
 
         if fixedPointCompression:
             # Scale data to span the full range of an unsigned 16bit integer. save as integer and save the min and max
             # needed to scale back to the original data. Testing has shown that this has a maximum conversion error of 1.4e-3 percent.
             # Saving is ~10% faster but requires only 50% the hard drive space. Time can be traded for space by using compression
-            # when creating the dataset
+            # when creating the dataset. The conversion is done one slab at a time so that no full size temporary arrays are needed.
             m = self.data.min()
             M = self.data.max()
-            fpData = self.data - m
-            fpData = fpData / (M - m)
-            fpData *= (2 ** 16 - 1)
-            fpData = fpData.astype(np.uint16)
-            dset = g.create_dataset(name, data=fpData, compression=compression)  # , chunks=(64,64,self.data.shape[2]), compression=2)
+            if codec is None:
+                dset = g.create_dataset(name, shape=self.data.shape, dtype=np.uint16, compression=compression, chunks=self._getHdfChunks(chunkSize))
+            else:
+                codec = hdfCodecs.getCodec(codec)
+                dset = codec.createDataset(g, name, self.data.shape, np.uint16, self._getHdfChunks(chunkSize or 64))
+            _FixedPointCodec.encode(self.data, dset, m, M, codec=codec)
             dset.attrs['index'] = np.array(self.index)
             dset.attrs['type'] = np.string_(f"{self._hdfTypeName}_fp")
             dset.attrs['min'] = m
             dset.attrs['max'] = M
         else:
-            dset = g.create_dataset(name, data=self.data, compression=compression)
+            dset = hdfCodecs.writeDataset(g, name, self.data, codec=codec, compression=compression,
+                                          chunks=self._getHdfChunks(chunkSize if codec is None else chunkSize or 64))
             dset.attrs['index'] = np.array(self.index)
             dset.attrs['type'] = np.string_(self._hdfTypeName)
         return g
 
+    def _getHdfChunks(self, chunkSize: Optional[int]) -> Optional[Tuple[int, int, int]]:
+        """Returns the chunk shape used by `toHdfDataset`. Each chunk holds the full index axis for a square of pixels."""
+        if chunkSize is None:
+            return None
+        return min(chunkSize, self.data.shape[0]), min(chunkSize, self.data.shape[1]), self.data.shape[2]
+
     @classmethod
-    def decodeHdf(cls, d: h5py.Dataset) -> Tuple[np.array, Tuple[float, ...]]:
+    def decodeHdf(cls, d: h5py.Dataset, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> Tuple[np.array, Tuple[float, ...]]:
         """
         Load a new instance of ICBase from an `h5py.Dataset`
 
         Args:
             d: The dataset that the ICBase has been saved to
+            region: If provided then only this spatial region of the data is read. This can be an `Roi` or a bounding
+                box in the (top, left, bottom, right) form returned by `Roi.getBoundingBox`. For datasets saved in
+                chunks only the chunks overlapping the region are read from disk. Datasets saved with a codec from
+                `pwspy.utility.hdfCodecs` are decoded automatically.
 
         Returns:
             A tuple containing: (data: The 3D array of `data`,  index: A tuple containing the `index`)
         """
         assert 'type' in d.attrs
         assert 'index' in d.attrs
+        window = _getRegionWindow(region) + (slice(None),)
         if d.attrs['type'].decode() == cls._hdfTypeName: #standard decoding
-            return np.array(d), tuple(d.attrs['index'])
+            return hdfCodecs.readDataset(d, window), tuple(d.attrs['index'])
         elif d.attrs['type'].decode() == f"{cls._hdfTypeName}_fp": #Fixed point decoding
             M = d.attrs['max']
             m = d.attrs['min']
-            arr = np.array(d)
-            arr = arr.astype(np.float32) / (2 ** 16 - 1)
-            arr *= (M - m)
-            arr += m
-            return arr, tuple(d.attrs['index'])
+            return _FixedPointCodec.decode(d, window[:2], m, M), tuple(d.attrs['index'])
+        elif d.attrs['type'].decode() == f"{cls._hdfTypeName}_lr":  # Low rank decoding
+            return LowRankCube.fromHdfDataset(d, region).data, tuple(d.attrs['index'])
         else:
             raise TypeError(f"Got {d.attrs['type'].decode()} instead of {cls._hdfTypeName}")
 
@@ -350,7 +409,9 @@ class ICRawBase(ICBase, ABC):
         index: A tuple containing the values of the index for the data. This could be a tuple of wavelength values, times (in the case of Dynamics), etc.
         metadata: The metadata object associated with this data object.
         processingStatus: An object that keeps track of which processing steps and corrections have been applied to this object.
-        dtype (type): the data type that the data should be stored as. The default is numpy.float32.
+        dtype (type): the data type that the data should be stored as. The default is numpy.float32. Integer data, e.g.
+            the uint16 data loaded from the raw files, is stored in its native format without copying until an operation
+            requires floating point, at which point it is converted to `dtype`.
     """
 
     @dataclass
@@ -370,7 +431,12 @@ class ICRawBase(ICBase, ABC):
             return cls(cameraCorrected=d['camCorrected'], normalizedByExposure=d['exposureNormed'], extraReflectionSubtracted=d['erSubtracted'], normalizedByReference=d['refNormed'])
 
     def __init__(self, data: np.ndarray, index: tuple, metadata: pwsdtmd.MetaDataBase, processingStatus: ProcessingStatus=None, dtype=np.float32):
-        super().__init__(data, index, dtype)
+        if np.issubdtype(data.dtype, np.integer):
+            super().__init__(data, index, dtype=None)  # Keep raw data as integers for now. Half the memory of float32 and many cubes are never processed.
+        else:
+            super().__init__(data, index, dtype)
+        if np.issubdtype(dtype, np.floating):
+            self._floatDtype = dtype
         self.metadata = metadata
         if processingStatus:
             self.processingStatus = processingStatus
@@ -384,7 +450,8 @@ class ICRawBase(ICBase, ABC):
             raise Exception(
                 "This ImCube has not yet been corrected for camera effects. are you sure you want to normalize by exposure?")
         if not self.processingStatus.normalizedByExposure:
-            self.data = self.data / self.metadata.exposure
+            self._ensureFloatingPoint()
+            self.data /= self.metadata.exposure  # Done in place to avoid allocating another full size array.
         else:
             raise Exception("The ImCube has already been normalized by exposure.")
         self.processingStatus.normalizedByExposure = True
@@ -400,21 +467,68 @@ class ICRawBase(ICBase, ABC):
         """
         if self.processingStatus.cameraCorrected:
             raise Exception("This ImCube has already had it's camera correction applied!")
-        if binning is None:
-            binning = self.metadata.binning
-            if binning is None: raise ValueError('Binning metadata not found. Binning must be specified in function argument.')
-        if correction is None:
-            correction = self.metadata.cameraCorrection
-            if correction is None: raise ValueError('other.CameraCorrection metadata not found. Binning must be specified in function argument.')
+        correction, binning = self._getCameraCorrectionParameters(correction, binning)
+        self._ensureFloatingPoint()
         count = correction.darkCounts * binning ** 2  # Account for the fact that binning multiplies the darkcount.
-        self.data = self.data - count
+        self.data -= count
         if correction.linearityPolynomial is None or correction.linearityPolynomial == (1.0,):
             pass
         else:
-            self.data = np.polynomial.polynomial.polyval(self.data, (0.0,) + correction.linearityPolynomial)  # The [0] item is the y-intercept (already handled by the darkcount)
+            # Evaluate the polynomial using Horner's method. `np.polynomial.polynomial.polyval` would return a float64 array, this keeps the original precision and only needs one extra array.
+            coeffs = (0.0,) + correction.linearityPolynomial  # The [0] item is the y-intercept (already handled by the darkcount)
+            out = np.full_like(self.data, coeffs[-1])
+            for c in reversed(coeffs[:-1]):
+                out *= self.data
+                out += c
+            self.data = out
         self.processingStatus.cameraCorrected = True
         return
 
+    def correctCameraEffectsAndNormalizeExposure(self, correction: _other.CameraCorrection = None, binning: int = None, out: np.ndarray = None):
+        """Equivalent to `correctCameraEffects` followed by `normalizeByExposure`. If the data is still the unsigned
+        16-bit data from the camera then both corrections are applied in a single pass by indexing into a lookup table
+        that contains the corrected value for every possible raw value.
+
+        Args:
+            correction: The cameracorrection object providing information on how to correct the data.
+            binning: The binning that the raw data was imaged at. 2 = 2x2 binning, 3 = 3x3 binning, etc.
+            out: An optional float32 array with the same shape as the data to write the corrected data into. Only used
+                when the lookup table can be applied.
+        """
+        if self.data.dtype != np.uint16:  # The data has already been converted to floating point, or it isn't from a 16-bit camera.
+            self.correctCameraEffects(correction, binning)
+            self.normalizeByExposure()
+            return
+        if self.processingStatus.cameraCorrected:
+            raise Exception("This ImCube has already had it's camera correction applied!")
+        if self.processingStatus.normalizedByExposure:
+            raise Exception("The ImCube has already been normalized by exposure.")
+        correction, binning = self._getCameraCorrectionParameters(correction, binning)
+        lut = correction.getLookupTable(binning, self.metadata.exposure)
+        if out is None:
+            out = np.empty(self.data.shape, dtype=lut.dtype)
+        np.take(lut, self.data, out=out, mode='clip')  # 'clip' is never needed for uint16 but unlike the default mode it allows writing directly to `out` without buffering.
+        self.data = out
+        self.processingStatus.cameraCorrected = True
+        self.processingStatus.normalizedByExposure = True
+
+    @classmethod
+    def _fromWindow(cls, data: np.ndarray, metadata: pwsdtmd.MetaDataBase, window: Tuple[slice, slice]) -> ICRawBase:
+        """Used by the file loaders to construct a new object from a region of the full frame. See `_getRegionWindow`."""
+        cube = cls(data, metadata)
+        cube.offset = _getWindowOffset(window)
+        return cube
+
+    def _getCameraCorrectionParameters(self, correction: Optional[_other.CameraCorrection], binning: Optional[int]) -> Tuple[_other.CameraCorrection, int]:
+        """Fill in the `correction` and `binning` from the metadata if they weren't provided."""
+        if binning is None:
+            binning = self.metadata.binning
+            if binning is None: raise ValueError('Binning metadata not found. Binning must be specified in function argument.')
+        if correction is None:
+            correction = self.metadata.cameraCorrection
+            if correction is None: raise ValueError('other.CameraCorrection metadata not found. Binning must be specified in function argument.')
+        return correction, binning
+
     @abstractmethod
     def normalizeByReference(self, reference: 'self.__class__'):
         """Normalize the raw data of this data cube by a reference cube to result in data representing
@@ -456,10 +570,8 @@ class ICRawBase(ICBase, ABC):
         assert not reference.processingStatus.extraReflectionSubtracted
         assert not reference.processingStatus.cameraCorrected
         assert not reference.processingStatus.normalizedByExposure
-        reference.correctCameraEffects(cameraCorrection)
-        reference.normalizeByExposure()
-        self.correctCameraEffects(cameraCorrection)
-        self.normalizeByExposure()
+        reference.correctCameraEffectsAndNormalizeExposure(cameraCorrection)
+        self.correctCameraEffectsAndNormalizeExposure(cameraCorrection)
 
         reflection = ExtraReflectionCube.create(extraReflectance, getReflectance(Material.Glass, referenceMaterial), reference)
         reference.subtractExtraReflection(reflection)
@@ -477,7 +589,8 @@ class ICRawBase(ICBase, ABC):
         """
         pass
 
-    def toHdfDataset(self, g: h5py.Group, name: str, fixedPointCompression: bool = True) -> h5py.Group:
+    def toHdfDataset(self, g: h5py.Group, name: str, fixedPointCompression: bool = True, chunkSize: Optional[int] = 64,
+                     codec: Optional[Union[str, hdfCodecs.HDFCodec]] = None, lowRankTolerance: Optional[float] = None) -> h5py.Group:
         """
         Save this object into an HDF dataset.
 
@@ -486,23 +599,27 @@ class ICRawBase(ICBase, ABC):
             name: The name of the new dataset.
             fixedPointCompression: If True then the data will be converted from floating point to 16-bit fixed point.
                 This results in approximately half the storage requirements at a very slight loss in precision.
+            chunkSize: The size of the square of pixels stored in each chunk of the dataset. See `ICBase.toHdfDataset`.
+            codec: A codec used to compress the dataset in parallel. See `ICBase.toHdfDataset`.
+            lowRankTolerance: If provided then the data is saved in a lossy low rank format. See `ICBase.toHdfDataset`.
 
         Returns:
             A reference to the `h5py.Group` passed in as `g`.
 
         """
-        g = ICBase.toHdfDataset(self, g, name, fixedPointCompression)
+        g = ICBase.toHdfDataset(self, g, name, fixedPointCompression, chunkSize=chunkSize, codec=codec, lowRankTolerance=lowRankTolerance)
         self.metadata.encodeHdfMetadata(g[name])
         g[name].attrs['processingStatus'] = np.string_(json.dumps(self.processingStatus.toDict()))
         return g
 
     @classmethod
-    def decodeHdf(cls, d: h5py.Dataset) -> Tuple[np.array, Tuple[float, ...], dict, ProcessingStatus]:
+    def decodeHdf(cls, d: h5py.Dataset, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> Tuple[np.array, Tuple[float, ...], dict, ProcessingStatus]:
         """
         Load a new instance of ICRawBase from an `h5py.Dataset`
 
         Args:
             d: The dataset that the ICBase has been saved to
+            region: If provided then only this spatial region of the data is read. See `ICBase.decodeHdf`.
 
         Returns:
             A tuple containing:
@@ -511,7 +628,7 @@ class ICRawBase(ICBase, ABC):
                 metadata: A dictionary containing metadata.
                 procStatus: The processing status of the object.
         """
-        arr, index = super().decodeHdf(d)
+        arr, index = super().decodeHdf(d, region)
         mdDict = cls.getMetadataClass().decodeHdfMetadata(d)
         if 'processingStatus' in d.attrs:
             processingStatus = cls.ProcessingStatus.fromDict(json.loads(d.attrs['processingStatus']))
@@ -530,7 +647,8 @@ class DynCube(ICRawBase):
             and Z corresponds to the `index` dimension, e.g. wavelength, wavenumber, time, etc.
         metadata: The metadata object associated with this data object.
         processingStatus: An object that keeps track of which processing steps and corrections have been applied to this object.
-        dtype: the data type that the data should be stored as. The default is numpy.float32.
+        dtype: the data type that the data should be stored as. The default is numpy.float32. Integer data is kept in
+            its native format until floating point is required. See `ICRawBase`.
     """
 
     _hdfTypeName = "DynCube"  # This is used for saving/loading from HDF. Important not to change it or old files will stop working.
@@ -553,28 +671,36 @@ class DynCube(ICRawBase):
         return self.index
 
     @classmethod
-    def fromMetadata(cls, meta: pwsdtmd.DynMetaData, lock: mp.Lock = None) -> DynCube:
+    def fromMetadata(cls, meta: pwsdtmd.DynMetaData, lock: mp.Lock = None, out: np.ndarray = None, memoryMap: bool = False, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> DynCube:
         """
         Load a new instance of `DynCube` based on the information contained in a `DynMetaData` object.
 
         Args:
             meta: The metadata object to be used for loading.
             lock: An optional `Lock` used to synchronize IO operations in multithreaded and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            memoryMap: If True then the data file is memory mapped rather than read, if the file format supports it. See
+                `fromOldPWS` and `fromTiff`.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `DynCube`.
         """
         if meta.fileFormat == pwsdtmd.DynMetaData.FileFormats.Tiff:
-            return cls.fromTiff(meta.filePath, metadata=meta, lock=lock)
+            return cls.fromTiff(meta.filePath, metadata=meta, lock=lock, out=out, memoryMap=memoryMap, region=region)
         elif meta.fileFormat == pwsdtmd.DynMetaData.FileFormats.RawBinary:
-            return cls.fromOldPWS(meta.filePath, metadata=meta, lock=lock)
+            return cls.fromOldPWS(meta.filePath, metadata=meta, lock=lock, out=out, memoryMap=memoryMap, region=region)
         elif meta.fileFormat is None:
-            return cls.loadAny(meta.filePath, metadata=meta, lock=lock)
+            return cls.loadAny(meta.filePath, metadata=meta, lock=lock, out=out, memoryMap=memoryMap, region=region)
         else:
             raise TypeError("Invalid FileFormat")
 
     @classmethod
-    def loadAny(cls, directory: str, metadata: typing.Optional[pwsdtmd.DynMetaData] = None, lock: typing.Optional[mp.Lock] = None) -> DynCube:
+    def loadAny(cls, directory: str, metadata: typing.Optional[pwsdtmd.DynMetaData] = None, lock: typing.Optional[mp.Lock] = None, out: np.ndarray = None, memoryMap: bool = False, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> DynCube:
         """
         Attempt to load a `DynCube` for any format of file in `directory`
 
@@ -582,20 +708,28 @@ class DynCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            memoryMap: If True then the data file is memory mapped rather than read, if the file format supports it. See
+                `fromOldPWS` and `fromTiff`.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `DynCube`.
         """
         try:
-            return DynCube.fromTiff(directory, metadata=metadata, lock=lock)
+            return DynCube.fromTiff(directory, metadata=metadata, lock=lock, out=out, memoryMap=memoryMap, region=region)
         except:
             try:
-                return DynCube.fromOldPWS(directory, metadata=metadata, lock=lock)
+                return DynCube.fromOldPWS(directory, metadata=metadata, lock=lock, out=out, memoryMap=memoryMap, region=region)
             except:
                 raise OSError(f"Could not find a valid PWS image cube file at {directory}.")
 
     @classmethod
-    def fromOldPWS(cls, directory, metadata: pwsdtmd.DynMetaData = None,  lock: mp.Lock = None) -> DynCube:
+    def fromOldPWS(cls, directory, metadata: pwsdtmd.DynMetaData = None,  lock: mp.Lock = None, out: np.ndarray = None, memoryMap: bool = False, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> DynCube:
         """Loads from the file format that was saved by the all-matlab version of the Basis acquisition code.
         Data was saved in raw binary to a file called `image_cube`. Some metadata was saved to .mat files called
         `info2` and `info3`.
@@ -604,26 +738,38 @@ class DynCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            memoryMap: If True then the data is not read from file. Instead the returned object's `data` is a read-only
+                `numpy.memmap` of the file and only the parts of the file that are actually accessed will be read, e.g.
+                the frames selected by `selIndex` or the pixels of an ROI. The data is copied into a C-ordered working
+                copy when it is first converted to floating point. Cannot be used along with `out`.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `DynCube`.
         """
+        if memoryMap and out is not None:
+            raise ValueError("The `out` argument can not be used when memory mapping.")
         if lock is not None:
             lock.acquire()
         try:
             if metadata is None:
                 metadata = pwsdtmd.DynMetaData.fromOldPWS(directory)
-            with open(os.path.join(directory, 'image_cube'), 'rb') as f:
-                data = np.frombuffer(f.read(), dtype=np.uint16)
-            data = data.reshape((metadata.dict['imgHeight'], metadata.dict['imgWidth'], len(metadata.times)), order='F')
+            shape = (metadata.dict['imgHeight'], metadata.dict['imgWidth'], len(metadata.times))
+            path = os.path.join(directory, 'image_cube')
+            window = _getRegionWindow(region)
+            data = _memoryMapRawBinaryCube(path, shape)[window] if memoryMap else _readRawBinaryCube(path, shape, out, window)
         finally:
             if lock is not None:
                 lock.release()
-        data = data.copy(order='C')
-        return cls(data, metadata)
+        return cls._fromWindow(data, metadata, window)
 
     @classmethod
-    def fromTiff(cls, directory, metadata: pwsdtmd.DynMetaData = None, lock: mp.Lock = None) -> DynCube:
+    def fromTiff(cls, directory, metadata: pwsdtmd.DynMetaData = None, lock: mp.Lock = None, out: np.ndarray = None, memoryMap: bool = False, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> DynCube:
         """Load a dyanmics acquisition from a tiff file. if the metadata for the acquisition has already been loaded then you can provide
         is as the `metadata` argument to avoid loading it again. the `lock` argument is an optional place to provide a multiprocessing.Lock
         which can be used when multiple files in parallel to avoid giving the hard drive too many simultaneous requests, this is probably not necessary.
@@ -632,10 +778,24 @@ class DynCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            memoryMap: If True then the data is not read from file. The location of each page of the TIFF file is indexed
+                and, if the pages are uncompressed and evenly spaced, the returned object's `data` is a read-only view
+                into a memory map of the file. Only the pages that are actually accessed will be read, e.g. the
+                frames selected by `selIndex` or `data[:, :, i]`. The data is copied into a C-ordered working copy
+                when it is first converted to floating point. If the file can't be memory mapped then it is loaded
+                normally. Cannot be used along with `out`.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `DynCube`.
         """
+        if memoryMap and out is not None:
+            raise ValueError("The `out` argument can not be used when memory mapping.")
         if lock is not None:
             lock.acquire()
         try:
@@ -645,13 +805,16 @@ class DynCube(ICRawBase):
                 path = os.path.join(directory, 'dyn.tif')
             else:
                 raise OSError("No Tiff file was found at:", directory)
-            with tf.TiffFile(path) as tif:
-                data = np.rollaxis(tif.asarray(), 0, 3)  # Swap axes to match y,x,lambda convention.
+            window = _getRegionWindow(region)
+            data = _memoryMapTiffCube(path) if memoryMap else None
+            if data is None:
+                data = _readTiffCube(path, out, window)
+            else:
+                data = data[window]
         finally:
             if lock is not None:
                 lock.release()
-        data = data.copy(order='C')
-        return cls(data, metadata)
+        return cls._fromWindow(data, metadata, window)
 
     def normalizeByReference(self, reference: Union[DynCube, np.ndarray]):
         """This method can accept either a DynCube (in which case it's average over time will be calculated and used for
@@ -673,23 +836,24 @@ class DynCube(ICRawBase):
                 logger.warning("The reference cube has not been corrected for camera effects. This is highly reccomended before performing any analysis steps.")
             if not reference.processingStatus.normalizedByExposure:
                 logger.warning("The reference cube has not been normalized by exposure. This is highly reccomended before performing any analysis steps.")
-            mean = reference.data.mean(axis=2)
+            mean = self._cropToRegion(reference.data, reference.offset).mean(axis=2)
         elif isinstance(reference, np.ndarray):
             assert len(reference.shape) == 2
-            assert reference.shape[0] == self.data.shape[0]
-            assert reference.shape[1] == self.data.shape[1]
-            mean = reference
+            mean = reference if reference.shape == self.data.shape[:2] else self._cropToRegion(reference)
         else:
             raise TypeError(f"`reference` must be either DynCube or numpy.ndarray, not {type(reference)}")
-        self.data = self.data / mean[:, :, None]
+        self._ensureFloatingPoint()
+        self.data /= mean[:, :, None]
         self.processingStatus.normalizedByReference = True
 
     def subtractExtraReflection(self, extraReflection: np.ndarray): # Inherit docstring
-        assert self.data.shape[:2] == extraReflection.shape
+        if extraReflection.shape != self.data.shape[:2]:
+            extraReflection = self._cropToRegion(extraReflection)
         if not self.processingStatus.normalizedByExposure:
             raise Exception("This DynCube has not yet been normalized by exposure. are you sure you want to normalize by exposure?")
         if not self.processingStatus.extraReflectionSubtracted:
-            self.data = self.data - extraReflection[:, :, None]
+            self._ensureFloatingPoint()
+            self.data -= extraReflection[:, :, None]
             self.processingStatus.extraReflectionSubtracted = True
         else:
             raise Exception("The DynCube has already has extra reflection subtracted.")
@@ -698,7 +862,9 @@ class DynCube(ICRawBase):
         data, index = super().selIndex(start, stop)
         md = self.metadata
         md.dict['times'] = index
-        return DynCube(data, md)
+        cube = DynCube(data, md)
+        cube.offset = self.offset
+        return cube
 
     def getAutocorrelation(self) -> np.ndarray:
         """
@@ -708,6 +874,7 @@ class DynCube(ICRawBase):
         Returns:
             A 3D array of the autocorrelation function of the original data.
         """
+        self._ensureFloatingPoint()
         data = self.data - self.data.mean(axis=2)[:, :, None]  # By subtracting the mean we get an ACF where the 0-lag value is the variance of the signal.
         F = np.fft.rfft(data, axis=2)
         ac = np.fft.irfft(F * np.conjugate(F), axis=2) / data.shape[2]
@@ -732,10 +899,13 @@ class DynCube(ICRawBase):
         super().filterDust(kernelRadius, pixelSize)
 
     @classmethod
-    def fromHdfDataset(cls, d: h5py.Dataset):  # Inherit docstring
-        data, index, mdDict, processingStatus = cls.decodeHdf(d)
+    def fromHdfDataset(cls, d: h5py.Dataset, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None):
+        """Load a DynCube from an HDF5 dataset. If `region` is provided then only that spatial region is read. See `ICBase.decodeHdf`."""
+        data, index, mdDict, processingStatus = cls.decodeHdf(d, region)
         md = pwsdtmd.DynMetaData(mdDict, fileFormat=pwsdtmd.DynMetaData.FileFormats.Hdf)
-        return cls(data, md, processingStatus=processingStatus)
+        cube = cls(data, md, processingStatus=processingStatus)
+        cube.offset = _getWindowOffset(_getRegionWindow(region))
+        return cube
 
 
 class ExtraReflectanceCube(ICBase):
@@ -881,7 +1051,8 @@ class ImCube(ICRawBase):
             and Z corresponds to the `index` dimension, e.g. wavelength, wavenumber, time, etc.
         metadata: The metadata object associated with this data object.
         processingStatus: An object that keeps track of which processing steps and corrections have been applied to this object.
-        dtype (type): the data type that the data should be stored as. The default is numpy.float32.
+        dtype (type): the data type that the data should be stored as. The default is numpy.float32. Integer data is kept in
+            its native format until floating point is required. See `ICRawBase`.
     """
 
     _hdfTypeName = "ImCube"  # This is used for saving/loading from HDF. Important not to change it or old files will stop working.
@@ -898,7 +1069,7 @@ class ImCube(ICRawBase):
         return self.index
 
     @classmethod
-    def loadAny(cls, directory: str, metadata: pwsdtmd.ICMetaData = None,  lock: mp.Lock = None):
+    def loadAny(cls, directory: str, metadata: pwsdtmd.ICMetaData = None,  lock: mp.Lock = None, out: np.ndarray = None, memoryMap: bool = False, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None):
         """
         Attempt to load a `ImCube` for any format of file in `directory`
 
@@ -906,23 +1077,31 @@ class ImCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            memoryMap: If True then the data file is memory mapped rather than read, if the file format supports it. See
+                `fromOldPWS` and `fromTiff`.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `ImCube`.
         """
         try:
-            return ImCube.fromTiff(directory, metadata=metadata, lock=lock)
+            return ImCube.fromTiff(directory, metadata=metadata, lock=lock, out=out, memoryMap=memoryMap, region=region)
         except:
             try:
-                return ImCube.fromOldPWS(directory, metadata=metadata, lock=lock)
+                return ImCube.fromOldPWS(directory, metadata=metadata, lock=lock, out=out, memoryMap=memoryMap, region=region)
             except:
                 try:
-                    return ImCube.fromNano(directory, metadata=metadata, lock=lock)
+                    return ImCube.fromNano(directory, metadata=metadata, lock=lock, out=out, region=region)
                 except:
                     raise OSError(f"Could not find a valid PWS image cube file at {directory}.")
 
     @classmethod
-    def fromOldPWS(cls, directory: str, metadata: pwsdtmd.ICMetaData = None,  lock: mp.Lock = None):
+    def fromOldPWS(cls, directory: str, metadata: pwsdtmd.ICMetaData = None,  lock: mp.Lock = None, out: np.ndarray = None, memoryMap: bool = False, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None):
         """
         Loads from the file format that was saved by the all-matlab version of the Basis acquisition code.
         Data was saved in raw binary to a file called `image_cube`. Some metadata was saved to .mat files called
@@ -932,26 +1111,38 @@ class ImCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            memoryMap: If True then the data is not read from file. Instead the returned object's `data` is a read-only
+                `numpy.memmap` of the file and only the parts of the file that are actually accessed will be read, e.g.
+                the frames selected by `selIndex` or the pixels of an ROI. The data is copied into a C-ordered working
+                copy when it is first converted to floating point. Cannot be used along with `out`.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `ImCube`.
         """
+        if memoryMap and out is not None:
+            raise ValueError("The `out` argument can not be used when memory mapping.")
         if lock is not None:
             lock.acquire()
         try:
             if metadata is None:
                 metadata = pwsdtmd.ICMetaData.fromOldPWS(directory)
-            with open(os.path.join(directory, 'image_cube'), 'rb') as f:
-                data = np.frombuffer(f.read(), dtype=np.uint16)
-            data = data.reshape((metadata.dict['imgHeight'], metadata.dict['imgWidth'], len(metadata.wavelengths)), order='F')
+            shape = (metadata.dict['imgHeight'], metadata.dict['imgWidth'], len(metadata.wavelengths))
+            path = os.path.join(directory, 'image_cube')
+            window = _getRegionWindow(region)
+            data = _memoryMapRawBinaryCube(path, shape)[window] if memoryMap else _readRawBinaryCube(path, shape, out, window)
         finally:
             if lock is not None:
                 lock.release()
-        data = data.copy(order='C')
-        return cls(data, metadata)
+        return cls._fromWindow(data, metadata, window)
 
     @classmethod
-    def fromTiff(cls, directory, metadata: pwsdtmd.ICMetaData = None,  lock: mp.Lock = None):
+    def fromTiff(cls, directory, metadata: pwsdtmd.ICMetaData = None,  lock: mp.Lock = None, out: np.ndarray = None, memoryMap: bool = False, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None):
         """
         Loads from a 3D tiff file named `pws.tif`, or in some older data `MMStack.ome.tif`. Metadata can be stored in
         the tags of the tiff file but if there is a pwsmetadata.json file found then this is preferred.
@@ -962,10 +1153,24 @@ class ImCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            memoryMap: If True then the data is not read from file. The location of each page of the TIFF file is indexed
+                and, if the pages are uncompressed and evenly spaced, the returned object's `data` is a read-only view
+                into a memory map of the file. Only the pages that are actually accessed will be read, e.g. the
+                frames selected by `selIndex` or `data[:, :, i]`. The data is copied into a C-ordered working copy
+                when it is first converted to floating point. If the file can't be memory mapped then it is loaded
+                normally. Cannot be used along with `out`.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `ImCube`.
         """
+        if memoryMap and out is not None:
+            raise ValueError("The `out` argument can not be used when memory mapping.")
         if lock is not None:
             lock.acquire()
         try:
@@ -977,16 +1182,19 @@ class ImCube(ICRawBase):
                 path = os.path.join(directory, 'pws.tif')
             else:
                 raise OSError("No Tiff file was found at:", directory)
-            with tf.TiffFile(path) as tif:
-                data = np.rollaxis(tif.asarray(), 0, 3)  # Swap axes to match y,x,lambda convention.
+            window = _getRegionWindow(region)
+            data = _memoryMapTiffCube(path) if memoryMap else None
+            if data is None:
+                data = _readTiffCube(path, out, window)
+            else:
+                data = data[window]
         finally:
             if lock is not None:
                 lock.release()
-        data = data.copy(order='C')
-        return cls(data, metadata)
+        return cls._fromWindow(data, metadata, window)
 
     @classmethod
-    def fromNano(cls, directory: str, metadata: pwsdtmd.ICMetaData = None, lock: mp.Lock = None) -> ImCube:
+    def fromNano(cls, directory: str, metadata: pwsdtmd.ICMetaData = None, lock: mp.Lock = None, out: np.ndarray = None, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> ImCube:
         """
         Loads from the file format used at NanoCytomics. all data and metadata is contained in a .mat file.
 
@@ -994,6 +1202,12 @@ class ImCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `ImCube`.
@@ -1004,17 +1218,16 @@ class ImCube(ICRawBase):
         try:
             if metadata is None:
                 metadata = pwsdtmd.ICMetaData.fromNano(directory)
+            window = _getRegionWindow(region)
             with h5py.File(path, 'r') as hf:
-                data = np.array(hf['imageCube'])
-                data = data.transpose((2, 1, 0))  # Re-order axes to match the shape of ROIs and thumbnails.
-                data = data.copy(order='C')  # Copying the data to 'C' order has shows to provide some benefit for performance in selecting out spectra.
+                data = _readNanoCube(hf['imageCube'], out, window)
         finally:
             if lock is not None:
                 lock.release()
-        return cls(data, metadata)
+        return cls._fromWindow(data, metadata, window)
 
     @classmethod
-    def fromMetadata(cls, meta: pwsdtmd.ICMetaData,  lock: mp.Lock = None) -> ImCube:
+    def fromMetadata(cls, meta: pwsdtmd.ICMetaData,  lock: mp.Lock = None, out: np.ndarray = None, memoryMap: bool = False, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> ImCube:
         """
         If provided with an ICMetadata object this function will automatically select the correct file loading method
         and will return the associated ImCube.
@@ -1022,19 +1235,27 @@ class ImCube(ICRawBase):
         Args:
             meta: The metadata to use to load the object from.
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated C-ordered array (for example a block of shared memory) that the data will be
+                loaded into. It must have the shape and dtype of the data on file.
+            memoryMap: If True then the data file is memory mapped rather than read, if the file format supports it. See
+                `fromOldPWS` and `fromTiff`.
+            region: If provided then only this spatial region of the acquisition is loaded. This can be an `Roi`, in which
+                case the bounding box of its mask is used, or a bounding box in the (top, left, bottom, right) form
+                returned by `Roi.getBoundingBox`. The `offset` attribute of the returned object gives the position of
+                the region in the full frame. If `out` is provided it must match the shape of the region.
 
         Returns:
             A new instance of `ImCube`.
         """
         assert isinstance(meta, pwsdtmd.ICMetaData)
         if meta.fileFormat == pwsdtmd.ICMetaData.FileFormats.Tiff:
-            return cls.fromTiff(meta.filePath, metadata=meta, lock=lock)
+            return cls.fromTiff(meta.filePath, metadata=meta, lock=lock, out=out, memoryMap=memoryMap, region=region)
         elif meta.fileFormat == pwsdtmd.ICMetaData.FileFormats.RawBinary:
-            return cls.fromOldPWS(meta.filePath, metadata=meta, lock=lock)
+            return cls.fromOldPWS(meta.filePath, metadata=meta, lock=lock, out=out, memoryMap=memoryMap, region=region)
         elif meta.fileFormat == pwsdtmd.ICMetaData.FileFormats.NanoMat:
-            return cls.fromNano(meta.filePath, metadata=meta, lock=lock)
+            return cls.fromNano(meta.filePath, metadata=meta, lock=lock, out=out, region=region)
         elif meta.fileFormat is None:
-            return cls.loadAny(meta.filePath, metadata=meta, lock=lock)
+            return cls.loadAny(meta.filePath, metadata=meta, lock=lock, out=out, memoryMap=memoryMap, region=region)
         else:
             raise TypeError("Invalid FileFormat")
 
@@ -1098,18 +1319,22 @@ class ImCube(ICRawBase):
         md = copy.deepcopy(self.metadata)  # We are creating a copy of the metadata object because modifying the original metadata object can cause weird issues.
         assert md.dict is not self.metadata.dict
         md.dict['wavelengths'] = index
-        return ImCube(data, md)
+        cube = ImCube(data, md)
+        cube.offset = self.offset
+        return cube
 
     @staticmethod
     def getMetadataClass() -> Type[pwsdtmd.ICMetaData]:  # Inherit docstring
         return pwsdtmd.ICMetaData
 
     @classmethod
-    def fromHdfDataset(cls, d: h5py.Dataset):
-        """Load an Imcube from an HDF5 dataset."""
-        data, index, mdDict, processingStatus = cls.decodeHdf(d)
+    def fromHdfDataset(cls, d: h5py.Dataset, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None):
+        """Load an Imcube from an HDF5 dataset. If `region` is provided then only that spatial region is read. See `ICBase.decodeHdf`."""
+        data, index, mdDict, processingStatus = cls.decodeHdf(d, region)
         md = pwsdtmd.ICMetaData(mdDict, fileFormat=pwsdtmd.ICMetaData.FileFormats.Hdf)
-        return cls(data, md, processingStatus=processingStatus)
+        cube = cls(data, md, processingStatus=processingStatus)
+        cube.offset = _getWindowOffset(_getRegionWindow(region))
+        return cube
 
     def filterDust(self, kernelRadius: float, pixelSize: float = None) -> None:
         """This method blurs the data of the ImCube along the X and Y dimensions. This is useful if the ImCube is being
@@ -1146,15 +1371,18 @@ class ImCube(ICRawBase):
             logger.warning("The reference ImCube has not been corrected for camera effects. This is highly reccomended before performing any analysis steps.")
         if not reference.processingStatus.normalizedByExposure:
             logger.warning("The reference ImCube has not been normalized by exposure. This is highly reccomended before performing any analysis steps.")
-        self.data = self.data / reference.data
+        self._ensureFloatingPoint()
+        self.data /= self._cropToRegion(reference.data, reference.offset)
         self.processingStatus.normalizedByReference = True
 
     def subtractExtraReflection(self, extraReflection: ExtraReflectionCube):  # Inherit docstring
-        assert self.data.shape == extraReflection.data.shape
+        erData = self._cropToRegion(extraReflection.data, extraReflection.offset)
+        assert self.data.shape == erData.shape
         if not self.processingStatus.normalizedByExposure:
             raise Exception("This ImCube has not yet been normalized by exposure. Are you sure you want to subtract system reflectance before doing this?")
         if not self.processingStatus.extraReflectionSubtracted:
-            self.data = self.data - extraReflection.data
+            self._ensureFloatingPoint()
+            self.data -= erData
             self.processingStatus.extraReflectionSubtracted = True
         else:
             raise Exception("The ImCube has already has extra reflection subtracted.")
@@ -1201,7 +1429,9 @@ class KCube(ICBase):
         # Interpolate to the evenly spaced wavenumbers
         interpFunc = spi.interp1d(wavenumbers, data, kind='linear', axis=2)
         data = interpFunc(evenWavenumbers)
-        return cls(data, tuple(evenWavenumbers.astype(np.float32)), metadata=cube.metadata)
+        kCube = cls(data, tuple(evenWavenumbers.astype(np.float32)), metadata=cube.metadata)
+        kCube.offset = cube.offset
+        return kCube
 
     @property
     def wavenumbers(self) -> Tuple[float, ...]:
@@ -1232,9 +1462,20 @@ class KCube(ICBase):
         opd = opd[:, :, :indexOpdStop]
 
         if not mask is None:
+            if mask.shape != self.data.shape[:2]:  # Assume the mask covers the full frame.
+                mask = self._cropToRegion(mask)
             opd = opd[mask].mean(axis=0)
 
-        dk = self.wavenumbers[1] - self.wavenumbers[0]  # The interval that our linear array of wavenumbers is spaced by. Units: radians / micron
+        opdVals = self._getOpdValues(self.wavenumbers, dataLength, fftSize, indexOpdStop)
+
+        opd = opd.astype(self.data.dtype) #Make sure to upscale precision
+        opdVals = opdVals.astype(self.data.dtype)
+        return opd, opdVals
+
+    @staticmethod
+    def _getOpdValues(wavenumbers: Tuple[float, ...], dataLength: int, fftSize: int, indexOpdStop: Optional[int]) -> np.ndarray:
+        """Returns the OPD values associated with each element of the FFT calculated by `getOpd`."""
+        dk = wavenumbers[1] - wavenumbers[0]  # The interval that our linear array of wavenumbers is spaced by. Units: radians / micron
 
         # Generate the xval for the current OPD.
         maxOpd = 2 * np.pi / dk  # This is the maximum OPD value we can get with. tighter wavenumber spacing increases OPD range. units of microns
@@ -1247,10 +1488,7 @@ class KCube(ICBase):
         # opdVals *= 2 * np.pi  # Units: microns
 
         opdVals = opdVals[:indexOpdStop]
-
-        opd = opd.astype(self.data.dtype) #Make sure to upscale precision
-        opdVals = opdVals.astype(self.data.dtype)
-        return opd, opdVals
+        return opdVals
 
     def getRMSFromOPD(self, lowerOPD: float, upperOPD: float, useHannWindow: bool = False) -> np.ndarray:
         """
@@ -1387,16 +1625,19 @@ class KCube(ICBase):
         return cubeSlope, rSquared
 
     @classmethod
-    def fromHdfDataset(cls, dataset: h5py.Dataset):
+    def fromHdfDataset(cls, dataset: h5py.Dataset, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None):
         """
         Load the KCube object from an `h5py.Dataset` in an HDF5 file
 
         Args:
             dataset: The `h5py.Dataset` that the KCube data is stored in.
+            region: If provided then only this spatial region of the data is read. See `ICBase.decodeHdf`.
         Returns:
             KCube: A new instance of this class."""
-        arr, index = cls.decodeHdf(dataset)
-        return cls(arr, index)
+        arr, index = cls.decodeHdf(dataset, region)
+        cube = cls(arr, index)
+        cube.offset = _getWindowOffset(_getRegionWindow(region))
+        return cube
 
     def __add__(self, other):
         ret = self._add(other)
@@ -1415,6 +1656,127 @@ class KCube(ICBase):
         return KCube(ret, self.wavenumbers, metadata=self.metadata)
 
 
+class LowRankCube:
+    """A data cube that was saved to HDF in the lossy low rank format, see the `lowRankTolerance` argument of
+    `ICBase.toHdfDataset`. The spectrum at each pixel is represented as `mean + coefficients @ basis`. The mean spectra
+    of a region and the OPD can be calculated directly from the coefficients which is much cheaper than working with
+    the full data. The full data is only reconstructed if the `data` attribute is accessed.
+
+    Args:
+        coefficients: A 3D array with dimensions [Y, X, R] giving the coefficient of each of the R basis vectors for every pixel.
+        basis: A 2D array with dimensions [R, Z]. The basis vectors of the spectra.
+        mean: The mean spectrum of the data. Subtracted from each spectrum before the coefficients were calculated.
+        index: The values of the index of the data, e.g. wavenumbers for a `KCube`.
+        offset: The (y, x) position of `coefficients[0, 0]` in the full image. See `ICBase.offset`.
+    """
+    def __init__(self, coefficients: np.ndarray, basis: np.ndarray, mean: np.ndarray, index: Tuple[float, ...], offset: Tuple[int, int] = (0, 0)):
+        assert coefficients.shape[2] == basis.shape[0]
+        assert basis.shape[1] == len(mean) == len(index)
+        self.coefficients = coefficients
+        self.basis = basis
+        self.mean = mean
+        self._index = index
+        self.offset = offset
+
+    @staticmethod
+    def isLowRank(d: h5py.Dataset) -> bool:
+        """Returns `True` if dataset `d` was saved in the low rank format."""
+        return d.attrs['type'].decode().endswith('_lr')
+
+    @classmethod
+    def fromHdfDataset(cls, d: h5py.Dataset, region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]] = None) -> LowRankCube:
+        """Load from a dataset that was saved with the `lowRankTolerance` argument of `ICBase.toHdfDataset`.
+
+        Args:
+            d: The dataset to load from.
+            region: If provided then only the coefficients for this region are read. See `ICBase.decodeHdf`.
+
+        Returns:
+            A new instance of `LowRankCube`.
+        """
+        if not cls.isLowRank(d):
+            raise TypeError(f"{d.name} was not saved in the low rank format.")
+        window = _getRegionWindow(region)
+        coefficients = hdfCodecs.readDataset(d, window + (slice(None),))
+        basis = d.file[d.attrs['basis']][()]
+        return cls(coefficients, basis, d.attrs['mean'], tuple(d.attrs['index']), _getWindowOffset(window))
+
+    @property
+    def index(self) -> Tuple[float, ...]:
+        return self._index
+
+    @property
+    def wavenumbers(self) -> Tuple[float, ...]:
+        """An alias for `index` when this is the low rank representation of a `KCube`"""
+        return self.index
+
+    @cached_property
+    def data(self) -> np.ndarray:
+        """The reconstructed 3D data array. This is only calculated the first time it is accessed."""
+        shape = self.coefficients.shape
+        data = self.coefficients.reshape((shape[0] * shape[1], shape[2])) @ self.basis
+        data += self.mean.astype(data.dtype)
+        return data.reshape(shape[:2] + (len(self.mean),))
+
+    def _getCoefficients(self, mask: Optional[Union[_other.Roi, np.ndarray]]) -> np.ndarray:
+        """Returns the coefficients of the pixels in `mask` as a 2D array. Full frame masks are cropped to line up with the data."""
+        if isinstance(mask, _other.Roi):
+            mask = mask.mask
+        if mask is None:
+            return self.coefficients.reshape((-1, self.coefficients.shape[2]))
+        y, x = self.offset
+        h, w = self.coefficients.shape[:2]
+        if mask.shape != (h, w):  # Assume the mask covers the full frame.
+            mask = mask[y:y + h, x:x + w]
+            if mask.shape != (h, w):
+                raise ValueError(f"The mask is too small to cover the data. The data has shape {(h, w)} at offset {(y, x)} but the cropped mask has shape {mask.shape}.")
+        return self.coefficients[mask]
+
+    def getMeanSpectra(self, mask: Optional[Union[_other.Roi, np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Calculate the average spectra within a region of the data directly from the coefficients.
+
+        Args:
+            mask: An optional other.Roi or boolean numpy array used to select pixels. If left as None then the full data
+                array will be used as the region.
+
+        Returns:
+            The average spectra within the region, the standard deviation of the spectra within the region
+        """
+        coeffs = self._getCoefficients(mask).astype(np.float64)
+        meanCoeffs = coeffs.mean(axis=0)
+        mean = meanCoeffs @ self.basis + self.mean
+        centered = coeffs - meanCoeffs
+        cov = centered.T @ centered / len(coeffs)  # The covariance of the coefficients
+        var = np.einsum('iz,ij,jz->z', self.basis, cov, self.basis)  # The variance of each element of the spectra: diag(basis.T @ cov @ basis)
+        std = np.sqrt(np.clip(var, 0, None))
+        return mean.astype(self.basis.dtype), std.astype(self.basis.dtype)
+
+    def getOpd(self, isHannWindow: bool, indexOpdStop: int = None, mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """The equivalent of `KCube.getOpd` calculated directly from the coefficients. Only the pixels within `mask` are
+        processed.
+
+        Args:
+            isHannWindow: If True, apply a Hann window to the data before the FFT.
+            indexOpdStop: Truncates the 3rd axis of the OPD array.
+            mask: A 2D boolean numpy array indicating which pixels should be processed.
+
+        Returns:
+            A tuple containing: `opd`: The 3D array of values (or the average OPD if `mask` is provided), `opdIndex`:
+                The sequence of OPD values associated with each element of `opd`.
+        """
+        dataLength = len(self.mean)
+        coeffs = self._getCoefficients(mask)
+        opd = _FFTHelper.getLowRankFFTMagnitude(coeffs, self.basis, self.mean, isHannWindow, normalization=_FFTHelper.Normalization.POWER)
+        fftSize = opd.shape[-1]
+        opd = opd[:, :indexOpdStop]
+        if mask is None:
+            opd = opd.reshape(self.coefficients.shape[:2] + (opd.shape[-1],))
+        else:
+            opd = opd.mean(axis=0)
+        opdVals = KCube._getOpdValues(self.wavenumbers, dataLength, fftSize, indexOpdStop)
+        return opd.astype(self.basis.dtype), opdVals.astype(self.basis.dtype)
+
+
 class FluorescenceImage:
     """
     Represents a fluorescence image taken by the PWS acquisition software.
@@ -1498,16 +1860,55 @@ class _FFTHelper:
                 axis of the `data` array. Note that the length of the last axis will be longer than the last axis of the `data` array due to FFT interpolation.
         """
         dataLength = data.shape[-1]
+        fftSize = _FFTHelper._getFFTSize(dataLength)
+        w = _FFTHelper._getWindow(dataLength, useHannWindow)
+
+        # Calculate the Fourier Transform of the signal multiplied by Hann window
+        fft = np.fft.rfft(data * w, n=fftSize, axis=data.ndim-1)
+        fft = np.abs(fft)  # We're only interested in the magnitude.
+        return _FFTHelper._normalize(fft, w, normalization)
+
+    @staticmethod
+    def getLowRankFFTMagnitude(coefficients: np.ndarray, basis: np.ndarray, mean: np.ndarray, useHannWindow: bool = False, normalization: Normalization = Normalization.POWER):
+        """
+        Equivalent to `getFFTMagnitude` for data represented as `coefficients @ basis + mean`. The FFT is linear so
+        the FFT of each basis vector is calculated once and the FFT of each spectrum is just a weighted sum of those.
+
+        Args:
+            coefficients: An array of coefficients, the last axis must match the first axis of `basis`.
+            basis: A 2D array of basis vectors, one per row.
+            mean: The mean spectrum which was subtracted before the coefficients were calculated.
+            useHannWindow: See `getFFTMagnitude`.
+            normalization: See `getFFTMagnitude`.
+
+        Returns:
+            The same as `getFFTMagnitude` would for the reconstructed data.
+        """
+        dataLength = basis.shape[-1]
+        fftSize = _FFTHelper._getFFTSize(dataLength)
+        w = _FFTHelper._getWindow(dataLength, useHannWindow)
+        fft = coefficients @ np.fft.rfft(basis * w, n=fftSize, axis=1)
+        fft += np.fft.rfft(mean * w, n=fftSize)
+        fft = np.abs(fft)
+        return _FFTHelper._normalize(fft, w, normalization)
+
+    @staticmethod
+    def _getFFTSize(dataLength: int) -> int:
         fftSize = int(2 ** (np.ceil(np.log2((2 * dataLength) - 1))))  # This is the next size of fft that is  at least 2x greater than is needed but is a power of two. Results in interpolation, helps amplitude accuracy and fft efficiency.
         fftSize *= 2  # We double the fftsize for even more iterpolation. Not sure why, but that's how it was done in the original matlab code.
+        return fftSize
+
+    @staticmethod
+    def _getWindow(dataLength: int, useHannWindow: bool) -> np.ndarray:
         if useHannWindow:  # if hann window checkbox is selected, create hann window
             w = np.hanning(dataLength)  # Hanning window
         else:
             w = np.ones((dataLength))  # Create unity window
+        return w
 
-        # Calculate the Fourier Transform of the signal multiplied by Hann window
-        fft = np.fft.rfft(data * w, n=fftSize, axis=data.ndim-1)
-        fft = np.abs(fft)  # We're only interested in the magnitude.
+    @staticmethod
+    def _normalize(fft: np.ndarray, w: np.ndarray, normalization: Normalization) -> np.ndarray:
+        dataLength = len(w)
         # Normalize the FFT by the quantity of wavelengths.
         fft /= dataLength
 
@@ -1519,3 +1920,279 @@ class _FFTHelper:
         else:
             raise ValueError(f"{normalization} is not a valid normalization.")
         return fft
+
+
+def _prepareOutputArray(out: Optional[np.ndarray], shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    """Used by the file loaders. Returns `out` after checking that it is compatible, or a new array if `out` is `None`."""
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape != tuple(shape) or out.dtype != dtype or not out.flags.c_contiguous:
+        raise ValueError(f"The output array must be C-contiguous with shape {tuple(shape)} and dtype {np.dtype(dtype)}. Got shape {out.shape} and dtype {out.dtype}.")
+    return out
+
+
+def _getRegionWindow(region: Optional[Union[_other.Roi, Tuple[float, float, float, float]]]) -> Tuple[slice, slice]:
+    """Convert the `region` argument of the file loaders to a (Y, X) pair of slices. `region` can be an `Roi` or a
+    bounding box in the (top, left, bottom, right) form returned by `Roi.getBoundingBox`. The slices may extend past the
+    edge of the frame, numpy and h5py clip them to the size of the data."""
+    if region is None:
+        return slice(None), slice(None)
+    if isinstance(region, _other.Roi):
+        rows = np.flatnonzero(region.mask.any(axis=1))
+        cols = np.flatnonzero(region.mask.any(axis=0))
+        if len(rows) == 0:
+            raise ValueError(f"{region} does not contain any pixels.")
+        return slice(int(rows[0]), int(rows[-1]) + 1), slice(int(cols[0]), int(cols[-1]) + 1)
+    top, left, bottom, right = region
+    return slice(max(int(np.floor(bottom)), 0), int(np.ceil(top)) + 1), slice(max(int(np.floor(left)), 0), int(np.ceil(right)) + 1)
+
+
+def _getWindowOffset(window: Tuple[slice, slice]) -> Tuple[int, int]:
+    """Returns the (y, x) position of the first pixel selected by `window`. This is used as the `offset` of a cube."""
+    return window[0].start or 0, window[1].start or 0
+
+
+def _getWindowShape(window: Tuple[slice, slice], frameShape: Tuple[int, int]) -> Tuple[int, int]:
+    """Returns the shape of a frame of shape `frameShape` after being cropped by `window`."""
+    return tuple(len(range(*slc.indices(n))) for slc, n in zip(window, frameShape))
+
+
+def _checkRawBinaryCubeSize(path: str, shape: Tuple[int, int, int]):
+    """Raise a `ValueError` if the size of the uint16 `image_cube` file at `path` doesn't match `shape`, e.g. if the
+    dimensions in `info2` and `info3` are wrong or the file is truncated."""
+    nbytes = int(np.prod(shape)) * np.dtype(np.uint16).itemsize
+    fileSize = os.path.getsize(path)
+    if fileSize != nbytes:
+        raise ValueError(f"{path} is {fileSize} bytes but data of shape {shape} should be {nbytes} bytes.")
+
+
+def _readRawBinaryCube(path: str, shape: Tuple[int, int, int], out: Optional[np.ndarray] = None, window: Tuple[slice, slice] = (slice(None), slice(None))) -> np.ndarray:
+    """Read the uint16 `image_cube` file of the old MATLAB acquisition software into a C-ordered [Y, X, Z] array.
+    The file is saved in Fortran order, each 2D frame is read into a small buffer and copied into place so that the
+    bytes are only passed over once. If `window` selects a region of the frame then the file is memory mapped and only
+    that region is read."""
+    if window != (slice(None), slice(None)):
+        data = _memoryMapRawBinaryCube(path, shape)[window]
+        out = _prepareOutputArray(out, data.shape, np.dtype(np.uint16))
+        np.copyto(out, data)
+        return out
+    _checkRawBinaryCubeSize(path, shape)
+    out = _prepareOutputArray(out, shape, np.dtype(np.uint16))
+    frame = np.empty((shape[1], shape[0]), dtype=np.uint16)  # A Fortran ordered frame is the transpose of a C ordered frame.
+    with open(path, 'rb') as f:
+        for i in range(shape[2]):
+            if f.readinto(frame) != frame.nbytes:  # The file may have been truncated since it was checked.
+                raise OSError(f"{path} is too small to contain data of shape {shape}.")
+            out[:, :, i] = frame.T
+    return out
+
+
+def _memoryMapRawBinaryCube(path: str, shape: Tuple[int, int, int]) -> np.memmap:
+    """Memory map the uint16 `image_cube` file of the old MATLAB acquisition software as a read-only [Y, X, Z] array.
+    The file is in Fortran order so each Z frame is a contiguous block of the file."""
+    _checkRawBinaryCubeSize(path, shape)
+    return np.memmap(path, dtype=np.uint16, mode='r', shape=shape, order='F')
+
+
+def _readTiffCube(path: str, out: Optional[np.ndarray] = None, window: Tuple[slice, slice] = (slice(None), slice(None))) -> np.ndarray:
+    """Read a 3D tiff file into a C-ordered [Y, X, Z] array. Pages are decoded one at a time directly into their
+    place in the output array. If `window` selects a region of the frame then only that region is kept. Uncompressed
+    files are memory mapped so that only the region is read from disk, otherwise each page must still be decoded in
+    full."""
+    if window != (slice(None), slice(None)):
+        data = _memoryMapTiffCube(path)
+        if data is not None:
+            data = data[window]
+            out = _prepareOutputArray(out, data.shape, data.dtype)
+            np.copyto(out, data)
+            return out
+    with tf.TiffFile(path) as tif:
+        pages = tif.pages
+        first = pages[0]
+        series = tif.series[0]
+        if tuple(series.shape) == (len(pages),) + tuple(first.shape):
+            frameShape = _getWindowShape(window, first.shape)
+            out = _prepareOutputArray(out, frameShape + (len(pages),), first.dtype)
+            for i, page in enumerate(pages):
+                out[:, :, i] = page.asarray()[window]
+        else:  # Some files (e.g. ImageJ hyperstacks larger than 4GB) don't have an entry for each page. Fall back to loading the whole series.
+            data = np.rollaxis(series.asarray(), 0, 3)[window]  # Swap axes to match y,x,lambda convention.
+            out = _prepareOutputArray(out, data.shape, data.dtype)
+            np.copyto(out, data)
+    return out
+
+
+def _memoryMapTiffCube(path: str) -> Optional[np.ndarray]:
+    """Index the data offsets of each page of a 3D tiff file and return a read-only [Y, X, Z] view of a memory map of
+    the file. The pages don't need to be contiguous (e.g. Micro-Manager stores metadata between frames) but they must be
+    uncompressed and evenly spaced so that the Z axis can be represented by a single stride. Returns `None` if the file
+    can't be represented this way."""
+    with tf.TiffFile(path) as tif:
+        pages = tif.pages
+        first = pages[0]
+        if len(first.shape) != 2:  # Only single channel pages are supported.
+            return None
+        offsets = []
+        for page in pages:
+            if not page.is_memmappable or page.shape != first.shape or page.dtype != first.dtype:
+                return None
+            offsets.append(page.dataoffsets[0])
+        dtype = np.dtype(first.dtype).newbyteorder(tif.byteorder)
+    frameBytes = int(np.prod(first.shape)) * dtype.itemsize
+    offsets = np.array(offsets, dtype=np.int64)
+    steps = np.diff(offsets)
+    if len(steps) > 0 and (np.any(steps != steps[0]) or steps[0] < frameBytes):
+        return None
+    pageStride = int(steps[0]) if len(steps) > 0 else frameBytes
+    mm = np.memmap(path, dtype=np.uint8, mode='r', offset=int(offsets[0]), shape=(pageStride * (len(offsets) - 1) + frameBytes,))
+    return np.ndarray(shape=first.shape + (len(offsets),), dtype=dtype, buffer=mm, strides=(first.shape[1] * dtype.itemsize, dtype.itemsize, pageStride))
+
+
+def _readNanoCube(dset: h5py.Dataset, out: Optional[np.ndarray] = None, window: Tuple[slice, slice] = (slice(None), slice(None))) -> np.ndarray:
+    """Read the `imageCube` dataset of a NanoCytomics .mat file into a C-ordered [Y, X, Z] array. MATLAB saves arrays
+    in Fortran order so the dataset is [Z, X, Y]. Each 2D frame is read and transposed into place. If `window` selects
+    a region of the frame then only that hyperslab of the dataset is read."""
+    rows, cols = window
+    frameShape = _getWindowShape(window, (dset.shape[2], dset.shape[1]))
+    out = _prepareOutputArray(out, frameShape + (dset.shape[0],), dset.dtype)
+    for i in range(dset.shape[0]):
+        out[:, :, i] = dset[i, cols, rows].T
+    return out
+
+
+class _FixedPointCodec:
+    """Converts floating point data to and from the 16-bit fixed point format used by `ICBase.toHdfDataset`. Rather
+    than converting the whole array at once, the data is processed one slab of rows at a time in a pool of threads while
+    the main thread reads or writes the HDF dataset. This keeps the memory overhead bounded regardless of the size
+    of the data."""
+    _slabBytes = 2 ** 25  # The approximate size of the floating point data in each slab.
+    _maxValue = 2 ** 16 - 1
+
+    @classmethod
+    def encode(cls, data: np.ndarray, dset: h5py.Dataset, m: float, M: float, codec: Optional[hdfCodecs.HDFCodec] = None):
+        """Scale `data` from the range [`m`, `M`] to the full range of an unsigned 16-bit integer and write it to `dset`.
+
+        Args:
+            data: The array to encode.
+            dset: A uint16 dataset of the same shape as `data`.
+            m: The minimum value of `data`.
+            M: The maximum value of `data`.
+            codec: If `dset` was created by an `hdfCodecs.HDFCodec` then it must be provided to write the data.
+        """
+        def write(slab: slice, arr: np.ndarray):
+            if codec is None:
+                dset[slab] = arr
+            else:
+                codec.write(dset, arr, rowStart=slab.start)
+
+        def encodeSlab(slab: slice) -> np.ndarray:
+            fpData = data[slab] - m
+            fpData = fpData / (M - m)
+            fpData *= cls._maxValue
+            return fpData.astype(np.uint16)
+
+        slabs = cls._getSlabs(data.shape, dset.chunks)
+        numThreads = psutil.cpu_count(logical=False)
+        with ThreadPoolExecutor(numThreads) as pool:
+            pending = collections.deque()
+            for slab in slabs:
+                pending.append((slab, pool.submit(encodeSlab, slab)))
+                if len(pending) > numThreads:  # Don't let encoded slabs pile up faster than they can be written.
+                    slab, fut = pending.popleft()
+                    write(slab, fut.result())
+            for slab, fut in pending:
+                write(slab, fut.result())
+
+    @classmethod
+    def decode(cls, dset: h5py.Dataset, window: Tuple[slice, slice], m: float, M: float) -> np.ndarray:
+        """Read fixed point data from `dset` and scale it back to the range [`m`, `M`].
+
+        Args:
+            dset: The uint16 dataset to read from.
+            window: A (Y, X) pair of slices selecting the region of the dataset to read.
+            m: The minimum value of the original data.
+            M: The maximum value of the original data.
+
+        Returns:
+            A float32 array of the decoded data.
+        """
+        rows, cols = window
+        out = np.empty(_getWindowShape(window, dset.shape[:2]) + (dset.shape[2],), dtype=np.float32)
+        rowStart = rows.indices(dset.shape[0])[0]
+
+        def decodeSlab(slab: slice, raw: np.ndarray):
+            arr = out[slab]
+            arr[...] = raw
+            arr /= cls._maxValue
+            arr *= (M - m)
+            arr += m
+
+        slabs = cls._getSlabs(out.shape, dset.chunks)
+        numThreads = psutil.cpu_count(logical=False)
+        with ThreadPoolExecutor(numThreads) as pool:
+            pending = collections.deque()
+            for slab in slabs:
+                raw = hdfCodecs.readDataset(dset, (slice(rowStart + slab.start, rowStart + slab.stop), cols, slice(None)))
+                pending.append(pool.submit(decodeSlab, slab, raw))
+                if len(pending) > numThreads:  # Don't let raw slabs pile up faster than they can be decoded.
+                    pending.popleft().result()
+            for fut in pending:
+                fut.result()
+        return out
+
+    @classmethod
+    def _getSlabs(cls, shape: Tuple[int, ...], chunks: Optional[Tuple[int, ...]]) -> List[slice]:
+        """Split the first axis of an array of `shape` into slabs. For chunked datasets the slabs are a multiple of the
+        chunk height so that each chunk is only written once."""
+        rowBytes = int(np.prod(shape[1:])) * np.dtype(np.float32).itemsize
+        rows = max(1, cls._slabBytes // max(rowBytes, 1))
+        if chunks is not None:
+            rows = max(chunks[0], rows // chunks[0] * chunks[0])
+        return [slice(i, min(i + rows, shape[0])) for i in range(0, shape[0], rows)]
+
+
+class _LowRankEncoder:
+    """Saves a data cube in the low rank format read by `LowRankCube`. The spectral basis is found from the eigenvectors
+    of the covariance matrix of the spectra which is accumulated a block of pixels at a time to limit memory usage."""
+    _blockPixels = 2 ** 16
+
+    @classmethod
+    def encode(cls, data: np.ndarray, g: h5py.Group, name: str, tolerance: float, chunks: Tuple[int, int],
+               codec: Optional[Union[str, hdfCodecs.HDFCodec]] = None) -> h5py.Dataset:
+        """Calculate the low rank representation of `data` and save it to `g`.
+
+        Args:
+            data: The [Y, X, Z] data cube.
+            g: The group to save to.
+            name: The name of the new dataset of coefficients. The basis is saved to a second dataset named `{name}_basis`
+            tolerance: The maximum root-mean-square error of the saved data relative to the root-mean-square of the data.
+            chunks: The (Y, X) chunk size of the coefficient dataset.
+            codec: An optional codec to compress the coefficients with. See `pwspy.utility.hdfCodecs`.
+
+        Returns:
+            The new dataset of coefficients.
+        """
+        shape = data.shape
+        flat = data.reshape((shape[0] * shape[1], shape[2]))
+        blocks = [slice(i, i + cls._blockPixels) for i in range(0, flat.shape[0], cls._blockPixels)]
+        mean = flat.mean(axis=0, dtype=np.float64)
+        gram = np.zeros((shape[2], shape[2]), dtype=np.float64)
+        for blk in blocks:
+            centered = flat[blk] - mean
+            gram += centered.T @ centered
+        eigVals, eigVecs = np.linalg.eigh(gram)  # Sorted ascending
+        eigVals, eigVecs = np.clip(eigVals[::-1], 0, None), eigVecs[:, ::-1]
+        totalEnergy = eigVals.sum() + flat.shape[0] * (mean @ mean)  # The sum of the squares of all the data.
+        droppedEnergy = np.append(np.cumsum(eigVals[::-1])[::-1], 0)  # droppedEnergy[r] is the squared error when keeping r basis vectors.
+        rank = int(np.argmax(droppedEnergy <= (tolerance ** 2) * totalEnergy))
+        rank = max(rank, 1)
+        basis = eigVecs[:, :rank].T.astype(np.float32)
+        coefficients = np.empty((flat.shape[0], rank), dtype=np.float32)
+        for blk in blocks:
+            coefficients[blk] = (flat[blk] - mean) @ basis.T
+        dset = hdfCodecs.writeDataset(g, name, coefficients.reshape(shape[:2] + (rank,)), codec=codec,
+                                      chunks=(min(chunks[0], shape[0]), min(chunks[1], shape[1]), rank))
+        basisDset = g.create_dataset(f"{name}_basis", data=basis)
+        dset.attrs['basis'] = basisDset.ref
+        dset.attrs['mean'] = mean.astype(np.float32)
+        return dset
@@ -21,10 +21,12 @@ import logging
 import multiprocessing as mp
 import os
 import pathlib
+import re
 import subprocess
 import sys
 import typing
 import abc
+import functools
 import warnings
 from datetime import datetime
 import enum
@@ -40,6 +42,121 @@ from pwspy.dataTypes._other import CameraCorrection, Roi
 import pwspy.dataTypes._data as pwsdtd
 from pwspy import dateTimeFormat
 from pwspy.utility.misc import cached_property
+if typing.TYPE_CHECKING:
+    from pwspy.dataTypes._catalog import AcquisitionCatalog
+
+
+@functools.lru_cache(maxsize=None)
+def _getSchemaStore() -> typing.Dict[str, dict]:
+    """All of our json schemas keyed by their URI. Providing these to the `RefResolver` allows schemas to refer to each
+    other without the referenced schema being read from disk each time."""
+    store = {}
+    for fileName in os.listdir(_jsonSchemasPath):
+        path = os.path.join(_jsonSchemasPath, fileName)
+        with open(path) as f:
+            store[pathlib.Path(path).as_uri()] = json.load(f)
+    return store
+
+
+_validators = {}  # A cache of compiled validators keyed by the schema path or `$id`
+
+
+def _validate(instance: dict, schema: dict, schemaPath: Optional[str] = None):
+    """Check `instance` against a json schema, raising a `jsonschema.ValidationError` if it is invalid. Constructing a
+    validator and resolving the references of a schema is much slower than the validation itself so a validator is only
+    compiled once for each schema.
+
+    Args:
+        instance: The metadata dictionary to validate.
+        schema: The json schema.
+        schemaPath: The path that `schema` was loaded from. This is needed to resolve references to other schema files.
+            If `None` then the schema's `$id` is used to identify it.
+    """
+    key = schemaPath if schemaPath is not None else schema['$id']
+    validator = _validators.get(key)
+    if validator is None:
+        baseCls = jsonschema.validators.validator_for(schema)
+        arrayChecker = baseCls.TYPE_CHECKER.redefine('array', lambda checker, inst: isinstance(inst, (list, tuple)))  # Our metadata often contains tuples rather than lists.
+        cls = jsonschema.validators.extend(baseCls, type_checker=arrayChecker)
+        baseUri = pathlib.Path(schemaPath).as_uri() if schemaPath is not None else ''
+        resolver = jsonschema.RefResolver(baseUri, schema, store=_getSchemaStore())  # This resolver is used to allow derived json schemas to refer to the base schema.
+        validator = _validators[key] = cls(schema, resolver=resolver)
+    error = jsonschema.exceptions.best_match(validator.iter_errors(instance))  # This is the same error that `jsonschema.validate` would raise.
+    if error is not None:
+        raise error
+
+
+_mmKeys = ('Binning', 'PixelSizeUm')  # The only properties of the Micro-Manager metadata that are used.
+
+
+class _JsonIndex:
+    """Finds the structure of a JSON document with vectorized numpy operations rather than parsing it. This is used to
+    pick a few values out of a large document without parsing the rest.
+
+    Args:
+        text: The UTF-8 encoded JSON document.
+    """
+    def __init__(self, text: bytes):
+        self.text = text
+        self._buf = np.frombuffer(text, dtype=np.uint8)
+        idx = np.arange(len(self._buf))
+        isBackslash = self._buf == ord('\\')
+        lastOther = np.maximum.accumulate(np.where(isBackslash, -1, idx))  # The position of the most recent character that isn't a backslash.
+        numBackslashes = np.zeros(len(idx), dtype=int)  # The number of backslashes immediately before each character.
+        numBackslashes[1:] = idx[:-1] - lastOther[:-1]
+        self._isQuote = (self._buf == ord('"')) & (numBackslashes % 2 == 0)  # Quotes that aren't escaped
+        quotesBefore = np.cumsum(self._isQuote) - self._isQuote
+        self._outside = quotesBefore % 2 == 0  # Characters that aren't within a string, the opening quote of a string counts as outside.
+        opens = self._outside & ((self._buf == ord('{')) | (self._buf == ord('[')))
+        closes = self._outside & ((self._buf == ord('}')) | (self._buf == ord(']')))
+        self._depth = np.cumsum(opens.astype(int) - closes)  # The nesting depth after each character. Keys of the top level object are at depth 1.
+
+    def findValues(self, keys: typing.Sequence[str], start: int, end: int, depth: int) -> typing.Dict[str, Tuple[int, int]]:
+        """Find the values of `keys` in the objects at nesting `depth` between positions `start` and `end`.
+
+        Returns:
+            The (start, end) position of the value of each key that was found.
+        """
+        pattern = re.compile(rb'"(' + b'|'.join(re.escape(k.encode()) for k in keys) + rb')"\s*:')
+        spans = {}
+        for m in pattern.finditer(self.text, start, end):
+            if self._isQuote[m.start()] and self._outside[m.start()] and self._depth[m.start()] == depth:
+                spans[m.group(1).decode()] = (m.end(), self._findValueEnd(m.end(), depth))
+        return spans
+
+    def _findValueEnd(self, start: int, depth: int) -> int:
+        """The value ends at the next comma of its object or at the end of its object."""
+        buf, depths = self._buf[start:], self._depth[start:]
+        ends = np.flatnonzero(self._outside[start:] & (((buf == ord(',')) & (depths == depth)) | (depths < depth)))
+        return start + int(ends[0])
+
+
+def _loadMetadataJson(text: Union[str, bytes], fullMetadata: bool = True) -> dict:
+    """Parse a JSON metadata document.
+
+    Args:
+        text: The JSON document.
+        fullMetadata: If `False` then the embedded `MicroManagerMetadata`, which is a large dictionary of every device
+            property, is not parsed. Only the properties that are used are extracted and parsed, see
+            `MetaDataBase._parseMicroManagerMetadata`.
+
+    Returns:
+        The metadata dictionary.
+    """
+    if fullMetadata:
+        return json.loads(text)
+    if isinstance(text, str):
+        text = text.encode()
+    index = _JsonIndex(text)
+    span = index.findValues(('MicroManagerMetadata',), 0, len(text), 1).get('MicroManagerMetadata')
+    if span is None:
+        return json.loads(text)
+    start, end = span
+    metadata = json.loads(text[:start] + b'null' + text[end:])
+    mapSpan = index.findValues(('map',), start, end, 2).get('map')  # For a while the properties were nested in a `map`.
+    start, end, depth = (start, end, 2) if mapSpan is None else (mapSpan[0], mapSpan[1], 3)
+    metadata['MicroManagerMetadata'] = {k: json.loads(text[s:e]) for k, (s, e) in index.findValues(_mmKeys, start, end, depth).items()}
+    return metadata
 
 
 class MetaDataBase(abc.ABC):
@@ -50,6 +167,8 @@ class MetaDataBase(abc.ABC):
         metadata: A dictionary containing the metadata
         filePath: The path to the location the metadata was loaded from
         acquisitionDirectory: A reference to the `AcqDir` associated with this object.
+        trusted: If `True` then validation of `metadata` against the json schema is skipped. This should only be used
+            for metadata that has already been validated, for example metadata loaded from an `AcquisitionCatalog`.
 
     """
 
@@ -66,12 +185,12 @@ class MetaDataBase(abc.ABC):
         This serves as a schematic that can be checked against when loading metadata to make sure it contains the required information."""
         pass
 
-    def __init__(self, metadata: dict, filePath: Optional[str] = None, acquisitionDirectory: Optional[AcqDir] = None):
+    def __init__(self, metadata: dict, filePath: Optional[str] = None, acquisitionDirectory: Optional[AcqDir] = None, trusted: bool = False):
         logger = logging.getLogger(__name__)
         self.filePath = filePath
         self.acquisitionDirectory = acquisitionDirectory
-        refResolver = jsonschema.RefResolver(pathlib.Path(self._jsonSchemaPath).as_uri(), None)  # This resolver is used to allow derived json schemas to refer to the base schema.
-        jsonschema.validate(instance=metadata, schema=self._jsonSchema, types={'array': (list, tuple)}, resolver=refResolver)
+        if not trusted:
+            _validate(metadata, self._jsonSchema, self._jsonSchemaPath)
         self.dict: dict = metadata
         try:
             datetime.strptime(self.dict['time'], dateTimeFormat)
@@ -158,18 +277,48 @@ class MetaDataBase(abc.ABC):
         d.attrs['metadata'] = np.string_(json.dumps(self.dict))
         return d
 
+    @staticmethod
+    def _parseMicroManagerMetadata(metadata: dict, fullMetadata: bool = True, requirePixelSize: bool = False):
+        """Fill in the `binning` and `pixelSizeUm` fields of a metadata dictionary from the metadata saved by Micro-Manager.
+        The Micro-Manager metadata is a large dictionary of every device property but only these values are used.
+
+        Args:
+            metadata: A metadata dictionary containing a `MicroManagerMetadata` item. It is modified in place.
+            fullMetadata: If `False` then the `MicroManagerMetadata` is trimmed to just the properties that are used. This
+                makes the metadata much faster to copy, pickle and save.
+            requirePixelSize: If `True` then a `KeyError` is raised if the pixel size is missing. Otherwise it is set to `None`.
+        """
+        mmMetadata = metadata['MicroManagerMetadata']
+        if 'major_version' in mmMetadata:  # For a while the micromanager metadata was getting saved weird this fixes it.
+            mmMetadata = metadata['MicroManagerMetadata'] = mmMetadata['map']
+        # Get binning from the micromanager metadata
+        binning = mmMetadata['Binning']
+        if isinstance(binning, dict):  # This is due to a property map change from beta to gamma
+            binning = binning['scalar']
+        metadata['binning'] = binning
+        # Get the pixel size from the micromanager metadata
+        try:
+            metadata['pixelSizeUm'] = mmMetadata['PixelSizeUm']['scalar']
+        except KeyError:
+            if requirePixelSize:
+                raise
+            metadata['pixelSizeUm'] = None
+        if metadata['pixelSizeUm'] == 0: metadata['pixelSizeUm'] = None
+        if not fullMetadata:
+            metadata['MicroManagerMetadata'] = {k: mmMetadata[k] for k in _mmKeys if k in mmMetadata}
+
 
 class AnalysisManager(abc.ABC):
     """Handles the functionality to save, load, etc. analysis files.
 
     Args:
-        metadata: A dictionary containing the metadata
-        filePath: The path to the location the metadata was loaded from
-        acquisitionDirectory: A reference to the `AcqDir` associated with this object.
+        filePath: The path to the folder containing the `analyses` folder.
+        catalog: If provided then the list of analyses is answered from this `AcquisitionCatalog` when it is up to date.
 
     """
-    def __init__(self, filePath: str):
+    def __init__(self, filePath: str, catalog: Optional[AcquisitionCatalog] = None):
         self.__filePath = filePath
+        self.__catalog = catalog
 
     @staticmethod
     @abc.abstractmethod
@@ -188,18 +337,21 @@ class AnalysisManager(abc.ABC):
             A list of the names of analyses that were found.
         """
         assert self.__filePath is not None
-        return self.getAnalysesAtPath(self.__filePath)
+        return self.getAnalysesAtPath(self.__filePath, self.__catalog)
 
     @classmethod
-    def getAnalysesAtPath(cls, path: str) -> typing.List[str]:
+    def getAnalysesAtPath(cls, path: str, catalog: Optional[AcquisitionCatalog] = None) -> typing.List[str]:
         """
 
         Args:
             path: The path to search for analysis files.
+            catalog: An optional `AcquisitionCatalog` to answer from.
 
         Returns:
             A list of the names of analyses that were found.
         """
+        if catalog is not None:
+            return catalog.getAnalyses(path, cls.getAnalysisResultsClass())
         anPath = os.path.join(path, 'analyses')
         if os.path.exists(anPath):
             files = os.listdir(os.path.join(path, 'analyses'))
@@ -207,18 +359,31 @@ class AnalysisManager(abc.ABC):
         else:
             return []
 
-    def saveAnalysis(self, analysis: AbstractHDFAnalysisResults, name: str, overwrite: bool = False):
+    def saveAnalysis(self, analysis: AbstractHDFAnalysisResults, name: str, overwrite: bool = False, fingerprint: Optional[str] = None):
         """
 
         Args:
             analysis: An AnalysisResults object to be saved.
             name: The name to save the analysis as
             overwrite: If `True` then any existing file of the same name will be replaced. If `False` an exception will be raised.
+            fingerprint: An optional string identifying the inputs of the analysis. See `getAnalysisFingerprint`.
         """
         path = os.path.join(self.__filePath, 'analyses')
         if not os.path.exists(path):
             os.mkdir(path)
-        analysis.toHDF(path, name, overwrite=overwrite)
+        analysis.toHDF(path, name, overwrite=overwrite, fingerprint=fingerprint)
+
+    def getAnalysisFingerprint(self, name: str) -> Optional[str]:
+        """
+
+        Args:
+            name: The name of the analysis.
+
+        Returns:
+            The fingerprint that the analysis was saved with, `None` if it was saved without one. An `OSError` is raised
+            if the analysis doesn't exist.
+        """
+        return self.getAnalysisResultsClass().loadFingerprint(os.path.join(self.__filePath, 'analyses'), name)
 
     def loadAnalysis(self, name: str) -> AbstractHDFAnalysisResults:
         """
@@ -257,10 +422,11 @@ class DynMetaData(MetaDataBase, AnalysisManager):
     with open(_jsonSchemaPath) as f:
         _jsonSchema = json.load(f)
 
-    def __init__(self, metadata: dict, filePath: Optional[str] = None, fileFormat: Optional[FileFormats] = None, acquisitionDirectory: Optional[AcqDir] = None):
+    def __init__(self, metadata: dict, filePath: Optional[str] = None, fileFormat: Optional[FileFormats] = None, acquisitionDirectory: Optional[AcqDir] = None,
+                 trusted: bool = False):
         self.fileFormat = fileFormat
-        MetaDataBase.__init__(self, metadata, filePath, acquisitionDirectory=acquisitionDirectory)
-        AnalysisManager.__init__(self, filePath)
+        MetaDataBase.__init__(self, metadata, filePath, acquisitionDirectory=acquisitionDirectory, trusted=trusted)
+        AnalysisManager.__init__(self, filePath, None if acquisitionDirectory is None else acquisitionDirectory.catalog)
 
     def toDataClass(self, lock: mp.Lock = None) -> pwsdtd.DynCube:
         """
@@ -330,11 +496,12 @@ class DynMetaData(MetaDataBase, AnalysisManager):
         return cls(md, filePath=directory, fileFormat=DynMetaData.FileFormats.RawBinary, acquisitionDirectory=acquisitionDirectory)
 
     @classmethod
-    def fromTiff(cls, directory, lock: mp.Lock = None, acquisitionDirectory: Optional[AcqDir] = None) -> DynMetaData:
+    def fromTiff(cls, directory, lock: mp.Lock = None, acquisitionDirectory: Optional[AcqDir] = None, fullMetadata: bool = True) -> DynMetaData:
         """
 
         Args:
             directory: The path to the folder containing the data files load the metadata from.
+            fullMetadata: If `False` then only the parts of the Micro-Manager metadata that are used are kept.
         Returns:
             A new instance of `DynMetaData` loaded from file.
         """
@@ -346,16 +513,15 @@ class DynMetaData(MetaDataBase, AnalysisManager):
             else:
                 raise OSError("No Tiff file was found at:", directory)
             if os.path.exists(os.path.join(directory, 'dynmetadata.json')):
-                metadata = json.load(open(os.path.join(directory, 'dynmetadata.json'), 'r'))
+                with open(os.path.join(directory, 'dynmetadata.json'), 'rb') as f:
+                    metadata = _loadMetadataJson(f.read(), fullMetadata)
             else:
                 with tf.TiffFile(path) as tif:
-                    metadata = json.loads(tif.imagej_metadata['Info'])  # The micromanager plugin saves metadata as the info property of the imagej imageplus object.
+                    metadata = _loadMetadataJson(tif.imagej_metadata['Info'], fullMetadata)  # The micromanager plugin saves metadata as the info property of the imagej imageplus object.
         finally:
             if lock is not None:
                 lock.release()
-        metadata['binning'] = metadata['MicroManagerMetadata']['Binning']['scalar']  # Get binning from the micromanager metadata
-        metadata['pixelSizeUm'] = metadata['MicroManagerMetadata']['PixelSizeUm']['scalar']  # Get the pixel size from the micromanager metadata
-        if metadata['pixelSizeUm'] == 0: metadata['pixelSizeUm'] = None
+        cls._parseMicroManagerMetadata(metadata, fullMetadata, requirePixelSize=True)
         return cls(metadata, filePath=directory, fileFormat=cls.FileFormats.Tiff, acquisitionDirectory=acquisitionDirectory)
 
     def getThumbnail(self) -> np.ndarray:
@@ -398,7 +564,7 @@ class ERMetaData:
     def __init__(self, inheritedMetadata: dict, numericalAperture: float, filePath: str=None):
         self.inheritedMetadata = inheritedMetadata
         self.inheritedMetadata['numericalAperture'] = numericalAperture
-        jsonschema.validate(instance=inheritedMetadata, schema=self._jsonSchema, types={'array': (list, tuple)})
+        _validate(inheritedMetadata, self._jsonSchema)
         self.filePath = filePath
 
     @property
@@ -512,8 +678,8 @@ class FluorMetaData(MetaDataBase):
     with open(_jsonSchemaPath) as f:
         _jsonSchema = json.load(f)
 
-    def __init__(self, md: dict, filePath: Optional[str] = None, acquisitionDirectory: Optional[AcqDir] = None):
-        super().__init__(md, filePath, acquisitionDirectory)
+    def __init__(self, md: dict, filePath: Optional[str] = None, acquisitionDirectory: Optional[AcqDir] = None, trusted: bool = False):
+        super().__init__(md, filePath, acquisitionDirectory, trusted=trusted)
 
     def toDataClass(self, lock: mp.Lock = None) -> pwsdtd.FluorescenceImage:
         return pwsdtd.FluorescenceImage.fromMetadata(self, lock)
@@ -523,30 +689,21 @@ class FluorMetaData(MetaDataBase):
         return f"Fluor_{self.dict['system']}_{self.dict['time']}"
 
     @classmethod
-    def fromTiff(cls, directory: str, acquisitionDirectory: Optional[AcqDir]) -> FluorMetaData:
+    def fromTiff(cls, directory: str, acquisitionDirectory: Optional[AcqDir], fullMetadata: bool = True) -> FluorMetaData:
         """Load from a TIFF file.
 
         Args:
             directory: The path to the folder to load from.
+            fullMetadata: If `False` then only the parts of the Micro-Manager metadata that are used are kept.
 
         Returns:
             A new instance of `FluorMetaData` loaded from file.
         """
         if not FluorMetaData.isValidPath(directory):
             raise ValueError(f"Fluorescence image not found in {directory}.")
-        with open(os.path.join(directory, FluorMetaData.MDPATH), 'r') as f:
-            dic = json.load(f)
-
-        # Get binning from the micromanager metadata
-        binning = dic['MicroManagerMetadata']['Binning']['scalar']
-        dic['binning'] = binning
-        # Get the pixel size from the micromanager metadata
-        try:
-            dic['pixelSizeUm'] = dic['MicroManagerMetadata']['PixelSizeUm']['scalar']
-        except KeyError:
-            dic['pixelSizeUm'] = None
-        if dic['pixelSizeUm'] == 0: dic['pixelSizeUm'] = None
-
+        with open(os.path.join(directory, FluorMetaData.MDPATH), 'rb') as f:
+            dic = _loadMetadataJson(f.read(), fullMetadata)
+        cls._parseMicroManagerMetadata(dic, fullMetadata)
         return FluorMetaData(dic, directory, acquisitionDirectory)
 
     @classmethod
@@ -594,9 +751,10 @@ class ICMetaData(MetaDataBase, AnalysisManager):
     with open(_jsonSchemaPath) as f:
         _jsonSchema = json.load(f)
 
-    def __init__(self, metadata: dict, filePath: Optional[str] = None, fileFormat: ICMetaData.FileFormats = None, acquisitionDirectory: Optional[AcqDir] = None):
-        MetaDataBase.__init__(self, metadata, filePath, acquisitionDirectory=acquisitionDirectory)
-        AnalysisManager.__init__(self, filePath)
+    def __init__(self, metadata: dict, filePath: Optional[str] = None, fileFormat: ICMetaData.FileFormats = None, acquisitionDirectory: Optional[AcqDir] = None,
+                 trusted: bool = False):
+        MetaDataBase.__init__(self, metadata, filePath, acquisitionDirectory=acquisitionDirectory, trusted=trusted)
+        AnalysisManager.__init__(self, filePath, None if acquisitionDirectory is None else acquisitionDirectory.catalog)
         self.fileFormat: ICMetaData.FileFormats = fileFormat
         self.dict['wavelengths'] = tuple(np.array(self.dict['wavelengths']).astype(float))
 
@@ -612,17 +770,18 @@ class ICMetaData(MetaDataBase, AnalysisManager):
         return self.dict['wavelengths']
 
     @classmethod
-    def loadAny(cls, directory, lock: mp.Lock = None, acquisitionDirectory: Optional[AcqDir] = None) -> ICMetaData:
+    def loadAny(cls, directory, lock: mp.Lock = None, acquisitionDirectory: Optional[AcqDir] = None, fullMetadata: bool = True) -> ICMetaData:
         """
         Attempt to load from any file format.
 
         Args:
             directory: The file path to load the metadata from.
+            fullMetadata: If `False` then only the parts of the Micro-Manager metadata that are used are kept. See `fromTiff`.
         Returns:
             A new instance of `ICMetaData` loaded from file
         """
         try:
-            return ICMetaData.fromTiff(directory, lock=lock, acquisitionDirectory=acquisitionDirectory)
+            return ICMetaData.fromTiff(directory, lock=lock, acquisitionDirectory=acquisitionDirectory, fullMetadata=fullMetadata)
         except:
             try:
                 return ICMetaData.fromOldPWS(directory, lock=lock, acquisitionDirectory=acquisitionDirectory)
@@ -691,12 +850,13 @@ class ICMetaData(MetaDataBase, AnalysisManager):
         return cls(md, filePath=directory, fileFormat=ICMetaData.FileFormats.NanoMat, acquisitionDirectory=acquisitionDirectory)
 
     @classmethod
-    def fromTiff(cls, directory, lock: mp.Lock = None, acquisitionDirectory: Optional[AcqDir] = None) -> ICMetaData:
+    def fromTiff(cls, directory, lock: mp.Lock = None, acquisitionDirectory: Optional[AcqDir] = None, fullMetadata: bool = True) -> ICMetaData:
         """
         Attempt to load from the standard TIFF file format.
 
         Args:
             directory: The file path to load the metadata from.
+            fullMetadata: If `False` then only the parts of the Micro-Manager metadata that are used are kept.
         Returns:
             A new instance of `ICMetaData` loaded from file
         """
@@ -710,31 +870,19 @@ class ICMetaData(MetaDataBase, AnalysisManager):
             else:
                 raise OSError("No Tiff file was found at:", directory)
             if os.path.exists(os.path.join(directory, 'pwsmetadata.json')):
-                metadata = json.load(open(os.path.join(directory, 'pwsmetadata.json'), 'r'))
+                with open(os.path.join(directory, 'pwsmetadata.json'), 'rb') as f:
+                    metadata = _loadMetadataJson(f.read(), fullMetadata)
             else:
                 with tf.TiffFile(path) as tif:
                     try:
-                        metadata = json.loads(tif.pages[0].description)
+                        metadata = _loadMetadataJson(tif.pages[0].description, fullMetadata)
                     except:
-                        metadata = json.loads(tif.imagej_metadata['Info'])  # The micromanager plugin saves metadata as the info property of the imagej imageplus object.
+                        metadata = _loadMetadataJson(tif.imagej_metadata['Info'], fullMetadata)  # The micromanager plugin saves metadata as the info property of the imagej imageplus object.
                     metadata['time'] = tif.pages[0].tags['DateTime'].value
         finally:
             if lock is not None:
                 lock.release()
-        #For a while the micromanager metadata was getting saved weird this fixes it.
-        if 'major_version' in metadata['MicroManagerMetadata']:
-            metadata['MicroManagerMetadata'] = metadata['MicroManagerMetadata']['map']
-        # Get binning from the micromanager metadata
-        binning = metadata['MicroManagerMetadata']['Binning']
-        if isinstance(binning, dict):  # This is due to a property map change from beta to gamma
-            binning = binning['scalar']
-        metadata['binning'] = binning
-        # Get the pixel size from the micromanager metadata
-        try:
-            metadata['pixelSizeUm'] = metadata['MicroManagerMetadata']['PixelSizeUm']['scalar']
-        except KeyError:
-            metadata['pixelSizeUm'] = None
-        if metadata['pixelSizeUm'] == 0: metadata['pixelSizeUm'] = None
+        cls._parseMicroManagerMetadata(metadata, fullMetadata)
         if 'waveLengths' in metadata:  # Fix an old naming issue
             metadata['wavelengths'] = metadata['waveLengths']
             del metadata['waveLengths']
@@ -770,9 +918,12 @@ class AcqDir:
 
     Args:
         directory: the file path the root directory of the acquisition
+        catalog: If provided then the metadata, ROIs, analyses and thumbnail are loaded from this `AcquisitionCatalog`
+            rather than from the data files, as long as the catalog's record of the acquisition is up to date.
     """
-    def __init__(self, directory: str):
+    def __init__(self, directory: str, catalog: Optional[AcquisitionCatalog] = None):
         self.filePath = os.path.abspath(directory)  # Forcing an absolute path helps by: A: normalizing the path so string comparisons work. B: making sure that if the object is pickled and then unpickled from a different working direcotory the path will still be valid if the data is unmoved.
+        self.catalog = catalog
         if (self.pws is None) and (self.dynamics is None) and (len(self.fluorescence) == 0):
             raise OSError(f"Could not find a valid PWS or Dynamics Acquisition at {directory}.")
 
@@ -784,9 +935,32 @@ class AcqDir:
             path = self.filePath
         return f"{self.__class__.__name__}({path})"
 
+    @cached_property
+    def _catalogMetadata(self) -> Tuple[Optional[ICMetaData], Optional[DynMetaData], typing.List[FluorMetaData]]:
+        return self.catalog.loadMetadata(self)
+
     @cached_property
     def pws(self) -> Optional[ICMetaData]:
         """ICMetaData: Returns None if no PWS acquisition was found."""
+        if self.catalog is not None:
+            return self._catalogMetadata[0]
+        return self._loadPws()
+
+    @cached_property
+    def dynamics(self) -> Optional[DynMetaData]:
+        """DynMetaData: Returns None if no dynamics acquisition was found."""
+        if self.catalog is not None:
+            return self._catalogMetadata[1]
+        return self._loadDynamics()
+
+    @cached_property
+    def fluorescence(self) -> typing.List[FluorMetaData]:
+        """A list of FluorMetaData for each fluorescence image found in the acquisition."""
+        if self.catalog is not None:
+            return self._catalogMetadata[2]
+        return self._loadFluorescence()
+
+    def _loadPws(self) -> Optional[ICMetaData]:
         try:
             return ICMetaData.loadAny(os.path.join(self.filePath, 'PWS'), acquisitionDirectory=self)
         except:
@@ -795,9 +969,7 @@ class AcqDir:
             except:
                 return None
 
-    @cached_property
-    def dynamics(self) -> Optional[DynMetaData]:
-        """DynMetaData: Returns None if no dynamics acquisition was found."""
+    def _loadDynamics(self) -> Optional[DynMetaData]:
         try:
             return DynMetaData.fromTiff(os.path.join(self.filePath, 'Dynamics'), acquisitionDirectory=self)
         except:
@@ -806,8 +978,7 @@ class AcqDir:
             except:
                 return None
 
-    @cached_property
-    def fluorescence(self) -> typing.List[FluorMetaData]:
+    def _loadFluorescence(self) -> typing.List[FluorMetaData]:
         # Newer acquisitions allow for multiple fluorescence images saved to numbered subfolders
         i = 0
         imgs = []
@@ -841,7 +1012,7 @@ class AcqDir:
         """Return information about the Rois found in the acquisition's file path.
         See documentation for Roi.getValidRoisInPath()"""
         assert self.filePath is not None
-        return Roi.getValidRoisInPath(self.filePath)
+        return Roi.getValidRoisInPath(self.filePath, self.catalog)
 
     def loadRoi(self, name: str, num: int, fformat: Roi.FileFormats = None) -> Roi:
         """Load a Roi that has been saved to file in the acquisition's file path."""
@@ -892,6 +1063,11 @@ class AcqDir:
 
     def getThumbnail(self) -> np.ndarray:
         """Return a thumbnail from any of the available acquisitions. Should be an 8bit normalized image."""
+        if self.catalog is not None:
+            return self.catalog.getThumbnail(self)
+        return self._loadThumbnail()
+
+    def _loadThumbnail(self) -> np.ndarray:
         if self.pws is not None:
             return self.pws.getThumbnail()
         elif self.dynamics is not None:
@@ -906,6 +1082,7 @@ class AcqDir:
         """When the object is unpickled this will check if the file path is still valid."""
         if not os.path.exists(state['filePath']):
             warnings.warn(f"{self.__class__.__name__} file path cannot be found. {state['filePath']}")
+        state.setdefault('catalog', None)  # Objects pickled before the catalog was added.
         self.__dict__ = state  # This is the default thing to do to unpicle the object.
 
 
@@ -22,6 +22,7 @@ Created on Sat Feb  9 15:57:52 2019
 @author: Nick Anthony
 """
 from __future__ import annotations
+import functools
 import json
 import logging
 import os
@@ -39,6 +40,8 @@ from shapely import geometry
 from shapely.ops import cascaded_union, polygonize
 import cv2
 import typing
+if typing.TYPE_CHECKING:
+    from pwspy.dataTypes._catalog import AcquisitionCatalog
 if typing.TYPE_CHECKING:
     from matplotlib.image import AxesImage
 
@@ -67,6 +70,27 @@ class CameraCorrection:
             object.__setattr__(self, 'linearityPolynomial', tuple(self.linearityPolynomial))
             assert isinstance(self.linearityPolynomial, tuple)
 
+    @functools.lru_cache(maxsize=16)
+    def getLookupTable(self, binning: int, exposure: float = 1.0) -> np.ndarray:
+        """
+        Raw camera data is unsigned 16-bit so there are only 65,536 possible values. This returns a table of the
+        corrected value for every possible raw value. The dark counts are subtracted, the linearity polynomial is
+        applied, and the result is divided by `exposure`. Results are cached.
+
+        Args:
+            binning: The binning that the raw data was imaged at. 2 = 2x2 binning, 3 = 3x3 binning, etc.
+            exposure: The exposure time to normalize by. Leave as 1 to skip exposure normalization.
+
+        Returns:
+            A read-only float32 array of length 65,536. Index it with the raw data to get the corrected data.
+        """
+        x = np.arange(2 ** 16, dtype=np.float64) - self.darkCounts * binning ** 2  # Account for the fact that binning multiplies the darkcount.
+        if self.linearityPolynomial is not None and self.linearityPolynomial != (1.0,):
+            x = np.polynomial.polynomial.polyval(x, (0.0,) + self.linearityPolynomial)  # The [0] item is the y-intercept (already handled by the darkcount)
+        lut = (x / exposure).astype(np.float32)
+        lut.flags.writeable = False  # This array is shared by the cache. Don't let it be modified.
+        return lut
+
     def toJsonFile(self, filePath: str):
         """
         Save the camera correction to a JSON formatted text file.
@@ -403,12 +427,14 @@ class Roi:
             raise Exception("Programming error.")
 
     @staticmethod
-    def getValidRoisInPath(path: str) -> List[Tuple[str, int, Roi.FileFormats]]:
+    def getValidRoisInPath(path: str, catalog: Optional[AcquisitionCatalog] = None) -> List[Tuple[str, int, Roi.FileFormats]]:
         """Search the `path` for valid roi files and return the detected rois as a list of tuple where each tuple
         contains the `name`, `number`, and file format for the Roi.
 
         Args:
             path: The path to the folder containing the Roi files.
+            catalog: If provided then the result is loaded from this `AcquisitionCatalog` rather than by opening
+                each of the Roi files, as long as the catalog's record is up to date.
 
         Returns:
             A list of tuples containing:
@@ -416,6 +442,8 @@ class Roi:
                 number: The detected Roi number
                 fformat: The file format of the file that the Roi is stored in
         """
+        if catalog is not None:
+            return catalog.getRois(path)
         patterns = [('BW*_*.mat', Roi.FileFormats.MAT), ('ROI_*.h5', Roi.FileFormats.HDF)]
         files = {fformat: glob(os.path.join(path, p)) for p, fformat in patterns} #Lists of the found files keyed by file format
         ret = []
@@ -24,6 +24,8 @@ Modules
    :toctree: generated/
 
    fileIO
+   hdfCodecs
+   sharedMemory
    misc
    machineVision
    fluorescence
@@ -38,5 +40,5 @@ import os
 
 thinFilmPath = os.path.join(os.path.split(__file__)[0], 'thinFilmInterferenceFiles')
 
-__all__ = ['fileIO', 'misc', 'machineVision', 'fluorescence', 'plotting', 'reflection',
+__all__ = ['fileIO', 'hdfCodecs', 'sharedMemory', 'misc', 'machineVision', 'fluorescence', 'plotting', 'reflection',
            'micromanager', 'DConversion']
@@ -2,7 +2,7 @@ from __future__ import annotations
 import json
 import typing
 import os
-from pwspy.dataTypes import AcqDir
+from pwspy.dataTypes import AcqDir, AcquisitionCatalog
 
 
 class SequencerCoordinateStep:
@@ -109,10 +109,11 @@ class SeqAcqDir(AcqDir):
     A subclasss of AcqDir that has will also search for a sequencerCoordinate file
     and load it as an attribute.
     """
-    def __init__(self, directory: typing.Union[str, AcqDir]):
+    def __init__(self, directory: typing.Union[str, AcqDir], catalog: typing.Optional[AcquisitionCatalog] = None):
         if isinstance(directory, AcqDir):
+            catalog = directory.catalog if catalog is None else catalog
             directory = directory.filePath
-        super().__init__(directory)
+        super().__init__(directory, catalog)
         path = os.path.join(directory, "sequencerCoords.json")
         self.sequencerCoordinate = SequencerCoordinate.fromJsonFile(path)
 
@@ -88,6 +88,16 @@ def _procWrap(procFunc, lock: th.Lock):
     return func
 
 
+class _SharedMemoryReturn:
+    """Wraps a function so that its return value is sent back to the parent process through shared memory."""
+    def __init__(self, func: typing.Callable):
+        self.func = func
+
+    def __call__(self, *args):
+        from pwspy.utility.sharedMemory import SharedMemoryPickle  # Requires Python 3.8
+        return SharedMemoryPickle.dumps(self.func(*args))
+
+
 def _loadThenProcess(procFunc, procFuncArgs, lock: mp.Lock, row):
     """Handles loading the ImCubes from file and if needed then calling the processorFunc. This function will be executed
      on each core when running in parallel. If not running in parallel then _loadIms will be used."""
@@ -193,7 +203,8 @@ def loadAndProcess(fileFrame: Union[pd.DataFrame, List, Tuple], processorFunc: O
         return origClass(ret['cube'])
 
 
-def processParallel(fileFrame: pd.DataFrame, processorFunc: typing.Callable[[], typing.Any], initializer: typing.Callable=None, initArgs: Tuple=None, procArgs: Tuple=None, numProcesses: int = None) -> List:
+def processParallel(fileFrame: pd.DataFrame, processorFunc: typing.Callable[[], typing.Any], initializer: typing.Callable=None, initArgs: Tuple=None, procArgs: Tuple=None, numProcesses: int = None,
+                    sharedMemory: bool = False) -> List:
     """A convenience function to process the rows of a pandas DataFrame in parallel
 
     Parameters
@@ -210,11 +221,19 @@ def processParallel(fileFrame: pd.DataFrame, processorFunc: typing.Callable[[],
         A function that is run once at the beginning of each spawned process. Can be used for copying shared memory.
     initArgs:
         A tuple of arguments to pass to the `initializer` function.
+    numProcesses:
+        The number of processes to use. Defaults to one less than the number of physical cores.
+    sharedMemory:
+        If `True` then the return values of `processorFunc` are sent back through shared memory using
+        `pwspy.utility.sharedMemory.SharedMemoryPickle`. This avoids repeatedly copying large return values such as data
+        cubes and analysis results. Requires Python 3.8 or newer.
 
     Returns
     -------
         List containing the results of each execution of `processorFunc`.
     """
+    if sharedMemory:
+        processorFunc = _SharedMemoryReturn(processorFunc)
     if numProcesses is None:
         numProcesses = psutil.cpu_count(logical=False) - 1  # Use one less than number of available cores. If we use all cores then things can get locked up.
     po = mp.Pool(processes=numProcesses, initializer=initializer, initargs=initArgs)
@@ -224,4 +243,6 @@ def processParallel(fileFrame: pd.DataFrame, processorFunc: typing.Callable[[],
     finally:
         po.close()
         po.join()
+    if sharedMemory:
+        cubes = [c.loads() for c in cubes]
     return cubes
\ No newline at end of file
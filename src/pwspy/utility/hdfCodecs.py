@@ -0,0 +1,401 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+# -*- coding: utf-8 -*-
+"""
+Compression codecs for saving large arrays to HDF5 files. The HDF5 library applies compression filters one chunk at a
+time in a single thread, this makes writing compressed files very slow. The codecs in this module compress the chunks
+of a dataset in a pool of threads and then write the compressed chunks directly to the file. The name of the codec is
+saved as the `codec` attribute of the dataset so that `readDataset` can decode it. Codecs that only use standard HDF5
+filters (`GzipCodec`, `ZstdCodec`) produce files that can also be read by any other HDF5 software. `ShuffleDeltaCodec`
+declares a private HDF5 filter, other software will fail to read it rather than silently returning the wrong data.
+
+Classes
+---------
+.. autosummary::
+   :toctree: generated/
+
+   HDFCodec
+   GzipCodec
+   ShuffleDeltaCodec
+   ZstdCodec
+
+Functions
+-----------
+.. autosummary::
+   :toctree: generated/
+
+   registerCodec
+   getCodec
+   availableCodecs
+   writeDataset
+   readDataset
+
+"""
+from __future__ import annotations
+import collections
+import itertools
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, Type, Union, List
+import h5py
+import numpy as np
+import psutil
+
+try:  # These are optional. They are needed for the `ZstdCodec`
+    import zstandard
+    import hdf5plugin
+except ImportError:
+    zstandard = hdf5plugin = None
+
+__all__ = ['HDFCodec', 'GzipCodec', 'ShuffleDeltaCodec', 'ZstdCodec', 'registerCodec', 'getCodec', 'availableCodecs',
+           'writeDataset', 'readDataset']
+
+_registry: Dict[str, Type[HDFCodec]] = {}
+
+
+def registerCodec(cls: Type[HDFCodec]) -> Type[HDFCodec]:
+    """A class decorator that adds an implementation of `HDFCodec` to the registry of codecs so that it can be
+    selected by name and so that datasets saved with it can be decoded by `readDataset`.
+
+    Args:
+        cls: A subclass of `HDFCodec` with a unique `name`.
+
+    Returns:
+        The same class that was passed in.
+    """
+    if cls.name in _registry:
+        raise ValueError(f"A codec named {cls.name} has already been registered.")
+    _registry[cls.name] = cls
+    return cls
+
+
+def availableCodecs() -> List[str]:
+    """
+
+    Returns:
+        The names of the registered codecs which can be used in this environment, along with 'fast' which selects the
+        fastest of them. See `getCodec`.
+    """
+    return [name for name, cls in _registry.items() if cls.isAvailable()] + ['fast']
+
+
+def getCodec(codec: Union[str, HDFCodec]) -> HDFCodec:
+    """Get a codec by name.
+
+    Args:
+        codec: The name of a registered codec. 'fast' selects `ZstdCodec` if it is available and `ShuffleDeltaCodec`
+            otherwise. If an instance of `HDFCodec` is passed in then it is returned unchanged.
+
+    Returns:
+        An instance of the codec with default settings.
+    """
+    if isinstance(codec, HDFCodec):
+        return codec
+    if codec == 'fast':
+        return ZstdCodec() if ZstdCodec.isAvailable() else ShuffleDeltaCodec()
+    try:
+        return _registry[codec]()
+    except KeyError:
+        raise ValueError(f"There is no codec named `{codec}`. Available codecs are: {availableCodecs()}")
+
+
+def writeDataset(g: h5py.Group, name: str, data: np.ndarray, codec: Optional[Union[str, HDFCodec]] = None,
+                 chunks: Optional[Tuple[int, ...]] = None, compression: str = None) -> h5py.Dataset:
+    """Save an array to a new dataset.
+
+    Args:
+        g: The group to create the dataset in.
+        name: The name of the new dataset.
+        data: The array to save.
+        codec: The codec (or name of the codec) to compress the data with. If `None` then the dataset is created by
+            h5py in the usual way.
+        chunks: The chunk shape of the dataset. If `None` a default is chosen. 3D arrays are assumed to be [Y, X, Z] data
+            cubes and are chunked in squares of 64 x 64 pixels spanning the full Z axis.
+        compression: Passed on to `h5py.Group.create_dataset` if `codec` is `None`.
+
+    Returns:
+        The new dataset.
+    """
+    if codec is None:
+        return g.create_dataset(name, data=data, compression=compression, chunks=chunks)
+    codec = getCodec(codec)
+    if chunks is None:
+        if data.ndim == 3:
+            chunks = (min(64, data.shape[0]), min(64, data.shape[1]), data.shape[2])
+        else:
+            chunks = tuple(min(256, n) for n in data.shape)
+    dset = codec.createDataset(g, name, data.shape, data.dtype, chunks)
+    codec.write(dset, data)
+    return dset
+
+
+def readDataset(dset: h5py.Dataset, selection: Tuple[slice, ...] = ()) -> np.ndarray:
+    """Read data from a dataset, decoding it if it was saved with one of the codecs in this module.
+
+    Args:
+        dset: The dataset to read.
+        selection: A tuple of slices selecting the part of the dataset to read. By default the whole dataset is read.
+
+    Returns:
+        The decoded array.
+    """
+    if 'codec' not in dset.attrs:
+        return dset[selection]
+    return getCodec(dset.attrs['codec'].decode()).read(dset, selection)
+
+
+class HDFCodec(ABC):
+    """The base class of the compression codecs. Implementations should be decorated with `registerCodec`.
+
+    Args:
+        numThreads: The number of threads used to compress and decompress chunks. By default the number of physical
+            CPU cores is used.
+    """
+    name: str = None  # The unique name of the codec. This is saved with the data. Don't change it or old files will stop working.
+
+    def __init__(self, numThreads: Optional[int] = None):
+        self._numThreads = numThreads if numThreads is not None else psutil.cpu_count(logical=False)
+
+    @classmethod
+    def isAvailable(cls) -> bool:
+        """Returns `True` if all the packages needed by the codec are installed."""
+        return True
+
+    @abstractmethod
+    def _getFilterKwargs(self) -> dict:
+        """Returns the keyword arguments for `h5py.Group.create_dataset` declaring the HDF5 filters that match the
+        output of `_encodeChunk`."""
+        pass
+
+    @abstractmethod
+    def _encodeChunk(self, chunk: np.ndarray) -> bytes:
+        """Compress a single chunk of the dataset. This is run in multiple threads at once."""
+        pass
+
+    @abstractmethod
+    def _decodeChunk(self, buffer: bytes, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        """Decompress a single chunk of the dataset. This is run in multiple threads at once."""
+        pass
+
+    def createDataset(self, g: h5py.Group, name: str, shape: Tuple[int, ...], dtype: np.dtype, chunks: Tuple[int, ...]) -> h5py.Dataset:
+        """Create a new empty dataset to be filled in with `write`.
+
+        Args:
+            g: The group to create the dataset in.
+            name: The name of the new dataset.
+            shape: The shape of the dataset.
+            dtype: The data type of the dataset.
+            chunks: The shape of each chunk of the dataset. Each chunk is compressed separately.
+
+        Returns:
+            The new dataset.
+        """
+        dset = g.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks, **self._getFilterKwargs())
+        dset.attrs['codec'] = np.string_(self.name)
+        return dset
+
+    def write(self, dset: h5py.Dataset, data: np.ndarray, rowStart: int = 0):
+        """Compress `data` and write it to `dset`.
+
+        Args:
+            dset: A dataset created by `createDataset`.
+            data: The array to write. All dimensions other than the first must match the dataset.
+            rowStart: The position along the first axis of the dataset to write `data` to. This must be a multiple of
+                the chunk size. This allows large arrays to be written a few chunks at a time.
+        """
+        chunks = dset.chunks
+        if rowStart % chunks[0] != 0:
+            raise ValueError(f"`rowStart` must be a multiple of the chunk size, {chunks[0]}")
+
+        def encode(offset: Tuple[int, ...]) -> bytes:
+            block = data[tuple(slice(o, o + c) for o, c in zip(offset, chunks))]
+            if block.shape != chunks:  # HDF5 chunks always have the full chunk shape. Pad chunks on the edge of the dataset.
+                padded = np.zeros(chunks, dtype=dset.dtype)
+                padded[tuple(slice(0, n) for n in block.shape)] = block
+                block = padded
+            return self._encodeChunk(np.ascontiguousarray(block, dtype=dset.dtype))
+
+        offsets = itertools.product(*[range(0, n, c) for n, c in zip(data.shape, chunks)])
+        with ThreadPoolExecutor(self._numThreads) as pool:
+            pending = collections.deque()
+            for offset in offsets:
+                pending.append((offset, pool.submit(encode, offset)))
+                if len(pending) > 2 * self._numThreads:  # Don't let compressed chunks pile up faster than they can be written.
+                    offset, fut = pending.popleft()
+                    dset.id.write_direct_chunk((offset[0] + rowStart,) + offset[1:], fut.result())
+            for offset, fut in pending:
+                dset.id.write_direct_chunk((offset[0] + rowStart,) + offset[1:], fut.result())
+
+    def read(self, dset: h5py.Dataset, selection: Tuple[slice, ...] = ()) -> np.ndarray:
+        """Read and decompress data from a dataset that was written by this codec. Only the chunks which overlap
+        `selection` are read.
+
+        Args:
+            dset: The dataset to read from.
+            selection: A tuple of slices selecting the region to read. Missing dimensions select everything.
+
+        Returns:
+            The decoded array.
+        """
+        chunks = dset.chunks
+        if chunks is None:
+            raise ValueError(f"{dset.name} is not chunked so it was not written by a codec.")
+        selection = tuple(selection) + (slice(None),) * (dset.ndim - len(selection))
+        bounds = [slc.indices(n)[:2] for slc, n in zip(selection, dset.shape)]
+        out = np.empty(tuple(max(stop - start, 0) for start, stop in bounds), dtype=dset.dtype)
+
+        def decode(offset: Tuple[int, ...], buffer: bytes):
+            chunk = self._decodeChunk(buffer, chunks, dset.dtype)
+            src, dst = [], []
+            for o, c, (start, stop) in zip(offset, chunks, bounds):  # Find the overlap between the chunk and the selection.
+                lo, hi = max(o, start), min(o + c, stop)
+                src.append(slice(lo - o, hi - o))
+                dst.append(slice(lo - start, hi - start))
+            out[tuple(dst)] = chunk[tuple(src)]
+
+        offsets = itertools.product(*[range(start // c * c, stop, c) for (start, stop), c in zip(bounds, chunks)])
+        with ThreadPoolExecutor(self._numThreads) as pool:
+            pending = collections.deque()
+            for offset in offsets:
+                filterMask, buffer = dset.id.read_direct_chunk(offset)
+                if filterMask != 0:  # Some filters were skipped for this chunk, so it wasn't written by this codec and can't be decoded by it.
+                    raise ValueError(f"The chunk at {offset} of {dset.name} was not written by the `{self.name}` codec (filter mask {filterMask}).")
+                pending.append(pool.submit(decode, offset, buffer))
+                if len(pending) > 2 * self._numThreads:
+                    pending.popleft().result()
+            for fut in pending:
+                fut.result()
+        return out
+
+    @staticmethod
+    def _shuffle(chunk: np.ndarray) -> bytes:
+        """Equivalent to the HDF5 shuffle filter. The first byte of every element is stored, then the second byte, etc.
+        This groups together the bytes that are similar between neighboring elements, improving compression."""
+        return chunk.reshape(-1).view(np.uint8).reshape((-1, chunk.dtype.itemsize)).T.tobytes()
+
+    @staticmethod
+    def _unshuffle(buffer: bytes, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        """Reverses `_shuffle`."""
+        dtype = np.dtype(dtype)
+        arr = np.frombuffer(buffer, dtype=np.uint8).reshape((dtype.itemsize, -1)).T.copy()
+        return arr.view(dtype).reshape(shape)
+
+
+@registerCodec
+class GzipCodec(HDFCodec):
+    """Byte shuffling followed by gzip compression. These are standard HDF5 filters, the data can be read by any HDF5
+    software.
+
+    Args:
+        level: The gzip compression level, from 0 to 9.
+        numThreads: The number of threads used to compress and decompress chunks.
+    """
+    name = 'gzip'
+
+    def __init__(self, level: int = 4, numThreads: Optional[int] = None):
+        super().__init__(numThreads)
+        self._level = level
+
+    def _getFilterKwargs(self) -> dict:
+        return dict(shuffle=True, compression='gzip', compression_opts=self._level)
+
+    def _encodeChunk(self, chunk: np.ndarray) -> bytes:
+        return zlib.compress(self._shuffle(chunk), self._level)  # zlib releases the GIL so this runs in parallel.
+
+    def _decodeChunk(self, buffer: bytes, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        return self._unshuffle(zlib.decompress(buffer), shape, dtype)
+
+
+@registerCodec
+class ShuffleDeltaCodec(GzipCodec):
+    """A fast codec that doesn't need any extra packages. For integer data, such as the 16-bit fixed point data saved
+    by `ICBase.toHdfDataset`, each element along the last axis (the spectral axis of a data cube) is replaced by its
+    difference from the previous element. Spectra are smooth so the differences are small and compress much better.
+    Floating point data is only shuffled since the differences couldn't be reversed exactly. The data is then
+    compressed with a low gzip level. The differencing is not a standard HDF5 filter so the data must be read with
+    `readDataset`. The dataset declares it as a filter with a private ID, `FILTER_ID`, ahead of the standard shuffle
+    and gzip filters. This filter is never registered with HDF5 so reading the dataset in any other way raises an error.
+
+    Args:
+        level: The gzip compression level, from 0 to 9.
+        numThreads: The number of threads used to compress and decompress chunks.
+    """
+    name = 'shuffleDelta'
+    FILTER_ID = 307  # IDs 256-511 are reserved by HDF5 for filters that aren't publicly registered.
+
+    def __init__(self, level: int = 1, numThreads: Optional[int] = None):
+        super().__init__(level, numThreads)
+
+    def createDataset(self, g: h5py.Group, name: str, shape: Tuple[int, ...], dtype: np.dtype, chunks: Tuple[int, ...]) -> h5py.Dataset:
+        # `h5py.Group.create_dataset` refuses filters that aren't registered, so the dataset is created with the low level API.
+        dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+        dcpl.set_chunk(chunks)
+        dcpl.set_filter(self.FILTER_ID, h5py.h5z.FLAG_OPTIONAL)  # HDF5 skips an unavailable optional filter when the dataset is created but still refuses to read it.
+        dcpl.set_shuffle()
+        dcpl.set_deflate(self._level)
+        space = h5py.h5s.create_simple(shape)
+        dsid = h5py.h5d.create(g.id, name.encode(), h5py.h5t.py_create(np.dtype(dtype)), space, dcpl=dcpl)
+        dset = h5py.Dataset(dsid)
+        dset.attrs['codec'] = np.string_(self.name)
+        return dset
+
+    def _encodeChunk(self, chunk: np.ndarray) -> bytes:
+        if np.issubdtype(chunk.dtype, np.integer):
+            delta = chunk.copy()
+            delta[..., 1:] = np.diff(chunk, axis=-1)  # Integer overflow wraps around, `np.cumsum` reverses this exactly.
+            chunk = delta
+        return super()._encodeChunk(chunk)
+
+    def _decodeChunk(self, buffer: bytes, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        arr = super()._decodeChunk(buffer, shape, dtype)
+        if np.issubdtype(arr.dtype, np.integer):
+            np.cumsum(arr, axis=-1, dtype=arr.dtype, out=arr)
+        return arr
+
+
+@registerCodec
+class ZstdCodec(HDFCodec):
+    """Byte shuffling followed by Zstandard compression. This is much faster than gzip at a similar compression ratio.
+    Requires the `zstandard` and `hdf5plugin` packages. Other software needs the HDF5 Zstandard filter plugin to read
+    the data.
+
+    Args:
+        level: The Zstandard compression level, from 1 to 22.
+        numThreads: The number of threads used to compress and decompress chunks.
+    """
+    name = 'zstd'
+
+    def __init__(self, level: int = 3, numThreads: Optional[int] = None):
+        if not self.isAvailable():
+            raise ImportError("The `zstandard` and `hdf5plugin` packages are required to use `ZstdCodec`.")
+        super().__init__(numThreads)
+        self._level = level
+
+    @classmethod
+    def isAvailable(cls) -> bool:
+        return zstandard is not None
+
+    def _getFilterKwargs(self) -> dict:
+        return dict(shuffle=True, **hdf5plugin.Zstd(clevel=self._level))
+
+    def _encodeChunk(self, chunk: np.ndarray) -> bytes:
+        return zstandard.ZstdCompressor(level=self._level).compress(self._shuffle(chunk))  # Compressor objects aren't thread safe, make a new one each time.
+
+    def _decodeChunk(self, buffer: bytes, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        return self._unshuffle(zstandard.ZstdDecompressor().decompress(buffer), shape, dtype)
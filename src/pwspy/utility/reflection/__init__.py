@@ -26,6 +26,7 @@ Subpackages
     extraReflectance
     multilayerReflectanceEngine
     reflectanceHelper
+    thinFilm
 
 Classes
 ---------
@@ -29,6 +29,7 @@ Functions
    getAllCubeCombos
    plotExtraReflection
    generateRExtraCubes
+   generateRExtraCubesStreaming
 
 Classes
 --------
@@ -38,13 +39,17 @@ Classes
    CubeCombo
 """
 import logging
-from typing import Dict, List, Tuple, Iterable, Any, Iterator, Union, Optional, Set
-from pwspy.dataTypes import Roi, ExtraReflectanceCube, ImCube, ERMetaData
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Iterable, Any, Iterator, Union, Optional, Set, Callable
+import psutil
+from pwspy.dataTypes import Roi, ExtraReflectanceCube, ImCube, ERMetaData, ICMetaData
 from pwspy.utility.reflection import reflectanceHelper, Material
 import itertools
 import matplotlib.pyplot as plt
 import numpy as np
-from functools import reduce
+from functools import reduce, partial
 import pandas as pd
 from dataclasses import dataclass
 
@@ -97,16 +102,48 @@ class _ComboSummary:
     weight: np.ndarray
 
 
-def _interpolateNans(arr):
-    """Interpolate out nan values along the third axis of an array"""
+_nanChunkSize = 65536  # The number of spectra that `_interpolateNans` processes at a time. Chunks are processed in parallel.
 
-    def interp1(arr1):
-        nans = np.isnan(arr1)
-        f = lambda z: z.nonzero()[0]
-        arr1[nans] = np.interp(f(nans), f(~nans), arr1[~nans])
-        return arr1
 
-    arr = np.apply_along_axis(interp1, 2, arr)
+def _interpolateNans(arr: np.ndarray, numThreads: Optional[int] = None) -> np.ndarray:
+    """Interpolate out nan values along the third axis of an array. Values before the first or after the last valid
+    value of a spectrum take the value of the nearest valid value, the same as `np.interp`. Spectra with no valid
+    values are left as nan.
+
+    Only the spectra containing nan are processed. For every nan the nearest valid values on either side are found
+    with cumulative maximum/minimum operations and the gap is filled by linear interpolation, for all spectra at once.
+    If there are many spectra to repair they are processed in chunks by a pool of threads.
+    """
+    arr = arr.copy()
+    nans = np.isnan(arr)
+    bad = np.nonzero(nans.any(axis=2))  # The (y, x) coordinates of the spectra that need repair
+    if len(bad[0]) == 0:
+        return arr
+
+    def fill(chunk: slice):
+        coords = (bad[0][chunk], bad[1][chunk])
+        spectra = arr[coords]  # (spectra, wavelengths)
+        isValid = ~nans[coords]
+        positions = np.arange(spectra.shape[1])
+        previous = np.maximum.accumulate(np.where(isValid, positions, -1), axis=1)  # The index of the last valid value at or before each position
+        following = np.minimum.accumulate(np.where(isValid, positions, spectra.shape[1])[:, ::-1], axis=1)[:, ::-1]  # The index of the next valid value at or after each position
+        previous = np.where(previous < 0, following, previous)  # Before the first valid value use the first valid value.
+        following = np.where(following >= spectra.shape[1], previous, following)  # After the last valid value use the last valid value.
+        hasValid = isValid.any(axis=1)
+        previous[~hasValid] = following[~hasValid] = 0  # These spectra are left as nan.
+        v0 = np.take_along_axis(spectra, previous, axis=1)
+        v1 = np.take_along_axis(spectra, following, axis=1)
+        span = following - previous
+        with np.errstate(invalid='ignore', divide='ignore'):
+            filled = np.where(span > 0, v0 + (v1 - v0) * (positions - previous) / span, v0)
+        arr[coords] = np.where(isValid, spectra, filled)
+
+    chunks = [slice(i, i + _nanChunkSize) for i in range(0, len(bad[0]), _nanChunkSize)]
+    if len(chunks) == 1:
+        fill(chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=numThreads or psutil.cpu_count(logical=False)) as pool:  # Chunks don't overlap so they can safely be written to `arr` in parallel.
+            list(pool.map(fill, chunks))  # Wrapping with `list` raises any errors from the threads.
     return arr
 
 
@@ -380,10 +417,14 @@ def _generateOneRExtraCube(combo: CubeCombo, theoryR: Dict[Material, pd.Series])
         each element in the array is.
 
     """
-    data1 = combo.data1.data
-    data2 = combo.data2.data
     T1 = np.array(theoryR[combo.mat1][np.newaxis, np.newaxis, :])
     T2 = np.array(theoryR[combo.mat2][np.newaxis, np.newaxis, :])
+    return _calculateRExtra(combo.data1.data, combo.data2.data, T1, T2)
+
+
+def _calculateRExtra(data1: np.ndarray, data2: np.ndarray, T1: np.ndarray, T2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The calculation of `_generateOneRExtraCube` for two arrays of data with theoretical reflectances `T1` and `T2`
+    that broadcast against the data."""
     denominator = data1 - data2
     nominator = T1 * data2 - T2 * data1
     arr = nominator / denominator
@@ -437,4 +478,107 @@ def generateRExtraCubes(allCombos: Dict[MCombo, List[CubeCombo]], theoryR: dict,
     return erCube, rExtra
 
 
+_bandBytes = 16 * 1024**2  # The approximate size of the band of rows of a cube processed at a time by `generateRExtraCubesStreaming`.
+_numLoadThreads = 2  # The number of acquisitions loaded at once by `generateRExtraCubesStreaming`. Each one holds a full cube in memory while it is processed.
+
+
+def _accumulateRExtra(band: slice, cubes: Dict[int, np.ndarray], pairs: List[Tuple[int, int]], T1: np.ndarray, T2: np.ndarray,
+                      weightedSum: np.ndarray, weightSum: np.ndarray):
+    """Add the weighted extra reflectance of every pair of cubes to the running sums, for one band of rows."""
+    for i1, i2 in pairs:
+        arr, weight = _calculateRExtra(np.asarray(cubes[i1][band]), np.asarray(cubes[i2][band]), T1, T2)
+        weightedSum[band] += arr * weight
+        weightSum[band] += weight
+
+
+def generateRExtraCubesStreaming(df: pd.DataFrame, matCombos: Iterable[MCombo], theoryR: Dict[Material, pd.Series], numericalAperture: float,
+                                 processor: Optional[Callable[[ImCube], ImCube]] = None, numWorkers: Optional[int] = None,
+                                 scratchDirectory: Optional[str] = None) -> Tuple[ExtraReflectanceCube, Dict[Union[str, MCombo], Tuple[np.ndarray, np.ndarray]]]:
+    """Generate extra reflectance cubes with the same calculation as `generateRExtraCubes` while keeping only a few
+    cubes in memory, no matter how many calibration acquisitions are used.
 
+    Each acquisition is loaded once, at most two at a time, and its data is saved to a memory mapped scratch file. The extra reflectance of
+    every combination of cubes is then folded into a running weighted sum for its material combination, rather than
+    being kept until all combinations have been calculated. The cubes are processed in bands of rows which are spread
+    over a pool of threads, so every thread adds to a different part of the same sums.
+
+    Args:
+        df: A pandas dataframe with a row for each acquisition. The dataframe should have the following columns:
+            'cube': The `ICMetaData` of the acquisition, or an `ImCube` that has already been loaded and processed.
+            'material': The `Material` that the acquisition is an image of.
+        matCombos: The material combinations to evaluate, most likely generated by `generateMaterialCombos`.
+        theoryR: The theoretical reflectance for each material.
+        numericalAperture: The numerical aperture that the acquisitions were imaged at. The theoryR reflectances should
+            have also been calculated at this NA
+        processor: A function that is applied to each cube that is loaded from `ICMetaData`. If `None` then the cubes
+            are corrected for camera effects and normalized by exposure.
+        numWorkers: The number of threads used to calculate the extra reflectance. Defaults to the number of physical cores.
+        scratchDirectory: The folder to save the scratch files in. Defaults to the system's temporary folder. There
+            must be room for a float32 copy of every acquisition.
+
+    Returns:
+        The same as `generateRExtraCubes`. The arrays are float32, the sums are also accumulated in float32 to save memory.
+    """
+    logger = logging.getLogger(__name__)
+    df = df.reset_index(drop=True)
+    matCombos = [mc for mc in matCombos if all((df['material'] == m).any() for m in mc)]  # In some cases a matCombo appears for which there is no data. get rid of these.
+    if len(matCombos) == 0:
+        raise ValueError("None of the material combinations have acquisitions of both materials.")
+    if numWorkers is None:
+        numWorkers = psutil.cpu_count(logical=False)
+    with tempfile.TemporaryDirectory(dir=scratchDirectory) as scratch:
+        cubes: Dict[int, np.ndarray] = {}  # The data of each acquisition, keyed by the row of `df`
+        metadata: Dict[int, Tuple[ICMetaData, Tuple[float, ...]]] = {}  # The metadata and wavelengths of each acquisition
+
+        def load(i: int):
+            cube = df['cube'][i]
+            if isinstance(cube, ImCube):
+                cubes[i], metadata[i] = cube.data, (cube.metadata, cube.wavelengths)
+                return
+            logger.info(f"Loading {cube.filePath}")
+            cube = ImCube.fromMetadata(cube)
+            if processor is not None:
+                cube = processor(cube)
+            elif not cube.processingStatus.cameraCorrected:
+                cube.correctCameraEffectsAndNormalizeExposure()
+            elif not cube.processingStatus.normalizedByExposure:
+                cube.normalizeByExposure()
+            path = os.path.join(scratch, f"{i}.npy")
+            mm = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=cube.data.shape)
+            mm[:] = cube.data
+            mm.flush()
+            del mm
+            cubes[i], metadata[i] = np.load(path, mmap_mode='r'), (cube.metadata, cube.wavelengths)
+
+        used = sorted(set(df.index[df['material'].isin([m for mc in matCombos for m in mc])]))
+        with ThreadPoolExecutor(max_workers=_numLoadThreads) as pool:  # One acquisition can be read from disk while another is processed.
+            list(pool.map(load, used))  # Wrapping with `list` raises any errors from the threads.
+
+        shape = cubes[used[0]].shape
+        rowsPerBand = max(1, _bandBytes // (shape[1] * shape[2] * 4))
+        bands = [slice(y, y + rowsPerBand) for y in range(0, shape[0], rowsPerBand)]
+        rExtra = {}
+        meanSum, meanWeightSum = np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)  # Running sums for the mean over material combinations.
+        for matCombo in matCombos:
+            logger.info(f"Calculating rExtra for: {matCombo}")
+            mat1, mat2 = matCombo
+            pairs = list(itertools.product(df.index[df['material'] == mat1], df.index[df['material'] == mat2]))
+            T1 = np.array(theoryR[mat1])[np.newaxis, np.newaxis, :]
+            T2 = np.array(theoryR[mat2])[np.newaxis, np.newaxis, :]
+            weightedSum, weightSum = np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
+            with ThreadPoolExecutor(max_workers=numWorkers) as pool:
+                list(pool.map(partial(_accumulateRExtra, cubes=cubes, pairs=pairs, T1=T1, T2=T2,
+                                      weightedSum=weightedSum, weightSum=weightSum), bands))
+            weightedSum /= weightSum  # This is now the weighted mean.
+            weightSum /= len(pairs)  # This is now the mean weight.
+            meanSum += weightedSum * weightSum
+            meanWeightSum += weightSum
+            rExtra[matCombo] = (weightedSum, weightSum)
+        meanSum /= meanWeightSum
+        meanWeightSum /= len(matCombos)
+        rExtra['mean'] = (meanSum, meanWeightSum)
+        sampleMetadata, wavelengths = metadata[df.index[df['material'] == matCombos[0][0]][0]]
+        cubes.clear()  # Close the memory mapped files so the scratch folder can be deleted.
+    md = ERMetaData(sampleMetadata.dict, numericalAperture)
+    erCube = ExtraReflectanceCube(rExtra['mean'][0], wavelengths, md)
+    return erCube, rExtra
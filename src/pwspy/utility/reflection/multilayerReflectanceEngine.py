@@ -31,6 +31,9 @@ representing each element of the system. If the transmitted light is considered
 to be propagating from left to right then the matrices should be in multiplied
 in reverse, from right to left.
 
+`StackBatch` calculates the reflectance of many stacks at once, e.g. a sweep of layer thicknesses, and supports
+Gauss-Legendre quadrature for the integration over numerical aperture.
+
 
 Classes
 ----------
@@ -40,10 +43,12 @@ Classes
    Polarization
    Layer
    Stack
+   StackBatch
    NonPolarizedStack
 
 """
-__all__ = ['Polarization', 'Layer', 'Stack', 'NonPolarizedStack']
+from __future__ import annotations
+__all__ = ['Polarization', 'Layer', 'Stack', 'StackBatch', 'NonPolarizedStack']
 
 import typing
 from enum import Enum, auto
@@ -51,7 +56,7 @@ from enum import Enum, auto
 import matplotlib.pyplot as plt
 from cycler import cycler
 from numbers import Number
-from typing import Union, Optional, List
+from typing import Union, Optional, List, Dict, Tuple
 from pwspy.utility.reflection import Material
 import pandas as pd
 import numpy as np
@@ -421,6 +426,172 @@ class Stack(StackBase):
         fig4.show()
 
 
+class StackBatch:
+    """Represents a batch of stacks of 1d homogenous films that differ in the thickness and/or refractive index of
+    their layers, e.g. the candidate stacks of a thin film calibration. Every stack must have the same number of layers.
+    The transfer matrices for every stack, wavelength, numerical aperture and polarization are calculated as a single
+    array and the chain of matrices of each stack is multiplied using a few batched products, rather than one stack and
+    one matrix at a time as in `Stack`. Indices of refraction must be real (no absorption).
+
+    Args:
+        wavelengths: The wavelengths that calculation should operate over.
+        refractiveIndices: The refractive index of each layer. An array of shape (stacks, layers, wavelengths) or
+            (layers, wavelengths) if the indices are the same for every stack. Any axis can have a length of 1 in which
+            case it is broadcast.
+        thicknesses: The thickness of each layer. An array of shape (stacks, layers) or (layers,) if the thicknesses are
+            the same for every stack. The units that thicknesses and wavelengths are specified in must match.
+
+    Examples:
+        Calculate the reflectance of ITO films of 1000 different thicknesses on glass::
+
+            layers = [Layer(Material.Air, 1e6), Layer(Material.ITO, 0), Layer(Material.Glass, 1e6)]
+            thicknesses = np.zeros((1000, 3))
+            thicknesses[:, 1] = np.linspace(0, 1000, num=1000)
+            batch = StackBatch.fromLayers(np.arange(500, 701, 2), layers, thicknesses)
+            r = batch.circularIntegration(0.52)  # An array of shape (1000, 101)
+    """
+    _maxBlockBytes = 256 * 1024**2  # The approximate memory used to calculate a block of stacks. Large batches are calculated one block at a time.
+
+    def __init__(self, wavelengths: np.ndarray, refractiveIndices: np.ndarray, thicknesses: np.ndarray):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        assert len(self.wavelengths.shape) == 1
+        n = np.asarray(refractiveIndices, dtype=float)
+        d = np.asarray(thicknesses, dtype=float)
+        n = n.reshape((1,) * (3 - len(n.shape)) + n.shape)
+        d = d.reshape((1,) * (2 - len(d.shape)) + d.shape)
+        numStacks, numLayers = max(n.shape[0], d.shape[0]), max(n.shape[1], d.shape[1])
+        self.refractiveIndices = np.broadcast_to(n, (numStacks, numLayers, len(self.wavelengths)))
+        self.thicknesses = np.broadcast_to(d, (numStacks, numLayers))
+
+    @classmethod
+    def fromLayers(cls, wavelengths: np.ndarray, layers: List[Layer], thicknesses: Optional[np.ndarray] = None) -> StackBatch:
+        """Create a batch of stacks made of the same layers with different thicknesses.
+
+        Args:
+            wavelengths: The wavelengths that calculation should operate over.
+            layers: The layers of each stack.
+            thicknesses: An array of shape (stacks, layers) giving the thickness of each layer in each stack. If `None`
+                then the batch contains a single stack using the thicknesses of `layers`.
+
+        Returns:
+            A new batch of stacks.
+        """
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        n = np.array([np.asarray(layer.getRefractiveIndex(wavelengths), dtype=float) for layer in layers])
+        if thicknesses is None:
+            thicknesses = np.array([layer.d for layer in layers])
+        return cls(wavelengths, n, thicknesses)
+
+    @classmethod
+    def fromStack(cls, stack: Stack, thicknesses: Optional[np.ndarray] = None) -> StackBatch:
+        """Create a batch of stacks made of the layers of `stack` with different thicknesses. See `fromLayers`."""
+        return cls.fromLayers(stack.wavelengths, stack.layers, thicknesses)
+
+    def calculateReflectance(self, NAs: np.ndarray) -> Dict[Polarization, np.ndarray]:
+        """Calculate the reflectance of every stack for each of the two polarizations. See `Stack.calculateReflectance`.
+
+        Args:
+            NAs: The numerical apertures to calculate reflectance at.
+
+        Returns:
+            A dictionary containing a reflectance array for each of the two polarizations. The polarization is the key
+            to the dictionary. Each reflectance is an array of shape (stacks, wavelengths, NAs).
+        """
+        NAs = np.atleast_1d(np.asarray(NAs, dtype=float))
+        numStacks, numLayers, numWavelengths = self.refractiveIndices.shape
+        bytesPerStack = 3 * (2 * numLayers - 1) * numWavelengths * NAs.size * 2 * 4 * 16  # Three copies of the matrix chain, complex 2x2 matrices for each polarization.
+        blockSize = max(1, int(self._maxBlockBytes // bytesPerStack))
+        R = np.empty((numStacks, numWavelengths, NAs.size, 2))
+        for start in range(0, numStacks, blockSize):
+            block = slice(start, start + blockSize)
+            R[block] = self._calculateBlock(self.refractiveIndices[block], self.thicknesses[block], NAs)
+        return {Polarization.TE: R[..., 0], Polarization.TM: R[..., 1]}
+
+    def _calculateBlock(self, n: np.ndarray, d: np.ndarray, NAs: np.ndarray) -> np.ndarray:
+        """Returns the reflectance of a block of stacks as an array of shape (stacks, wavelengths, NAs, polarizations).
+        The transfer matrices are calculated the same way as `Stack.interfaceMatrix` and `Stack.propagationMatrix` with
+        axes of (stacks, layers, wavelengths, NAs, polarizations, 2, 2)."""
+        n = n[:, :, :, None, None]
+        cosTheta = np.cos(np.arcsin(NAs[None, None, None, :, None] / n))
+        N = np.concatenate(np.broadcast_arrays(n * cosTheta, n / cosTheta), axis=4)  # The effective index for TE and TM polarizations.
+        N1, N2 = N[:, :-1], N[:, 1:]
+        a21 = np.concatenate(np.broadcast_arrays(np.ones((1,)), cosTheta[:, 1:] / cosTheta[:, :-1]), axis=4)  # 1 for TE, cos(theta2)/cos(theta1) for TM
+        interfaces = np.stack([np.stack([N2 + N1, N2 - N1], axis=-1),
+                               np.stack([N2 - N1, N2 + N1], axis=-1)], axis=-2) / (2 * a21 * N2)[..., None, None]
+        phi = n * d[:, :, None, None, None] * cosTheta * 2 * np.pi / self.wavelengths[None, None, :, None, None]
+        phi = np.broadcast_to(phi, N.shape)
+        numStacks, numLayers = N.shape[:2]
+        chain = np.zeros((numStacks, 2 * numLayers - 1) + N.shape[2:] + (2, 2), dtype=complex)
+        chain[:, 0::2, ..., 0, 0] = np.exp(-1j * phi)  # Propagation through each layer
+        chain[:, 0::2, ..., 1, 1] = np.exp(1j * phi)
+        chain[:, 1::2] = interfaces  # The interfaces between layers
+        m = self._chainProduct(chain[:, ::-1])  # The matrices are multiplied in reverse, from right to left.
+        R = m[..., 1, 0] / m[..., 1, 1]  # The reflection coefficient of the stack, the [1, 0] element of the scattering matrix (up to sign).
+        return (R * np.conjugate(R)).real
+
+    @staticmethod
+    def _chainProduct(chain: np.ndarray) -> np.ndarray:
+        """Multiply the matrices along axis 1 of `chain` in order. Neighbouring pairs are multiplied in a single batched
+        product so the number of products grows with the logarithm of the number of layers."""
+        while chain.shape[1] > 1:
+            numMatrices = chain.shape[1]
+            paired = np.einsum('sk...ij,sk...jl->sk...il', chain[:, 0:numMatrices - 1:2], chain[:, 1:numMatrices:2])
+            if numMatrices % 2 == 1:
+                paired = np.concatenate([paired, chain[:, -1:]], axis=1)
+            chain = paired
+        return chain[:, 0]
+
+    @staticmethod
+    def getQuadrature(NA: float, numAngles: int, method: str = 'gauss') -> Tuple[np.ndarray, np.ndarray]:
+        """Get the numerical apertures and weights used to integrate reflectance over the disc of the aperture plane.
+
+        Args:
+            NA: The maximum numerical aperture.
+            numAngles: The number of numerical apertures to evaluate.
+            method: 'gauss' for Gauss-Legendre quadrature. The reflectance varies smoothly with NA so this is accurate
+                to well below the precision of the refractive index data with a few tens of angles. 'trapezoid' for the
+                trapezoidal rule on evenly spaced angles, as used by `Stack.circularIntegration`.
+
+        Returns:
+            A tuple containing: `NAs`: The numerical apertures, `weights`: The weight of each numerical aperture. The weights sum to 1.
+        """
+        if NA == 0:
+            return np.zeros((1,)), np.ones((1,))
+        if method == 'gauss':
+            if numAngles < 1:
+                raise ValueError(f"Gauss-Legendre quadrature requires at least 1 angle, got {numAngles}.")
+            x, w = np.polynomial.legendre.leggauss(numAngles)
+            NAs = NA * (x + 1) / 2
+            w = w * NA / 2
+        elif method == 'trapezoid':
+            if numAngles < 2:
+                raise ValueError(f"The trapezoid rule requires at least 2 angles, got {numAngles}.")
+            NAs = np.linspace(0, NA, num=numAngles)
+            w = np.full((numAngles,), NA / (numAngles - 1))
+            w[[0, -1]] /= 2
+        else:
+            raise ValueError(f"Quadrature method `{method}` is not supported.")
+        weights = w * 2 * np.pi * NAs  # The aperture plane is a disk, higher NAs have larger circumference disks contributing to them.
+        return NAs, weights / weights.sum()
+
+    def circularIntegration(self, NA: float, numAngles: int = 32, method: str = 'gauss') -> np.ndarray:
+        """Integrate the reflectance of every stack over the disc of numerical apertures up to `NA`, averaged over
+        polarization. See `Stack.circularIntegration`.
+
+        Args:
+            NA: The numerical aperture of the system.
+            numAngles: The number of numerical apertures to evaluate.
+            method: The quadrature method to use. See `getQuadrature`.
+
+        Returns:
+            An array of shape (stacks, wavelengths).
+        """
+        NAs, weights = self.getQuadrature(NA, numAngles, method)
+        d = self.calculateReflectance(NAs)
+        r = (d[Polarization.TE] + d[Polarization.TM]) / 2  # Reflectance averaged over polarization.
+        return r @ weights
+
+
 if __name__ == '__main__':
     num = 40
     wv = np.linspace(500, 700, num=100)
@@ -18,6 +18,9 @@
 # -*- coding: utf-8 -*-
 """Provides a number of functions for calculating simple reflections based on known refractive indices
 
+Calculated reflectances are cached in memory. Calling `setCacheDirectory` additionally saves them to disk so that they
+can be shared between processes and sessions.
+
 Functions
 ----------
 .. autosummary::
@@ -25,21 +28,27 @@ Functions
 
    getReflectance
    getRefractiveIndex
+   setCacheDirectory
+   clearCache
 
 """
 
-__all__ = ['getReflectance', 'getRefractiveIndex']
+__all__ = ['getReflectance', 'getRefractiveIndex', 'setCacheDirectory', 'clearCache']
 
+import functools
+import hashlib
+import logging
 import typing
 from numbers import Number
 
 import pandas as pd
 import numpy as np
 import os
+import pwspy
 from . import Material
 
 from .multilayerReflectanceEngine import Stack, Layer, Polarization
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, Optional
 
 
 materialFiles = {
@@ -80,6 +89,9 @@ def _init():
 
 _n = _init()
 del _init
+_nComplex = {mat: _n[mat]['n'].values + 1j * _n[mat]['k'].values for mat in materialFiles}  # The complex refractive index of each material at the wavelengths of `_n.index`
+_dataHash = hashlib.sha1(_n.values.tobytes() + _n.index.values.tobytes() + pwspy.__version__.encode()).hexdigest()  # Identifies the refractive index data and code used to calculate cached reflectances.
+_cacheDirectory: Optional[str] = None
 
 
 def getRefractiveIndex(mat: Material, wavelengths: typing.Optional[typing.Iterable[float]] =None) -> pd.Series:
@@ -93,16 +105,14 @@ def getRefractiveIndex(mat: Material, wavelengths: typing.Optional[typing.Iterab
     Returns:
         The refractive index. The index of the pandas series is the wavelengths.
     """
-    refractiveIndex = np.array([np.complex(i[0], i[1]) for idx, i in _n[mat].iterrows()])
-    refractiveIndex = pd.Series(refractiveIndex, _n.index)
-    if wavelengths is not None: #Need to do interpolation
-        wavelengths = pd.Index(wavelengths)
-        combinedIdx = refractiveIndex.index.append(
-            wavelengths)  # An index that contains all the original index points and all of the new. That way we can interpolate without first throwing away old data.
-        from scipy.interpolate import griddata
-        out = griddata(refractiveIndex.index, refractiveIndex.values, wavelengths)  #This works with complex numbers
-        refractiveIndex = pd.Series(out, index=wavelengths)
-    return refractiveIndex
+    n = _nComplex[mat]
+    if wavelengths is None:
+        return pd.Series(n.copy(), index=_n.index)
+    wavelengths = pd.Index(wavelengths)
+    # Linear interpolation of the real and imaginary parts. Wavelengths outside the range of the data are NaN.
+    x = np.asarray(wavelengths, dtype=float)
+    out = np.interp(x, _n.index.values, n.real, left=np.nan, right=np.nan) + 1j * np.interp(x, _n.index.values, n.imag, left=np.nan, right=np.nan)
+    return pd.Series(out, index=wavelengths)
 
 
 def getReflectance(mat1: Material, mat2: Material, wavelengths: Union[np.ndarray, List, Tuple] = None, NA: float = 0) -> pd.Series:
@@ -125,13 +135,60 @@ def getReflectance(mat1: Material, mat2: Material, wavelengths: Union[np.ndarray
         index = np.array([index])
     elif not isinstance(index, np.ndarray):
         index = np.array(index)
+    r = _getCachedReflectance(mat1, mat2, tuple(index.astype(float).tolist()), 0. if NA is None else float(NA))
+    return pd.Series(r.copy(), index=index)  # Copy so that the cached array can't be modified.
+
+
+def setCacheDirectory(directory: Optional[str]):
+    """Set a folder where calculated reflectances are saved. Reflectances found in the folder are loaded rather than
+    calculated again, this allows the results to be shared between processes and sessions. The setting only applies
+    to the current process.
+
+    Args:
+        directory: The folder to save reflectances in. It is created if it doesn't exist. If `None` then reflectances
+            are only cached in memory.
+    """
+    global _cacheDirectory
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    _cacheDirectory = directory
+
+
+def clearCache():
+    """Clear the in-memory cache of calculated reflectances. Files in the cache directory are not affected."""
+    _getCachedReflectance.cache_clear()
+
+
+@functools.lru_cache(maxsize=64)
+def _getCachedReflectance(mat1: Material, mat2: Material, wavelengths: Tuple[float, ...], NA: float) -> np.ndarray:
+    """Returns a read-only array of the reflectance, loading it from the cache directory if it has been saved there."""
+    if _cacheDirectory is None:
+        r = _calculateReflectance(mat1, mat2, np.array(wavelengths), NA)
+    else:
+        key = hashlib.sha1(repr((mat1.name, mat2.name, wavelengths, NA, _dataHash)).encode()).hexdigest()
+        path = os.path.join(_cacheDirectory, f"reflectance_{key}.npy")
+        try:
+            r = np.load(path)
+        except (OSError, ValueError):  # The file doesn't exist or is incomplete.
+            r = _calculateReflectance(mat1, mat2, np.array(wavelengths), NA)
+            tempPath = f"{path}.{os.getpid()}.tmp.npy"  # Other processes will never see a partially written file.
+            try:
+                np.save(tempPath, r)
+                os.replace(tempPath, path)
+            except OSError as e:
+                logging.getLogger(__name__).warning(f"Failed to save reflectance to {path}: {e!r}")
+    r.flags.writeable = False
+    return r
+
+
+def _calculateReflectance(mat1: Material, mat2: Material, index: np.ndarray, NA: float) -> np.ndarray:
     s = Stack(wavelengths=index)
     s.addLayer(Layer(mat1, 1e9))  # Add a meter thick layer
     s.addLayer(Layer(mat2, 1e9))
     if NA == 0:
         d = s.calculateReflectance(np.array([0]))
         r = (d[Polarization.TE] + d[Polarization.TM]) / 2
-        r = pd.Series(r.squeeze(), index=index)  # Get reflectance at 0 NA (0 incident angle)
+        r = r[:, 0]  # Get reflectance at 0 NA (0 incident angle)
     else:
-        r = s.circularIntegration(np.linspace(0, NA, num=1000))
+        r = s.circularIntegration(np.linspace(0, NA, num=1000)).values
     return r
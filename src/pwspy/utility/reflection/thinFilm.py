@@ -0,0 +1,223 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Map the thickness of a thin film (e.g. an ITO calibration slide or a resin phantom) at every pixel of an image. A library
+of the theoretical reflectance spectra of the film over a grid of thicknesses, and optionally refractive indices, is
+calculated with `multilayerReflectanceEngine.StackBatch`. The spectrum of each pixel is then matched to the most similar
+spectrum in the library using a nearest neighbour search on a low dimensional projection of the spectra.
+
+Spectra are compared by their shape. The mean of each spectrum is subtracted and it is scaled to unit length, so the
+result doesn't depend on the overall intensity of the image or on a constant background.
+
+Classes
+----------
+.. autosummary::
+   :toctree: generated/
+
+   ThinFilmLibrary
+   ThinFilmFit
+
+Functions
+----------
+.. autosummary::
+   :toctree: generated/
+
+   fitThickness
+
+"""
+from __future__ import annotations
+import dataclasses
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+import numpy as np
+import psutil
+from scipy.spatial import cKDTree
+from .multilayerReflectanceEngine import Layer, StackBatch
+if typing.TYPE_CHECKING:
+    from pwspy.dataTypes import ImCube
+
+__all__ = ['ThinFilmLibrary', 'ThinFilmFit', 'fitThickness']
+
+
+def _normalize(spectra: np.ndarray) -> np.ndarray:
+    """Subtract the mean of each spectrum (along the last axis) and scale it to unit length."""
+    spectra = spectra - spectra.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):  # Flat spectra become NaN
+        return spectra / np.linalg.norm(spectra, axis=-1, keepdims=True)
+
+
+@dataclasses.dataclass
+class ThinFilmFit:
+    """The result of fitting spectra with a `ThinFilmLibrary`. Each array has the shape of the fitted spectra without the
+    wavelength axis. Spectra that weren't fit are NaN.
+
+    Attributes:
+        thickness: The thickness of the film.
+        refractiveIndex: The refractive index of the film. `None` if the library used the refractive index of the layer.
+        residual: The root-mean-square difference between the normalized spectrum and the normalized spectrum of the
+            best matching library entry.
+    """
+    thickness: np.ndarray
+    refractiveIndex: Optional[np.ndarray]
+    residual: np.ndarray
+
+
+class ThinFilmLibrary:
+    """A library of theoretical reflectance spectra of a stack containing a film of unknown thickness, and a nearest
+    neighbour index used to find the best matching spectrum for many measured spectra at once.
+
+    Args:
+        wavelengths: The wavelengths of the data that will be fit, e.g. `ImCube.wavelengths`.
+        layers: The layers of the stack, in the same order as for `multilayerReflectanceEngine.Stack`.
+        filmLayer: The position of the film in `layers`. Its thickness is varied over `thicknesses`.
+        thicknesses: The thicknesses of the film to include in the library, in the same units as `wavelengths`. The
+            spacing of the thicknesses should be fine enough that neighbouring spectra are similar.
+        filmIndices: If provided then the film is given each of these (wavelength independent) refractive indices, in
+            combination with each of the thicknesses. Otherwise the refractive index of the film layer is used.
+        NA: The numerical aperture of the system. See `StackBatch.circularIntegration`.
+        numAngles: The number of angles used to integrate over the numerical aperture.
+        numComponents: The number of principal components of the library spectra that the nearest neighbour search is
+            performed in.
+    """
+    def __init__(self, wavelengths: np.ndarray, layers: List[Layer], filmLayer: int, thicknesses: np.ndarray,
+                 filmIndices: Optional[np.ndarray] = None, NA: float = 0, numAngles: int = 32, numComponents: int = 10):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.thicknesses = np.asarray(thicknesses, dtype=float)
+        self.filmIndices = None if filmIndices is None else np.asarray(filmIndices, dtype=float)
+        numIndices = 1 if self.filmIndices is None else len(self.filmIndices)
+        numStacks = numIndices * len(self.thicknesses)  # Entries are ordered by refractive index and then thickness, so neighbouring thicknesses are adjacent.
+        base = StackBatch.fromLayers(self.wavelengths, layers)
+        n = np.repeat(base.refractiveIndices, numStacks, axis=0)
+        if self.filmIndices is not None:
+            n[:, filmLayer, :] = np.repeat(self.filmIndices, len(self.thicknesses))[:, None]
+        d = np.repeat(base.thicknesses, numStacks, axis=0)
+        d[:, filmLayer] = np.tile(self.thicknesses, numIndices)
+        self.spectra: np.ndarray = StackBatch(self.wavelengths, n, d).circularIntegration(NA, numAngles)  # The theoretical reflectance of each entry. (entries, wavelengths)
+
+        self._normalized = np.nan_to_num(_normalize(self.spectra))  # A flat spectrum can't be matched by shape, replacing NaN keeps it from breaking the index.
+        self._center = self._normalized.mean(axis=0)
+        _, _, vt = np.linalg.svd(self._normalized - self._center, full_matrices=False)
+        self._basis = vt[:numComponents]  # The principal components of the library.
+        self._tree = cKDTree(self._project(self._normalized))
+
+    def _project(self, normalized: np.ndarray) -> np.ndarray:
+        return (normalized - self._center) @ self._basis.T
+
+    def fit(self, spectra: np.ndarray, refine: bool = True, numCandidates: int = 8, blockSize: int = 4096,
+            numThreads: Optional[int] = None) -> ThinFilmFit:
+        """Find the best matching library entry for each spectrum.
+
+        Args:
+            spectra: An array of reflectance spectra with wavelength along the last axis.
+            refine: If `True` then the `numCandidates` nearest entries in the low dimensional index are compared using
+                the full spectra and the thickness is interpolated between neighbouring thicknesses of the library by
+                fitting a parabola to the difference between the spectra. Otherwise the single nearest entry in the
+                index is used.
+            numCandidates: The number of nearest entries to compare when `refine` is `True`.
+            blockSize: The number of spectra processed at a time by each thread.
+            numThreads: The number of threads to process blocks of spectra with. Defaults to the number of physical cores.
+
+        Returns:
+            The fitted thickness, refractive index and residual of each spectrum.
+        """
+        spectra = np.asarray(spectra)
+        assert spectra.shape[-1] == len(self.wavelengths), "The spectra don't match the wavelengths of the library."
+        flat = spectra.reshape((-1, spectra.shape[-1]))
+        thickness = np.full((flat.shape[0],), np.nan)
+        index = np.full((flat.shape[0],), np.nan)
+        residual = np.full((flat.shape[0],), np.nan)
+
+        def processBlock(start: int):
+            block = slice(start, start + blockSize)
+            thickness[block], index[block], residual[block] = self._fitBlock(flat[block], refine, numCandidates)
+
+        if numThreads is None:
+            numThreads = psutil.cpu_count(logical=False)
+        with ThreadPoolExecutor(max_workers=numThreads) as pool:  # The nearest neighbour search and numpy release the GIL.
+            list(pool.map(processBlock, range(0, flat.shape[0], blockSize)))  # Wrapping with `list` raises any errors from the threads.
+        shape = spectra.shape[:-1]
+        return ThinFilmFit(thickness.reshape(shape), None if self.filmIndices is None else index.reshape(shape), residual.reshape(shape))
+
+    def _fitBlock(self, spectra: np.ndarray, refine: bool, numCandidates: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the thickness, refractive index and residual of a block of spectra."""
+        thickness = np.full((spectra.shape[0],), np.nan)
+        index = np.full((spectra.shape[0],), np.nan)
+        residual = np.full((spectra.shape[0],), np.nan)
+        x = _normalize(spectra.astype(float))
+        valid = np.all(np.isfinite(x), axis=1)
+        x = x[valid]
+        if x.shape[0] == 0:
+            return thickness, index, residual
+        numCandidates = min(numCandidates if refine else 1, self._normalized.shape[0])
+        _, candidates = self._tree.query(self._project(x), k=numCandidates)
+        candidates = candidates.reshape((x.shape[0], numCandidates))
+        # Compare the candidates using the full spectra.
+        distances = ((self._normalized[candidates] - x[:, None, :])**2).mean(axis=2)
+        best = candidates[np.arange(x.shape[0]), distances.argmin(axis=1)]
+        numThicknesses = len(self.thicknesses)
+        iThickness, iIndex = best % numThicknesses, best // numThicknesses
+        t = self.thicknesses[iThickness]
+        if refine and numThicknesses >= 3:
+            # Fit a parabola to the distance from the neighbouring thicknesses. Entries at the edge of the library are left as they are.
+            interior = (iThickness > 0) & (iThickness < numThicknesses - 1)
+            i = best[interior]
+            xi = x[interior]
+            f0, f1, f2 = (((self._normalized[i + offset] - xi)**2).mean(axis=1) for offset in (-1, 0, 1))
+            t0, t1, t2 = (self.thicknesses[iThickness[interior] + offset] for offset in (-1, 0, 1))
+            numerator = (t1 - t0)**2 * (f1 - f2) - (t1 - t2)**2 * (f1 - f0)
+            denominator = (t1 - t0) * (f1 - f2) - (t1 - t2) * (f1 - f0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                vertex = t1 - 0.5 * numerator / denominator
+            curvature = (f2 - f1) / (t2 - t1) - (f1 - f0) / (t1 - t0)  # Proportional to the second derivative, positive for an upward parabola.
+            ok = (curvature > 0) & (denominator != 0) & (vertex >= t0) & (vertex <= t2)  # Only accept the vertex of an upward parabola that lies between the neighbours.
+            refined = t[interior]
+            refined[ok] = vertex[ok]
+            t[interior] = refined
+        thickness[valid] = t
+        if self.filmIndices is not None:
+            index[valid] = self.filmIndices[iIndex]
+        residual[valid] = np.sqrt(((self._normalized[best] - x)**2).mean(axis=1))
+        return thickness, index, residual
+
+
+def fitThickness(cube: ImCube, library: ThinFilmLibrary, mask: Optional[np.ndarray] = None, refine: bool = True) -> ThinFilmFit:
+    """Map the thickness of a film at every pixel of an image.
+
+    Args:
+        cube: The image of the film. This should be normalized by a reference so that it is proportional to reflectance.
+        library: A library calculated at the wavelengths of `cube`.
+        mask: A 2D boolean array. If provided then only the pixels where it is `True` are fit, the others are NaN.
+        refine: See `ThinFilmLibrary.fit`.
+
+    Returns:
+        Maps of the thickness, refractive index and residual of the fit at each pixel.
+    """
+    assert len(cube.wavelengths) == len(library.wavelengths) and np.allclose(cube.wavelengths, library.wavelengths), "The library must be calculated at the wavelengths of the cube."
+    if mask is None:
+        return library.fit(cube.data, refine=refine)
+    fit = library.fit(cube.data[mask], refine=refine)
+    maps = []
+    for values in (fit.thickness, fit.refractiveIndex, fit.residual):
+        if values is None:
+            maps.append(None)
+            continue
+        m = np.full(cube.data.shape[:2], np.nan)
+        m[mask] = values
+        maps.append(m)
+    return ThinFilmFit(*maps)
@@ -0,0 +1,216 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Share numpy arrays between processes using named blocks of shared memory. Unlike `multiprocessing.RawArray`, which is
+only shared with processes that are forked after it is created, these arrays can be passed to processes started with
+any start method. Requires Python 3.8 or newer.
+
+Classes
+---------
+.. autosummary::
+   :toctree: generated/
+
+   SharedArray
+   SharedMemoryPickle
+
+"""
+from __future__ import annotations
+import atexit
+import os
+import pickle
+import weakref
+from multiprocessing import shared_memory
+from typing import Dict, Tuple, List, Any
+import numpy as np
+
+__all__ = ['SharedArray', 'SharedMemoryPickle']
+
+_blocks: Dict[str, Tuple[shared_memory.SharedMemory, int]] = {}  # Every block used by this process keyed by name, along with the process ID of the process that created the block.
+
+
+def _attach(name: str, shape: Tuple[int, ...], dtype: str) -> SharedArray:
+    """Used to unpickle a `SharedArray`. Attaches to an existing block of shared memory."""
+    if name in _blocks:
+        shm = _blocks[name][0]
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        _blocks[name] = (shm, None)
+    return SharedArray._fromBlock(shm, shape, np.dtype(dtype))
+
+
+def _release(name: str):
+    """Forget about a block. If this process created the block then it is unlinked so that the memory will be freed once
+    every process is finished with it."""
+    shm, ownerPid = _blocks.pop(name, (None, None))
+    if ownerPid == os.getpid():  # Forked processes inherit our records, they shouldn't unlink blocks that they didn't create.
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass  # Already unlinked.
+
+
+_unclosed: List[shared_memory.SharedMemory] = []  # Blocks that couldn't be closed yet because something still refers to their memory.
+
+
+def _closeBlock(shm: shared_memory.SharedMemory):
+    """Unmap a block that was loaded by `SharedMemoryPickle`. This normally happens once the last array using it is
+    garbage collected. If the unpickled object made its own views of the buffer then the memory may still be in use, in
+    which case we try again later."""
+    for block in [shm] + _unclosed:
+        try:
+            block.close()
+        except BufferError:
+            if block not in _unclosed:
+                _unclosed.append(block)
+        else:
+            if block in _unclosed:
+                _unclosed.remove(block)
+
+
+@atexit.register
+def _releaseAll():
+    for name in list(_blocks.keys()):
+        _release(name)
+
+
+class SharedArray(np.ndarray):
+    """A numpy array stored in a named block of shared memory. When pickled only the name, shape and data type of the
+    block are saved, unpickling attaches to the same memory without copying it. Views and the results of calculations
+    with the array are pickled as plain numpy arrays, so with protocol 5 their data can be sent out-of-band, e.g. by
+    `SharedMemoryPickle`.
+
+    The process that creates the block with `fromArray` owns it. The block is unlinked when the owner's array is garbage
+    collected, when `release` is called, or when the owning process exits. Other processes can keep using the memory
+    they have already attached to after it has been unlinked.
+    """
+    def __array_finalize__(self, obj):
+        self._shm = None  # Only the array that spans the entire block is pickled by reference.
+
+    @classmethod
+    def _fromBlock(cls, shm: shared_memory.SharedMemory, shape: Tuple[int, ...], dtype: np.dtype) -> SharedArray:
+        arr = np.ndarray.__new__(cls, shape, dtype=dtype, buffer=shm.buf)
+        arr._shm = shm
+        return arr
+
+    @classmethod
+    def fromArray(cls, arr: np.ndarray) -> SharedArray:
+        """Copy an array to a new block of shared memory.
+
+        Args:
+            arr: The array to copy. If this is already a `SharedArray` then it is returned unchanged.
+
+        Returns:
+            A new array backed by shared memory.
+        """
+        if isinstance(arr, SharedArray) and arr._shm is not None:
+            return arr
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))  # Zero size blocks aren't allowed.
+        _blocks[shm.name] = (shm, os.getpid())
+        out = cls._fromBlock(shm, arr.shape, arr.dtype)
+        np.copyto(out, arr)
+        weakref.finalize(out, _release, shm.name)
+        return out
+
+    @property
+    def name(self) -> str:
+        """The name of the shared memory block. `None` if this is a view of a `SharedArray`."""
+        return None if self._shm is None else self._shm.name
+
+    def release(self):
+        """Unlink the block of shared memory if this process created it. The memory is freed once no process is
+        attached to it."""
+        if self._shm is not None:
+            _release(self._shm.name)
+
+    def __reduce__(self):
+        if self._shm is None:
+            return np.asarray(self).__reduce__()
+        return _attach, (self._shm.name, self.shape, self.dtype.str)
+
+    def __reduce_ex__(self, protocol):
+        if self._shm is None:
+            return np.asarray(self).__reduce_ex__(protocol)  # numpy only passes the buffers of plain arrays out-of-band, subclasses are pickled in-band.
+        return self.__reduce__()  # numpy would otherwise pickle the data itself when using protocol 5.
+
+
+class SharedMemoryPickle:
+    """An object that has been pickled with protocol 5 with its large buffers, e.g. the data of numpy arrays and data
+    cubes, placed in shared memory rather than in the pickle. Sending this to another process only sends the small
+    in-band part of the pickle and the names of the shared memory blocks. The receiver's arrays use the shared memory
+    directly so the data is copied once, by `dumps`, rather than several times by the normal pickling machinery.
+
+    The process that calls `loads` takes ownership of the blocks. They are unlinked as soon as it has attached to them
+    and the memory is freed once the last array using it is garbage collected. Each instance should only be loaded once.
+    On Windows shared memory is freed as soon as no process has it open, so there the buffers are kept in the pickle.
+
+    Args:
+        payload: The in-band part of the pickle.
+        blocks: The name and size in bytes of the block of shared memory holding each out-of-band buffer.
+    """
+    def __init__(self, payload: bytes, blocks: List[Tuple[str, int]]):
+        self.payload = payload
+        self.blocks = blocks
+
+    @classmethod
+    def dumps(cls, obj: Any) -> SharedMemoryPickle:
+        """Pickle `obj`, copying its out-of-band buffers to shared memory.
+
+        Args:
+            obj: The object to pickle.
+
+        Returns:
+            A new instance that can be sent to another process and loaded with `loads`.
+        """
+        if os.name == 'nt':
+            return cls(pickle.dumps(obj, protocol=5), [])
+        buffers = []
+        payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        blocks = []
+        for buf in buffers:
+            raw = buf.raw()  # A flat view of the bytes of the buffer
+            shm = shared_memory.SharedMemory(create=True, size=max(raw.nbytes, 1))  # Zero size blocks aren't allowed.
+            shm.buf[:raw.nbytes] = raw
+            blocks.append((shm.name, raw.nbytes))
+            raw.release()
+            shm.close()  # The block persists until the receiver unlinks it.
+        return cls(payload, blocks)
+
+    def loads(self) -> Any:
+        """Load the pickled object. Its arrays will refer to the shared memory without copying it.
+
+        Returns:
+            The object that was passed to `dumps`.
+        """
+        buffers = []
+        for name, nbytes in self.blocks:
+            shm = shared_memory.SharedMemory(name=name)
+            shm.unlink()  # The memory remains available to us until we close it.
+            view = shm.buf[:nbytes]
+            weakref.finalize(view, _closeBlock, shm)  # Unmap the memory once nothing refers to it anymore.
+            buffers.append(view)
+        return pickle.loads(self.payload, buffers=buffers)
+
+    def discard(self):
+        """Free the shared memory of an instance that won't be loaded. Has no effect if it has already been loaded."""
+        for name, nbytes in self.blocks:
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                continue  # Already loaded or discarded.
+            shm.unlink()
+            shm.close()
@@ -0,0 +1,90 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Round trip tests of the compression codecs in `pwspy.utility.hdfCodecs`."""
+import h5py
+import numpy as np
+import pytest
+
+from pwspy.utility import hdfCodecs
+
+_codecNames = [name for name in hdfCodecs.availableCodecs() if name != 'fast']
+_standardCodecs = [name for name in _codecNames if name != hdfCodecs.ShuffleDeltaCodec.name]  # Codecs that are readable without `readDataset`.
+
+
+@pytest.fixture
+def h5File(tmp_path):
+    with h5py.File(tmp_path / 'test.h5', 'w') as f:
+        yield f
+
+
+def _makeData(dtype) -> np.ndarray:
+    """Smooth spectra with some noise. The shape is not a multiple of the chunk shape so there are partial chunks."""
+    rng = np.random.default_rng(0)
+    data = 30000 + 10000 * np.sin(np.linspace(0, 3, 50)) + rng.normal(0, 100, (70, 45, 50))
+    return data.astype(dtype)
+
+
+@pytest.mark.parametrize('codec', _codecNames + ['fast'])
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+def test_roundTrip(h5File, codec, dtype):
+    data = _makeData(dtype)
+    hdfCodecs.writeDataset(h5File, 'data', data, codec=codec, chunks=(16, 16, 50))
+    assert np.array_equal(hdfCodecs.readDataset(h5File['data']), data)
+    selection = (slice(5, 40), slice(17, 45), slice(None))
+    assert np.array_equal(hdfCodecs.readDataset(h5File['data'], selection), data[selection])
+
+
+@pytest.mark.parametrize('codec', _codecNames)
+def test_writeInSlabs(h5File, codec):
+    data = _makeData(np.uint16)
+    codecObj = hdfCodecs.getCodec(codec)
+    dset = codecObj.createDataset(h5File, 'data', data.shape, data.dtype, (16, 16, 50))
+    for start in range(0, data.shape[0], 32):
+        codecObj.write(dset, data[start:start + 32], rowStart=start)
+    assert np.array_equal(hdfCodecs.readDataset(dset), data)
+    with pytest.raises(ValueError):
+        codecObj.write(dset, data[:16], rowStart=8)
+
+
+@pytest.mark.parametrize('codec', _standardCodecs)
+def test_readableByH5py(h5File, codec):
+    data = _makeData(np.uint16)
+    hdfCodecs.writeDataset(h5File, 'data', data, codec=codec)
+    assert np.array_equal(h5File['data'][()], data)
+
+
+def test_shuffleDeltaNotReadableByH5py(h5File):
+    """The differencing isn't a standard filter. Reading the data without the codec must fail rather than return garbage."""
+    hdfCodecs.writeDataset(h5File, 'data', _makeData(np.uint16), codec=hdfCodecs.ShuffleDeltaCodec.name)
+    with pytest.raises(OSError):
+        h5File['data'][()]
+
+
+def test_unknownCodec():
+    with pytest.raises(ValueError):
+        hdfCodecs.getCodec('notACodec')
+
+
+@pytest.mark.parametrize('codec', _codecNames)
+def test_fixedPointCube(h5File, codec):
+    """Data cubes saved in the fixed point format with a codec decode to the same values as without a codec."""
+    import pwspy.dataTypes as pwsdt
+    cube = pwsdt.KCube(_makeData(np.float32), tuple(np.linspace(8, 12, 50)))
+    cube.toHdfDataset(h5File, 'plain', fixedPointCompression=True)
+    cube.toHdfDataset(h5File, 'codec', fixedPointCompression=True, codec=codec)
+    assert np.array_equal(pwsdt.KCube.fromHdfDataset(h5File['codec']).data, pwsdt.KCube.fromHdfDataset(h5File['plain']).data)
@@ -0,0 +1,117 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Round trip tests of the formats that `ICBase.toHdfDataset` can save data cubes in."""
+import h5py
+import numpy as np
+import pytest
+
+import pwspy.dataTypes as pwsdt
+from pwspy.dataTypes._data import _FixedPointCodec
+
+
+def _makeCube(shape=(70, 45, 30)) -> pwsdt.KCube:
+    rng = np.random.default_rng(0)
+    return pwsdt.KCube(rng.normal(1, 0.1, shape).astype(np.float32), tuple(np.linspace(8, 12, shape[2])))
+
+
+@pytest.fixture
+def h5File(tmp_path):
+    with h5py.File(tmp_path / 'test.h5', 'w') as f:
+        yield f
+
+
+@pytest.fixture
+def smallSlabs(monkeypatch):
+    """Use slabs of just a few rows so that the data is split into many slabs."""
+    monkeypatch.setattr(_FixedPointCodec, '_slabBytes', 3 * 45 * 30 * 4)
+
+
+@pytest.mark.parametrize('chunkSize', [None, 16, 64])
+def test_fixedPointMatchesWholeArrayConversion(h5File, smallSlabs, chunkSize):
+    """Encoding and decoding one slab at a time gives exactly the same values as converting the whole array at once."""
+    cube = _makeCube()
+    cube.toHdfDataset(h5File, 'cube', fixedPointCompression=True, chunkSize=chunkSize)
+    m, M = cube.data.min(), cube.data.max()
+    expected = ((cube.data - m) / (M - m) * (2 ** 16 - 1)).astype(np.uint16)
+    assert np.array_equal(h5File['cube'][()], expected)
+    decoded = pwsdt.KCube.fromHdfDataset(h5File['cube'])
+    expectedDecoded = expected.astype(np.float32) / (2 ** 16 - 1)
+    expectedDecoded *= (M - m)
+    expectedDecoded += m
+    assert np.array_equal(decoded.data, expectedDecoded)
+    assert decoded.wavenumbers == cube.wavenumbers
+    assert np.abs(decoded.data - cube.data).max() <= (M - m) / (2 ** 16 - 1)
+
+
+def test_fixedPointRegion(h5File, smallSlabs):
+    cube = _makeCube()
+    cube.toHdfDataset(h5File, 'cube', fixedPointCompression=True, chunkSize=16)
+    full = pwsdt.KCube.fromHdfDataset(h5File['cube'])
+    region = pwsdt.KCube.fromHdfDataset(h5File['cube'], region=(50, 7, 11, 30))  # (top, left, bottom, right)
+    assert region.offset == (11, 7)
+    assert np.array_equal(region.data, full.data[11:51, 7:31])
+
+
+def _makeLowRankCube(shape=(70, 45, 30)) -> pwsdt.KCube:
+    """Spectra made from a few smooth components plus a little noise, so they are well described by a low rank basis."""
+    rng = np.random.default_rng(0)
+    k = np.linspace(0, 1, shape[2])
+    components = np.stack([np.sin(2 * np.pi * f * k) for f in (1, 2.5, 4)])
+    data = 1 + rng.normal(0, 0.1, shape[:2] + (3,)) @ components + rng.normal(0, 1e-3, shape)
+    return pwsdt.KCube(data.astype(np.float32), tuple(np.linspace(8, 12, shape[2])))
+
+
+@pytest.mark.parametrize('tolerance', [1e-2, 1e-3])
+def test_lowRankTolerance(h5File, tolerance):
+    cube = _makeLowRankCube()
+    cube.toHdfDataset(h5File, 'cube', lowRankTolerance=tolerance)
+    assert pwsdt.LowRankCube.isLowRank(h5File['cube'])
+    decoded = pwsdt.KCube.fromHdfDataset(h5File['cube'])
+    error = np.sqrt(np.mean((decoded.data.astype(np.float64) - cube.data) ** 2))
+    assert error <= tolerance * np.sqrt(np.mean(cube.data.astype(np.float64) ** 2))
+
+
+def test_lowRankCalculations(h5File):
+    """The calculations done directly on the coefficients match those done on the reconstructed data."""
+    cube = _makeLowRankCube()
+    cube.toHdfDataset(h5File, 'cube', lowRankTolerance=1e-3)
+    lowRank = pwsdt.LowRankCube.fromHdfDataset(h5File['cube'])
+    reconstructed = pwsdt.KCube(lowRank.data, lowRank.wavenumbers)
+    mask = np.zeros(cube.data.shape[:2], dtype=bool)
+    mask[10:30, 5:40] = True
+    for m in (None, mask):
+        for expected, actual in zip(reconstructed.getMeanSpectra(m), lowRank.getMeanSpectra(m)):
+            assert np.allclose(expected, actual, rtol=1e-4, atol=1e-5)
+    expectedOpd, expectedIndex = reconstructed.getOpd(isHannWindow=True)
+    opd, opdIndex = lowRank.getOpd(isHannWindow=True)
+    assert np.allclose(opd, expectedOpd, rtol=1e-3, atol=1e-6)
+    assert np.allclose(opdIndex, expectedIndex)
+
+
+def test_lowRankRegion(h5File):
+    cube = _makeLowRankCube()
+    cube.toHdfDataset(h5File, 'cube', lowRankTolerance=1e-3, chunkSize=16)
+    full = pwsdt.LowRankCube.fromHdfDataset(h5File['cube'])
+    region = pwsdt.LowRankCube.fromHdfDataset(h5File['cube'], region=(50, 7, 11, 30))  # (top, left, bottom, right)
+    assert region.offset == (11, 7)
+    assert np.array_equal(region.data, full.data[11:51, 7:31])
+    mask = np.zeros(cube.data.shape[:2], dtype=bool)  # A full frame mask is cropped to the region.
+    mask[20:40, 10:20] = True
+    assert np.allclose(region.getMeanSpectra(mask)[0], full.getMeanSpectra(mask)[0])
+    with pytest.raises(ValueError):  # This mask doesn't reach the bottom of the region.
+        region.getMeanSpectra(mask[:45])
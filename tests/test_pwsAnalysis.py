@@ -0,0 +1,73 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Checks that the tiled PWS analysis gives the same results as the original whole image analysis."""
+import dataclasses
+
+import numpy as np
+import pytest
+
+import pwspy.dataTypes as pwsdt
+from pwspy.analysis.pws import PWSAnalysis, PWSAnalysisSettings
+
+_wavelengths = tuple(range(500, 701, 2))
+_resultNames = ('meanReflectance', 'rms', 'polynomialRms', 'autoCorrelationSlope', 'rSquared', 'ld')
+
+
+def _makeCube(seed: int, amplitude: float, shape=(37, 53)) -> pwsdt.ImCube:
+    """A synthetic cube where each pixel has a sinusoidal spectrum of random frequency and phase plus some noise."""
+    rng = np.random.default_rng(seed)
+    wv = np.array(_wavelengths)
+    freq = rng.uniform(0.02, 0.06, shape + (1,))
+    phase = rng.uniform(0, 2 * np.pi, shape + (1,))
+    data = 1000 + amplitude * np.sin(freq * wv + phase) + rng.normal(0, 1, shape + (len(wv),))
+    md = pwsdt.ICMetaData({'system': 'test', 'time': f'1-1-2020 00:00:{seed:02d}', 'exposure': 100, 'pixelSizeUm': 0.1,
+                           'binning': 1, 'wavelengths': _wavelengths})
+    return pwsdt.ImCube(data.astype(np.float32), md)
+
+
+@pytest.fixture(scope='module')
+def analysis() -> PWSAnalysis:
+    settings = PWSAnalysisSettings.loadDefaultSettings('Recommended')
+    settings = dataclasses.replace(settings, skipAdvanced=False, autoCorrMinSub=False, referenceMaterial=None,
+                                   cameraCorrection=pwsdt.CameraCorrection(0, None))
+    return PWSAnalysis(settings, None, _makeCube(0, 0))
+
+
+@pytest.mark.parametrize('tileSizes', [(8, 32), (5, 256), (1, 13)])
+def test_tileSizeIndependence(analysis, tileSizes):
+    a, b = (analysis.run(_makeCube(1, 20), tileSize=tileSize)[0] for tileSize in tileSizes)
+    for name in _resultNames:
+        assert np.array_equal(getattr(a, name), getattr(b, name)), name
+    assert np.array_equal(a.reflectance.data, b.reflectance.data)
+
+
+def test_tiledMatchesUntiled(analysis):
+    tiled = analysis.run(_makeCube(1, 20), tileSize=16)[0]
+    untiled = analysis.run(_makeCube(1, 20))[0]
+    for name in _resultNames:
+        assert np.allclose(getattr(tiled, name), getattr(untiled, name), rtol=1e-4, atol=1e-6), name
+    assert np.allclose(tiled.reflectance.data, untiled.reflectance.data, rtol=1e-4, atol=1e-6)
+
+
+def test_memoryBudget(analysis):
+    cube = _makeCube(1, 20)
+    plan = analysis.getPlan(cube.wavelengths)
+    with pytest.raises(ValueError):  # The outputs alone don't fit.
+        plan.getTileSize(1000, 1, cube.data.shape[:2])
+    tiled = analysis.run(cube, memoryBudget=2 ** 24, numThreads=2)[0]
+    assert np.array_equal(tiled.rms, analysis.run(_makeCube(1, 20), tileSize=16)[0].rms)